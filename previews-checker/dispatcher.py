@@ -0,0 +1,134 @@
+import json
+import os
+import random
+import time
+
+target_concurrency = int(os.environ.get("dispatch_target_concurrency", 100)) # Backfill invocations in flight per function
+live_share = float(os.environ.get("dispatch_live_share", 0.3)) # Share of the concurrency left to live uploads
+# Expected seconds per invocation of each tier, turns a concurrency into a rate
+tier_seconds = {
+  "high": float(os.environ.get("dispatch_high_seconds", 60)),
+  "low": float(os.environ.get("dispatch_low_seconds", 10))
+}
+max_retries = 5
+backoff_factor = 0.5 # Rate kept after a throttle
+recovery_step = 0.05 # Share of the target rate added back after every success
+
+class TokenBucket:
+  """Lets through rate requests per second on average, with bursts of up to capacity"""
+
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity or max(1.0, rate)
+    self.tokens = self.capacity
+    self.last = time.monotonic()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def wait_time(self):
+    self.refill()
+    return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+  def take(self):
+    self.refill()
+    self.tokens -= 1
+
+def is_throttle(error):
+  return getattr(error, "response", {}).get("Error", {}).get("Code") in ("TooManyRequestsException", "ThrottlingException")
+
+class Dispatcher:
+  """Invokes the preview functions asynchronously without starving live uploads
+
+  Every function gets a token bucket whose rate is its share of the concurrency divided by how
+  long an invocation takes. The share is the smaller of dispatch_target_concurrency and what's
+  left of the function's reserved concurrency after dispatch_live_share. Functions without a
+  reservation split the account's unreserved concurrency between them instead. Concurrent
+  shards split it evenly. Throttles halve the rate and every success adds a bit back, up to
+  the target.
+
+  :param client: Lambda client
+  :param shards: Checkers dispatching at the same time
+  :param state: State saved by a previous invocation with state(), to keep the learned rates
+  :param functions: Every function this may invoke, the ones without a reservation share the unreserved pool
+  """
+
+  def __init__(self, client, shards=1, state=None, functions=()):
+    self.client = client
+    self.shards = max(1, shards)
+    self.functions = set(functions)
+    self.reservations = {}
+    self.targets = {}
+    self.buckets = {}
+    self.rates = dict((state or {}).get("rates", {}))
+    self.throttles = (state or {}).get("throttles", 0)
+
+  def reservation(self, name):
+    if name not in self.reservations:
+      self.reservations[name] = self.client.get_function_concurrency(FunctionName=name).get("ReservedConcurrentExecutions")
+    return self.reservations[name]
+
+  def concurrency_limit(self, name):
+    try:
+      reserved = self.reservation(name)
+      if reserved is None:
+        sharing = [function for function in self.functions | {name} if self.reservation(function) is None]
+        reserved = self.client.get_account_settings()["AccountLimit"]["UnreservedConcurrentExecutions"] / len(sharing)
+    except Exception as e:
+      print(f"Unable to read the concurrency of {name}, using the target as is", e)
+      return target_concurrency
+    return max(1, int(reserved * (1 - live_share)))
+
+  def bucket(self, name, tier):
+    if name not in self.buckets:
+      concurrency = max(1, min(target_concurrency, self.concurrency_limit(name)) / self.shards)
+      self.targets[name] = concurrency / tier_seconds[tier]
+      rate = min(self.rates.get(name, self.targets[name]), self.targets[name])
+      self.buckets[name] = TokenBucket(rate, max(1.0, concurrency / 4))
+      print(f"Dispatching to {name} at up to {self.targets[name]:.2f} invocations per second")
+    return self.buckets[name]
+
+  def adjust(self, name, rate):
+    bucket = self.buckets[name]
+    bucket.refill()
+    bucket.rate = max(self.targets[name] / 100, min(self.targets[name], rate))
+    self.rates[name] = bucket.rate
+
+  def dispatch(self, name, tier, request, budget):
+    """Invoke name with request once a token is available
+
+    :param name: Function to invoke
+    :param tier: "high" or "low", for the expected duration of an invocation
+    :param request: Event sent to the function
+    :param budget: Seconds this call may wait for tokens and retries
+    :return: True when invoked, False when it didn't fit in the budget and should be left for later
+    """
+    bucket = self.bucket(name, tier)
+    deadline = time.monotonic() + budget
+    for attempt in range(max_retries + 1):
+      wait = bucket.wait_time()
+      if time.monotonic() + wait > deadline:
+        return False
+      time.sleep(wait)
+      bucket.take()
+      try:
+        self.client.invoke(FunctionName=name, InvocationType='Event', Payload=json.dumps(request))
+      except Exception as e:
+        if not is_throttle(e) or attempt == max_retries:
+          raise
+        self.throttles += 1
+        self.adjust(name, bucket.rate * backoff_factor)
+        # Full jitter so the shards don't come back at the same time
+        pause = min(random.uniform(0, 2 ** attempt), deadline - time.monotonic())
+        if pause > 0:
+          time.sleep(pause)
+        continue
+      self.adjust(name, bucket.rate + self.targets[name] * recovery_step)
+      return True
+    return False
+
+  def state(self):
+    # Saved in the continuation event so the next invocation starts from the rates learned here
+    return {"rates": self.rates, "throttles": self.throttles}
@@ -1,12 +1,24 @@
 import json
 import boto3
 import os
+import uuid
 import yaml
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil import parser
 
+import dispatcher
+import routing
+import skip_index
+
 client = boto3.client('lambda')
+MINIMUM_REMAINING_TIME_MS = 5000
+page_size = 250 # Keys listed at a time, the time left is checked between pages
+tag_workers = int(os.environ.get("checker_tag_workers", 16))
+max_shards = int(os.environ.get("checker_max_shards", 64))
+progress_prefix = "previews/backfill"
+skip_words = ['previews/', '.asp-preview'] # Just in case there's a file with the name of preview in it
 
 def read_yaml(file):
   with open(file, "r") as stream:
@@ -15,9 +27,8 @@ def read_yaml(file):
     except yaml.YAMLError as exc:
       print(exc)
       raise exc
-      
+
 def check_preview_tag(tags):
-  print(tags)
   for tag in tags:
     if tag["Key"] == 'previews' and tag["Value"] == 'true':
       return True
@@ -30,88 +41,212 @@ def invoke_lambda(name, request):
     Payload=json.dumps(request)
   )
 
+def list_prefixes(s3_client, bucket, path):
+  prefixes = []
+  for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=path, Delimiter="/"):
+    prefixes += [prefix["Prefix"] for prefix in page.get("CommonPrefixes", [])]
+  return [prefix for prefix in prefixes if not any(word in prefix for word in skip_words)]
+
+def discover_shards(s3_client, bucket, path, target):
+  """Split the key space under path into shards that can be listed independently
+
+  The folders found with a "/" delimiter become shards of their own, splitting the largest
+  known level first, until there are at least target shards or nothing left to split.
+  The objects directly in a split folder stay in a non-recursive shard.
+
+  :param s3_client: S3 client
+  :param bucket: Bucket to split
+  :param path: Prefix of the backfill
+  :param target: Number of shards wanted, capped at max_shards
+  :return: List of shards, dicts with the path and whether it's listed recursively
+  """
+  target = min(target, max_shards)
+  shards = [{"path": path, "recursive": True}]
+  pending = [path]
+  while pending and len(shards) < target:
+    prefix = pending.pop(0)
+    children = list_prefixes(s3_client, bucket, prefix)
+    if not children or len(shards) + len(children) > max_shards:
+      continue
+    shards = [shard for shard in shards if shard["path"] != prefix]
+    shards.append({"path": prefix, "recursive": False})
+    shards += [{"path": child, "recursive": True} for child in children]
+    pending += children
+  return shards
+
+def progress_key(job, shard):
+  return f"{progress_prefix}/{job}/{shard}.json"
+
+def write_progress(s3_client, bucket, job, shard, progress):
+  s3_client.put_object(Bucket=bucket, Key=progress_key(job, shard), Body=json.dumps(progress).encode())
+
+def report(s3_client, bucket, job):
+  # Sums the progress every shard has written so far
+  manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=progress_key(job, "job"))["Body"].read())
+  totals = {"listed": 0, "skipped": 0, "invoked": 0, "lookups": 0, "throttles": 0}
+  done = 0
+  for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{progress_prefix}/{job}/"):
+    for item in page.get("Contents", []):
+      if item["Key"] == progress_key(job, "job"):
+        continue
+      progress = json.loads(s3_client.get_object(Bucket=bucket, Key=item["Key"])["Body"].read())
+      for name in totals:
+        totals[name] += progress.get(name, 0)
+      done += 1 if progress["done"] else 0
+  return dict(totals, job=job, path=manifest["path"], shards=manifest["shards"], shards_done=done)
+
+def build_index(s3_client, bucket, event, run):
+  # One listing pass over previews/ or an S3 Inventory report, saved so shards and continuations can load it
+  start = datetime.now()
+  manifest = event.get("inventory") or os.environ.get("checker_inventory_manifest")
+  index = skip_index.inventory_markers(s3_client, manifest) if manifest else skip_index.list_markers(s3_client, bucket)
+  index_key = f"{progress_prefix}/{run}/index.json.gz"
+  skip_index.save(s3_client, bucket, index_key, index)
+  print(f"Indexed {len(index)} previewed files in {(datetime.now() - start).total_seconds()} seconds")
+  return index_key
+
+def fan_out(s3_client, event, context):
+  # Starts one checker per shard, they all share a job id to report progress under
+  bucket = event["bucket"]
+  start_time = event.get("start_time", datetime.now().isoformat())
+  job = uuid.uuid4().hex[:12]
+  shards = discover_shards(s3_client, bucket, event["path"], int(event["shards"]))
+  index_key = build_index(s3_client, bucket, event, job) if event.get("skip_index", True) else None
+  s3_client.put_object(Bucket=bucket, Key=progress_key(job, "job"),
+    Body=json.dumps({"path": event["path"], "shards": len(shards), "start_time": start_time}).encode())
+  for index, shard in enumerate(shards):
+    invoke_lambda(context.function_name, {
+      "bucket": bucket,
+      "path": shard["path"],
+      "recursive": shard["recursive"],
+      "start_time": start_time,
+      "job": job,
+      "shard": index,
+      "shards_total": len(shards),
+      "index": index_key
+    })
+  print(f"Started backfill {job} with {len(shards)} shards: {[shard['path'] for shard in shards]}")
+  return job, len(shards)
 
 def main(event, context):
   s3_client = boto3.client('s3')
-  MINIMUM_REMAINING_TIME_MS = 5000
-  s3 = boto3.resource('s3')
   last_item = event['marker'] if 'marker' in event else ''
   bucket = event['bucket'] if 'bucket' in event else ''
   path = event['path'] if 'path' in event else "N/A"
+  if bucket != '' and 'report' in event:
+    progress = report(s3_client, bucket, event['report'])
+    print(progress)
+    return {
+      'statusCode': 200,
+      'body': json.dumps(progress)
+    }
   if path == "N/A" or bucket == '':
     raise Exception("Missing required params, either path or bucket")
-  my_bucket = s3.Bucket(bucket)
+  if 'shards' in event and 'job' not in event:
+    job, shards = fan_out(s3_client, event, context)
+    return {
+      'statusCode': 200,
+      'body': json.dumps({"job": job, "shards": shards})
+    }
   start_datetime = parser.parse(event['start_time']) if 'start_time' in event else datetime.now()
-  skip_words = ['previews/', '.asp-preview'] # Just in case there's a file with the name of preview in it
+  recursive = event.get('recursive', True)
+  job = event.get('job')
+  shard = event.get('shard', 0)
+  progress = event.get('progress', {"listed": 0, "skipped": 0, "invoked": 0, "lookups": 0})
+  index_key = event.get('index')
+  if index_key is None and event.get('skip_index', True):
+    index_key = build_index(s3_client, bucket, event, job or uuid.uuid4().hex[:12])
+  index = skip_index.load(s3_client, bucket, index_key, path) if index_key else None
+  functions = [os.environ.get(name) for name in ('high_resource_lambda_name', 'low_resource_lambda_name')]
+  invoker = dispatcher.Dispatcher(client, event.get('shards_total', 1), event.get('dispatch'), [name for name in functions if name])
   script_path = str(pathlib.Path(__file__).parent.resolve())
   formats = read_yaml(f"{script_path}/file_formats.yml")
   in_progress = False
 
-  response1 = client.get_function_configuration(FunctionName=os.environ['high_resource_lambda_name'])
-  response2 = client.get_function_configuration(FunctionName=os.environ['low_resource_lambda_name'])
-  if int(response1['MemorySize']) > int(response2['MemorySize']):
-    video_lambda = os.environ['high_resource_lambda_name']
-    image_lambda = os.environ['low_resource_lambda_name']
-  else:
-    video_lambda = os.environ['low_resource_lambda_name']
-    image_lambda = os.environ['high_resource_lambda_name']
-  
-
-  for my_bucket_object in my_bucket.objects.filter(Prefix=path, Marker=last_item):
-    if context.get_remaining_time_in_millis() < MINIMUM_REMAINING_TIME_MS:
-      in_progress = True
-      break
-    last_item = my_bucket_object.key
-    if my_bucket_object.last_modified.replace(tzinfo = None) > start_datetime:
-      print("Too recent file, skipped: ", my_bucket_object.key)
-      continue
-    if any(word in my_bucket_object.key for word in skip_words):
-      print("Skipped: ", my_bucket_object.key)
-      continue
-    tags = s3_client.get_object_tagging(
-      Bucket=bucket,
-      Key=my_bucket_object.key
-    )
-    print(my_bucket_object)
-    print(f"tags: {tags['TagSet']}")
-    file_name = os.path.basename(my_bucket_object.key)
-    is_video = file_name.lower().endswith(tuple(formats['video']))
-    is_image = file_name.lower().endswith(tuple(formats['image']))
-    if check_preview_tag(tags["TagSet"]) or (not is_video and not is_image):
-      print("Skipped: ", my_bucket_object.key)
-      continue
-    item = s3.Object(bucket, my_bucket_object.key)
-    print(item.content_length)
-    new_event = {
-      "Records": [{
-        "s3":{
-          "bucket":{
-            "name": bucket
-          },
-          "object":{
-            "key": my_bucket_object.key,
-            "size": item.content_length
+  def get_tags(key):
+    return s3_client.get_object_tagging(Bucket=bucket, Key=key)["TagSet"]
+
+  listing = {"Bucket": bucket, "Prefix": path, "PaginationConfig": {"PageSize": page_size}}
+  if last_item:
+    listing["StartAfter"] = last_item
+  if not recursive:
+    listing["Delimiter"] = "/"
+  with ThreadPoolExecutor(max_workers=tag_workers) as executor:
+    for page in s3_client.get_paginator("list_objects_v2").paginate(**listing):
+      if context.get_remaining_time_in_millis() < MINIMUM_REMAINING_TIME_MS:
+        in_progress = True
+        break
+      decisions = []
+      for item in page.get("Contents", []):
+        kind = routing.category(os.path.basename(item["Key"]), formats)
+        if item["LastModified"].replace(tzinfo = None) > start_datetime:
+          print("Too recent file, skipped: ", item["Key"])
+          action = "skip"
+        elif any(word in item["Key"] for word in skip_words) or kind is None:
+          print("Skipped: ", item["Key"])
+          action = "skip"
+        elif index is None:
+          action = "tags"
+        else:
+          action = {"missing": "invoke", "ambiguous": "tags", "done": "skip"}[skip_index.lookup(index, item["Key"], item["LastModified"].timestamp())]
+        decisions.append([item, action])
+      # Tags are only looked up when there is no index or it can't tell, the size already comes with the listing
+      lookups = [decision for decision in decisions if decision[1] == "tags"]
+      progress["lookups"] += len(lookups)
+      for decision, tags in zip(lookups, executor.map(get_tags, [decision[0]["Key"] for decision in lookups])):
+        decision[1] = "skip" if check_preview_tag(tags) else "invoke"
+      # Handled in key order, so the marker is a cursor: everything up to it was skipped or dispatched
+      for item, action in decisions:
+        if action == "invoke":
+          new_event = {
+            "Records": [{
+              "s3":{
+                "bucket":{
+                  "name": bucket
+                },
+                "object":{
+                  "key": item["Key"],
+                  "size": item["Size"]
+                }
+              }
+            }]
           }
-        }
-      }]
-    }
-    if is_video:
-      invoke_lambda(video_lambda, new_event)
-      print(f"Invoked video lambda with: {my_bucket_object.key}")
-    else:
-      print(f"Invoked image lambda with: {my_bucket_object.key}")
-      invoke_lambda(image_lambda, new_event)
-    print("=====================")
-    
+          kind, level, target = routing.route(client, os.path.basename(item["Key"]), item["Size"], formats)
+          budget = (context.get_remaining_time_in_millis() - MINIMUM_REMAINING_TIME_MS) / 1000
+          if not invoker.dispatch(target, level, new_event, budget):
+            in_progress = True
+            break
+          progress["invoked"] += 1
+          print(f"Invoked {kind} lambda ({target}) with: {item['Key']}")
+        else:
+          progress["skipped"] += 1
+        progress["listed"] += 1
+        last_item = item["Key"]
+      if job:
+        write_progress(s3_client, bucket, job, shard, dict(progress, path=path, marker=last_item, done=False, throttles=invoker.throttles))
+      if in_progress:
+        break
+
+  print(f"Shard {shard} of {path}: {progress}")
   if in_progress:
     print("Timeout approaching and the task is still pending, calling another lambda to finish the job")
     new_event = {
       "bucket": bucket,
       "start_time": start_datetime.isoformat(),
       "marker": last_item,
-      "path": path
+      "path": path,
+      "recursive": recursive,
+      "progress": progress,
+      "index": index_key,
+      "skip_index": index_key is not None,
+      "shards_total": event.get('shards_total', 1),
+      "dispatch": invoker.state()
     }
+    if job:
+      new_event.update({"job": job, "shard": shard})
     invoke_lambda(context.function_name, new_event)
+  elif job:
+    write_progress(s3_client, bucket, job, shard, dict(progress, path=path, marker=last_item, done=True, throttles=invoker.throttles))
   return {
     'statusCode': 200,
     'body': json.dumps('Hello from Lambda!')
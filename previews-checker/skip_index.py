@@ -0,0 +1,107 @@
+import csv
+import gzip
+import io
+import json
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import parser
+
+preview_prefix = "previews/"
+marker_suffix = ".asp-location"
+# Preview folders are named after a uuid4, so the first hex digit splits the listing 16 ways
+uuid_digits = "0123456789abcdef"
+
+def marker_source(key):
+  # previews/{uuid}.asp-preview/{source key}.asp-location, None for any other object
+  if not key.startswith(preview_prefix) or not key.endswith(marker_suffix) or ".asp-preview/" not in key:
+    return None
+  return key.split(".asp-preview/", 1)[1][:-len(marker_suffix)]
+
+def add_marker(index, key, last_modified):
+  # Keeps the newest marker when a source was previewed more than once
+  source = marker_source(key)
+  if source is not None and last_modified > index.get(source, 0):
+    index[source] = last_modified
+
+def list_markers(s3_client, bucket):
+  """Build the index from the .asp-location markers with one listing pass over previews/
+
+  :param s3_client: S3 client
+  :param bucket: Bucket the previews are in
+  :return: Dict of source key to the time of its newest marker, in seconds since the epoch
+  """
+  def list_part(digit):
+    part = {}
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=f"{preview_prefix}{digit}"):
+      for item in page.get("Contents", []):
+        add_marker(part, item["Key"], item["LastModified"].timestamp())
+    return part
+
+  index = {}
+  with ThreadPoolExecutor(max_workers=len(uuid_digits)) as executor:
+    for part in executor.map(list_part, uuid_digits):
+      for source, last_modified in part.items():
+        if last_modified > index.get(source, 0):
+          index[source] = last_modified
+  return index
+
+def split_s3_url(url):
+  bucket, _, key = url[len("s3://"):].partition("/")
+  return bucket, key
+
+def inventory_markers(s3_client, manifest_url):
+  """Build the index from an S3 Inventory report instead of listing previews/
+
+  Only CSV reports are read, the checker image doesn't ship a Parquet or ORC reader.
+
+  :param s3_client: S3 client
+  :param manifest_url: s3:// URL of the manifest.json of the report
+  :return: Same as list_markers()
+  """
+  manifest_bucket, manifest_key = split_s3_url(manifest_url)
+  manifest = json.loads(s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)["Body"].read())
+  if manifest.get("fileFormat", "CSV").upper() != "CSV":
+    raise Exception(f"Unsupported inventory format {manifest['fileFormat']}, only CSV can be read")
+  fields = [field.strip() for field in manifest["fileSchema"].split(",")]
+  key_field = fields.index("Key")
+  modified_field = fields.index("LastModifiedDate")
+
+  def read_file(entry):
+    part = {}
+    body = s3_client.get_object(Bucket=manifest["destinationBucket"].split(":::")[-1], Key=entry["key"])["Body"].read()
+    for row in csv.reader(io.StringIO(gzip.decompress(body).decode("utf-8"))):
+      # Inventory reports URL-encode the keys
+      key = urllib.parse.unquote_plus(row[key_field])
+      if key.endswith(marker_suffix):
+        add_marker(part, key, parser.parse(row[modified_field]).timestamp())
+    return part
+
+  index = {}
+  with ThreadPoolExecutor(max_workers=len(uuid_digits)) as executor:
+    for part in executor.map(read_file, manifest["files"]):
+      for source, last_modified in part.items():
+        if last_modified > index.get(source, 0):
+          index[source] = last_modified
+  return index
+
+def save(s3_client, bucket, key, index):
+  s3_client.put_object(Bucket=bucket, Key=key, Body=gzip.compress(json.dumps(index).encode()))
+
+def load(s3_client, bucket, key, path=""):
+  # Shards only keep the sources under their own path
+  index = json.loads(gzip.decompress(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()))
+  return {source: last_modified for source, last_modified in index.items() if source.startswith(path)}
+
+def lookup(index, key, last_modified):
+  """Decide from the index whether an object still needs a preview
+
+  :param index: Result of list_markers() or inventory_markers()
+  :param key: Source object key
+  :param last_modified: Time the source was last written, in seconds since the epoch
+  :return: "done" when a marker is newer than the source, "missing" when there is no marker, and
+    "ambiguous" when the source was written again after its newest marker, the tags decide then
+  """
+  marked = index.get(key)
+  if marked is None:
+    return "missing"
+  return "done" if marked >= last_modified else "ambiguous"
@@ -0,0 +1,59 @@
+import io
+from datetime import datetime, timezone
+
+old_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+class Paginator:
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None, StartAfter="", PaginationConfig=None):
+        # Same order and grouping as list_objects_v2, a common prefix is returned once where its first key would be
+        self.s3.listings.append({"Prefix": Prefix, "Delimiter": Delimiter, "StartAfter": StartAfter})
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+        entries = []
+        for key in sorted(self.s3.objects):
+            if not key.startswith(Prefix) or key <= StartAfter:
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if not entries or entries[-1] != ("prefix", prefix):
+                    entries.append(("prefix", prefix))
+            else:
+                entries.append(("key", key))
+        for start in range(0, len(entries), page_size):
+            page = {"Contents": [], "CommonPrefixes": []}
+            for kind, name in entries[start:start + page_size]:
+                if kind == "prefix":
+                    page["CommonPrefixes"].append({"Prefix": name})
+                else:
+                    body, last_modified = self.s3.objects[name]
+                    page["Contents"].append({"Key": name, "Size": len(body), "LastModified": last_modified})
+            yield page
+
+class FakeS3:
+    """In memory bucket with the S3 calls the checker makes"""
+
+    def __init__(self, keys=()):
+        self.objects = {}
+        self.tags = {}
+        self.listings = []
+        for key in keys:
+            self.add(key)
+
+    def add(self, key, body=b"x", last_modified=old_date):
+        self.objects[key] = (body, last_modified)
+
+    def get_paginator(self, name):
+        return Paginator(self)
+
+    def put_object(self, Bucket, Key, Body):
+        self.add(Key, Body, datetime.now(timezone.utc))
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key][0])}
+
+    def get_object_tagging(self, Bucket, Key):
+        return {"TagSet": self.tags.get(Key, [])}
@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+import dispatcher
+
+class FakeLambda:
+    """Lambda client that answers the first throttled invocations with TooManyRequestsException"""
+
+    def __init__(self, reserved=None, unreserved=1000, throttled=0):
+        self.reserved = reserved or {}
+        self.unreserved = unreserved
+        self.throttled = throttled
+        self.invoked = []
+        self.attempts = 0
+
+    def get_function_concurrency(self, FunctionName):
+        if FunctionName in self.reserved:
+            return {"ReservedConcurrentExecutions": self.reserved[FunctionName]}
+        return {}
+
+    def get_account_settings(self):
+        return {"AccountLimit": {"UnreservedConcurrentExecutions": self.unreserved}}
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.attempts += 1
+        if self.attempts <= self.throttled:
+            raise ClientError({"Error": {"Code": "TooManyRequestsException", "Message": "Rate exceeded"}}, "Invoke")
+        self.invoked.append(FunctionName)
+
+
+@patch('dispatcher.time.sleep')
+@patch('dispatcher.target_concurrency', 100)
+@patch('dispatcher.live_share', 0.3)
+@patch.dict('dispatcher.tier_seconds', {"high": 60, "low": 10})
+class DispatcherTest(unittest.TestCase):
+
+    # Both functions without a reservation share the unreserved pool instead of each counting all of it
+    def test_unreserved_pool_split(self, sleep_mock):
+        invoker = dispatcher.Dispatcher(FakeLambda(unreserved=100), functions=["high", "low"])
+        self.assertEqual(invoker.concurrency_limit("high"), 35)
+        self.assertEqual(invoker.concurrency_limit("low"), 35)
+        invoker = dispatcher.Dispatcher(FakeLambda(reserved={"high": 50}, unreserved=100), functions=["high", "low"])
+        self.assertEqual(invoker.concurrency_limit("high"), 35)
+        self.assertEqual(invoker.concurrency_limit("low"), 70)
+
+    def test_shards_split_rate(self, sleep_mock):
+        invoker = dispatcher.Dispatcher(FakeLambda(), shards=4)
+        invoker.bucket("low", "low")
+        self.assertEqual(invoker.targets["low"], 25 / 10)
+
+    # A throttle halves the rate and the request is retried, it's only sent once
+    def test_throttle_backoff(self, sleep_mock):
+        client = FakeLambda(throttled=2)
+        invoker = dispatcher.Dispatcher(client)
+        self.assertTrue(invoker.dispatch("low", "low", {}, 60))
+        self.assertEqual(client.invoked, ["low"])
+        self.assertEqual(invoker.throttles, 2)
+        target = invoker.targets["low"]
+        self.assertAlmostEqual(invoker.rates["low"], target * 0.25 + target * dispatcher.recovery_step)
+
+    def test_recovery(self, sleep_mock):
+        invoker = dispatcher.Dispatcher(FakeLambda(), state={"rates": {"low": 1.0}, "throttles": 3})
+        target = 100 / 10
+        for _ in range(5):
+            self.assertTrue(invoker.dispatch("low", "low", {}, 60))
+        self.assertAlmostEqual(invoker.rates["low"], 1.0 + 5 * target * dispatcher.recovery_step)
+        for _ in range(40):
+            invoker.dispatch("low", "low", {}, 60)
+        # Never above the target
+        self.assertEqual(invoker.rates["low"], target)
+
+    # Waiting for a token past the budget leaves the request for the next checker
+    def test_budget_cutoff(self, sleep_mock):
+        client = FakeLambda()
+        invoker = dispatcher.Dispatcher(client, state={"rates": {"high": 0.01}})
+        invoker.bucket("high", "high").tokens = 0
+        self.assertFalse(invoker.dispatch("high", "high", {}, 1))
+        self.assertEqual(client.invoked, [])
+        sleep_mock.assert_not_called()
+
+    def test_retries_exhausted(self, sleep_mock):
+        client = FakeLambda(throttled=100)
+        with self.assertRaises(ClientError):
+            dispatcher.Dispatcher(client).dispatch("low", "low", {}, 600)
+        self.assertEqual(client.attempts, dispatcher.max_retries + 1)
+
+    def test_other_errors_raised(self, sleep_mock):
+        class FailingLambda(FakeLambda):
+            def invoke(self, **kwargs):
+                raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "Not found"}}, "Invoke")
+        with self.assertRaises(ClientError):
+            dispatcher.Dispatcher(FailingLambda()).dispatch("low", "low", {}, 60)
+
+    # The rates learned before a continuation are where the next checker starts
+    def test_state_round_trip(self, sleep_mock):
+        invoker = dispatcher.Dispatcher(FakeLambda(throttled=1))
+        invoker.dispatch("low", "low", {}, 60)
+        resumed = dispatcher.Dispatcher(FakeLambda(), state=invoker.state())
+        self.assertEqual(resumed.bucket("low", "low").rate, invoker.rates["low"])
+        self.assertEqual(resumed.throttles, 1)
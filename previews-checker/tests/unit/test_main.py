@@ -0,0 +1,153 @@
+import unittest
+import json
+from unittest import mock
+from unittest.mock import patch
+
+from tests.unit.s3_stub import FakeS3
+
+# Setting the default AWS region environment variable required by the Python SDK boto3
+with mock.patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-west-2'}):
+    import main__
+
+class FakeContext:
+    function_name = "checker"
+
+    def get_remaining_time_in_millis(self):
+        return 600000
+
+class FakeDispatcher:
+    # Accepts the first limit requests, then reports that the budget ran out
+    limit = None
+
+    def __init__(self, client, shards=1, state=None, functions=()):
+        self.invoked = []
+        self.throttles = 0
+
+    def dispatch(self, name, tier, request, budget):
+        if self.limit is not None and len(self.invoked) >= self.limit:
+            return False
+        self.invoked.append(request["Records"][0]["s3"]["object"]["key"])
+        return True
+
+    def state(self):
+        return {}
+
+def listed_keys(s3, shards):
+    # Lists every shard the way main() does and returns all the keys seen
+    keys = []
+    for shard in shards:
+        listing = {"Bucket": "bucket", "Prefix": shard["path"]}
+        if not shard["recursive"]:
+            listing["Delimiter"] = "/"
+        for page in s3.get_paginator("list_objects_v2").paginate(**listing):
+            keys += [item["Key"] for item in page["Contents"]]
+    return keys
+
+
+class DiscoverShardsTest(unittest.TestCase):
+
+    keys = ["top.jpg", "a/1.jpg", "a/x/2.jpg", "a/y/3.jpg", "a/y/z/4.jpg", "b/5.jpg", "previews/abc.asp-preview/top.jpg.asp-location"]
+
+    # The objects directly in a split folder stay in a non-recursive shard, so every key is listed exactly once
+    def test_split_parent(self):
+        s3 = FakeS3(self.keys)
+        shards = main__.discover_shards(s3, "bucket", "", 4)
+        self.assertIn({"path": "", "recursive": False}, shards)
+        self.assertIn({"path": "a/", "recursive": False}, shards)
+        self.assertIn({"path": "a/x/", "recursive": True}, shards)
+        self.assertNotIn("previews/", [shard["path"] for shard in shards])
+        self.assertEqual(sorted(listed_keys(s3, shards)), sorted(key for key in self.keys if not key.startswith("previews/")))
+
+    @patch('main__.max_shards', 3)
+    def test_max_shards(self):
+        s3 = FakeS3(self.keys)
+        shards = main__.discover_shards(s3, "bucket", "", 64)
+        self.assertLessEqual(len(shards), 3)
+        self.assertEqual(len(listed_keys(s3, shards)), 6)
+
+    # "a" also matches "ab/" and "a.jpg", the non-recursive shard keeps the objects next to the folders
+    def test_prefix_without_slash(self):
+        s3 = FakeS3(["a.jpg", "a/1.jpg", "a/x/2.jpg", "ab/3.jpg", "b/4.jpg"])
+        shards = main__.discover_shards(s3, "bucket", "a", 3)
+        self.assertEqual(shards, [{"path": "a", "recursive": False}, {"path": "a/", "recursive": True}, {"path": "ab/", "recursive": True}])
+        self.assertEqual(sorted(listed_keys(s3, shards)), ["a.jpg", "a/1.jpg", "a/x/2.jpg", "ab/3.jpg"])
+
+    def test_nothing_to_split(self):
+        s3 = FakeS3(["a/1.jpg", "a/2.jpg"])
+        self.assertEqual(main__.discover_shards(s3, "bucket", "a/", 8), [{"path": "a/", "recursive": True}])
+
+
+class FanOutTest(unittest.TestCase):
+
+    @patch('main__.invoke_lambda')
+    def test_fan_out(self, invoke_mock):
+        s3 = FakeS3(DiscoverShardsTest.keys)
+        event = {"bucket": "bucket", "path": "", "shards": 4, "skip_index": False, "start_time": "2021-01-01T00:00:00"}
+        job, shards = main__.fan_out(s3, event, FakeContext())
+        self.assertEqual(invoke_mock.call_count, shards)
+        events = [call[0][1] for call in invoke_mock.call_args_list]
+        self.assertEqual([shard_event["shard"] for shard_event in events], list(range(shards)))
+        self.assertEqual({call[0][0] for call in invoke_mock.call_args_list}, {"checker"})
+        for shard_event in events:
+            self.assertEqual((shard_event["job"], shard_event["shards_total"]), (job, shards))
+            self.assertEqual(shard_event["start_time"], "2021-01-01T00:00:00")
+            self.assertIsNone(shard_event["index"])
+        manifest = json.loads(s3.get_object(Bucket="bucket", Key=main__.progress_key(job, "job"))["Body"].read())
+        self.assertEqual(manifest["shards"], shards)
+
+
+class ReportTest(unittest.TestCase):
+
+    def test_report(self):
+        s3 = FakeS3()
+        s3.put_object(Bucket="bucket", Key=main__.progress_key("job1", "job"), Body=json.dumps({"path": "a/", "shards": 3}).encode())
+        main__.write_progress(s3, "bucket", "job1", 0, {"listed": 10, "skipped": 4, "invoked": 6, "lookups": 2, "throttles": 1, "done": True})
+        main__.write_progress(s3, "bucket", "job1", 1, {"listed": 5, "skipped": 5, "invoked": 0, "lookups": 0, "done": False})
+        # Progress of another job isn't counted
+        main__.write_progress(s3, "bucket", "job2", 0, {"listed": 100, "done": True})
+        progress = main__.report(s3, "bucket", "job1")
+        self.assertEqual(progress, {"listed": 15, "skipped": 9, "invoked": 6, "lookups": 2, "throttles": 1,
+            "job": "job1", "path": "a/", "shards": 3, "shards_done": 1})
+
+
+@patch('main__.routing.route', return_value=("image", "low", "low-function"))
+@patch('main__.page_size', 3)
+class ContinuationTest(unittest.TestCase):
+
+    keys = [f"photos/{index:02}.jpg" for index in range(8)]
+
+    def run_checker(self, s3, event):
+        dispatchers = []
+        def create_dispatcher(*args):
+            dispatchers.append(FakeDispatcher(*args))
+            return dispatchers[-1]
+        with patch('main__.boto3.client', return_value=s3), \
+            patch('main__.dispatcher.Dispatcher', side_effect=create_dispatcher), \
+            patch('main__.invoke_lambda') as invoke_mock:
+            main__.main(event, FakeContext())
+        continuation = invoke_mock.call_args[0][1] if invoke_mock.called else None
+        return dispatchers[0].invoked, continuation
+
+    # A stop in the middle of a page resumes right after the last dispatched key, nothing is skipped or sent twice
+    def test_resume_after_mid_page_stop(self, route_mock):
+        s3 = FakeS3(self.keys)
+        s3.tags["photos/01.jpg"] = [{"Key": "previews", "Value": "true"}]
+        event = {"bucket": "bucket", "path": "photos/", "skip_index": False, "start_time": "2021-01-01T00:00:00"}
+        with patch.object(FakeDispatcher, "limit", 3):
+            invoked, continuation = self.run_checker(s3, event)
+        self.assertEqual(invoked, ["photos/00.jpg", "photos/02.jpg", "photos/03.jpg"])
+        self.assertEqual(continuation["marker"], "photos/03.jpg")
+        self.assertEqual(continuation["progress"]["invoked"], 3)
+        self.assertEqual(continuation["progress"]["skipped"], 1)
+
+        resumed, finished = self.run_checker(s3, continuation)
+        self.assertEqual(s3.listings[-1]["StartAfter"], "photos/03.jpg")
+        self.assertEqual(resumed, self.keys[4:])
+        self.assertIsNone(finished)
+
+    def test_done_without_continuation(self, route_mock):
+        s3 = FakeS3(self.keys)
+        event = {"bucket": "bucket", "path": "photos/", "skip_index": False, "start_time": "2021-01-01T00:00:00"}
+        invoked, continuation = self.run_checker(s3, event)
+        self.assertEqual(invoked, self.keys)
+        self.assertIsNone(continuation)
@@ -0,0 +1,76 @@
+import unittest
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timezone
+
+from tests.unit.s3_stub import FakeS3
+import skip_index
+
+def marker(source, folder="0123abcd"):
+    return f"previews/{folder}.asp-preview/{source}.asp-location"
+
+def inventory_file(rows):
+    output = io.StringIO()
+    csv.writer(output, quoting=csv.QUOTE_ALL).writerows(rows)
+    return gzip.compress(output.getvalue().encode("utf-8"))
+
+
+class SkipIndexTest(unittest.TestCase):
+
+    def test_marker_source(self):
+        self.assertEqual(skip_index.marker_source(marker("photos/a b.jpg")), "photos/a b.jpg")
+        # The source key can hold .asp-preview/ too, only the first one is the preview folder
+        self.assertEqual(skip_index.marker_source(marker("x.asp-preview/a.jpg")), "x.asp-preview/a.jpg")
+        self.assertIsNone(skip_index.marker_source("previews/0123abcd.asp-preview/preview.mp4"))
+        self.assertIsNone(skip_index.marker_source("photos/a.jpg.asp-location"))
+
+    def test_lookup(self):
+        index = {"photos/a.jpg": 200.0}
+        self.assertEqual(skip_index.lookup(index, "photos/a.jpg", 100.0), "done")
+        self.assertEqual(skip_index.lookup(index, "photos/a.jpg", 200.0), "done")
+        # Written again after it was previewed, only the tags can tell
+        self.assertEqual(skip_index.lookup(index, "photos/a.jpg", 300.0), "ambiguous")
+        self.assertEqual(skip_index.lookup(index, "photos/b.jpg", 100.0), "missing")
+
+    def test_list_markers(self):
+        s3 = FakeS3()
+        s3.add(marker("a.jpg", "0aaa"), last_modified=datetime(2021, 1, 1, tzinfo=timezone.utc))
+        s3.add(marker("a.jpg", "fbbb"), last_modified=datetime(2022, 1, 1, tzinfo=timezone.utc))
+        s3.add("previews/0aaa.asp-preview/preview.mp4")
+        s3.add("a.jpg")
+        self.assertEqual(skip_index.list_markers(s3, "bucket"), {"a.jpg": datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp()})
+
+    def test_save_and_load(self):
+        s3 = FakeS3()
+        skip_index.save(s3, "bucket", "index.json.gz", {"photos/a.jpg": 1.0, "photos/b.jpg": 2.0, "videos/c.mp4": 3.0})
+        self.assertEqual(len(skip_index.load(s3, "bucket", "index.json.gz")), 3)
+        # A shard only keeps the sources under its path
+        self.assertEqual(skip_index.load(s3, "bucket", "index.json.gz", path="photos/"), {"photos/a.jpg": 1.0, "photos/b.jpg": 2.0})
+
+    def test_inventory_markers(self):
+        s3 = FakeS3()
+        s3.add("inventory/data/part-0.csv.gz", inventory_file([
+            ["bucket", "previews/0aaa.asp-preview/photos/a+b%2Bc.jpg.asp-location", "12", "2021-01-01T00:00:00.000Z"],
+            ["bucket", "previews/0aaa.asp-preview/preview.mp4", "1000", "2021-01-01T00:00:00.000Z"],
+            ["bucket", "photos/a b+c.jpg", "1000", "2020-01-01T00:00:00.000Z"]
+        ]))
+        s3.add("inventory/data/part-1.csv.gz", inventory_file([
+            ["bucket", "previews/fbbb.asp-preview/photos/a+b%2Bc.jpg.asp-location", "12", "2022-01-01T00:00:00.000Z"]
+        ]))
+        s3.add("inventory/manifest.json", json.dumps({
+            "destinationBucket": "arn:aws:s3:::inventory-bucket",
+            "fileFormat": "CSV",
+            "fileSchema": "Bucket, Key, Size, LastModifiedDate",
+            "files": [{"key": "inventory/data/part-0.csv.gz"}, {"key": "inventory/data/part-1.csv.gz"}]
+        }).encode())
+        index = skip_index.inventory_markers(s3, "s3://inventory-bucket/inventory/manifest.json")
+        # The keys are URL-encoded in the report and the newest marker wins
+        self.assertEqual(index, {"photos/a b+c.jpg": datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp()})
+
+    def test_inventory_format(self):
+        s3 = FakeS3()
+        s3.add("manifest.json", json.dumps({"fileFormat": "Parquet", "fileSchema": "", "files": []}).encode())
+        with self.assertRaises(Exception):
+            skip_index.inventory_markers(s3, "s3://inventory-bucket/manifest.json")
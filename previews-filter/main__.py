@@ -5,7 +5,10 @@ import pathlib
 import urllib.parse
 import os
 
+import routing
+
 client = boto3.client('lambda')
+formats = None # Parsed once per container, warm invocations reuse it
 
 def read_yaml(file):
   with open(file, "r") as stream:
@@ -15,6 +18,13 @@ def read_yaml(file):
       print(exc)
       raise exc
 
+def get_formats():
+  global formats
+  if formats is None:
+    script_path = str(pathlib.Path(__file__).parent.resolve())
+    formats = read_yaml(f"{script_path}/file_formats.yml")
+  return formats
+
 def invoke_lambda(name, request):
   client.invoke(
     FunctionName=name,
@@ -51,42 +61,43 @@ def remove_tags(s3, bucket, key):
 
 def main(event, context):
   print(event)
-  key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-  event_type = event["Records"][0]["eventName"]
-  if "ObjectRemoved" in event_type:
-    s3 = boto3.client("s3")
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    source_file_name = get_original_file(key)
-    remove_tags(s3, bucket, source_file_name)
-  else:
+  formats = get_formats()
+  s3 = None
+  groups = {}
+  ignored = []
+  unsupported = []
+  for record in event["Records"]:
+    key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+    if "ObjectRemoved" in record["eventName"]:
+      s3 = s3 or boto3.client("s3")
+      source_file_name = get_original_file(key)
+      remove_tags(s3, record["s3"]["bucket"]["name"], source_file_name)
+      continue
     if "previews" in key:
-      print("Stopping lambda: Preview files are ignored")
-      return {
-        "statusCode": 200,
-        "body": json.dumps("Stopping lambda: Preview files are ignored")
-      }
-    script_path = str(pathlib.Path(__file__).parent.resolve())
-    formats = read_yaml(f"{script_path}/file_formats.yml")
-    is_video = key.lower().endswith(tuple(formats["video"]))
-    is_image = key.lower().endswith(tuple(formats["image"]))
-    if not is_video and not is_image:
-      raise Exception("File extension not supported")
-
-    response1 = client.get_function_configuration(FunctionName=os.environ['high_resource_lambda_name'])
-    response2 = client.get_function_configuration(FunctionName=os.environ['low_resource_lambda_name'])
-    if int(response1['MemorySize']) > int(response2['MemorySize']):
-      video_lambda = os.environ['high_resource_lambda_name']
-      image_lambda = os.environ['low_resource_lambda_name']
-    else:
-      video_lambda = os.environ['low_resource_lambda_name']
-      image_lambda = os.environ['high_resource_lambda_name']
+      print(f"Preview file ignored: {key}")
+      ignored.append(key)
+      continue
+    size = record["s3"]["object"].get("size")
+    kind, level, target = routing.route(client, key, size, formats)
+    if kind is None:
+      print(f"File extension not supported: {key}")
+      unsupported.append(key)
+      continue
+    groups.setdefault((target, level), []).append(record)
 
-    if is_video:
-      invoke_lambda(video_lambda, event)
-      print(f"Invoked previews video with file: {key}")
-    else:
-      invoke_lambda(image_lambda, event)
-      print(f"Invoked previews image with file: {key}")
+  # One invocation per target function and batch instead of one per record
+  for (target, level), records in groups.items():
+    for batch in routing.batches(records, level):
+      invoke_lambda(target, {"Records": batch})
+      print(f"Invoked previews ({target}) with {len(batch)} files: {[record['s3']['object']['key'] for record in batch]}")
+  if unsupported and not groups:
+    raise Exception("File extension not supported")
+  if ignored and len(ignored) == len(event["Records"]):
+    print("Stopping lambda: Preview files are ignored")
+    return {
+      "statusCode": 200,
+      "body": json.dumps("Stopping lambda: Preview files are ignored")
+    }
   return {
     "statusCode": 200,
     "body": json.dumps('Hello from Lambda!')
@@ -0,0 +1,81 @@
+import os
+import time
+
+# Same module in previews-filter and previews-checker, keep both copies in sync like file_formats.yml
+config_ttl = int(os.environ.get("routing_config_ttl", 300)) # Seconds the function memory sizes are trusted
+small_video_size = int(os.environ.get("routing_small_video_mb", 20)) << 20
+large_image_size = int(os.environ.get("routing_large_image_mb", 100)) << 20
+large_pdf_size = int(os.environ.get("routing_large_pdf_mb", 50)) << 20
+batch_size = int(os.environ.get("routing_batch_size", 10)) # Low tier records sent in one invocation
+# Decoded at full size by ImageMagick, so they need the high tier sooner than compressed images
+heavy_image_extensions = (".tif", ".tiff", ".psd", ".psb")
+tiers = {"high": None, "low": None, "expires": 0}
+
+def resolve_tiers(client, high_name, low_name):
+  """Find out which preview function has more memory, cached for the lifetime of the container
+
+  Only deploys change it, so get_function_configuration is called at most once per config_ttl
+  instead of twice per upload. When the calls fail, for example when they are throttled during
+  a burst, the last known answer is kept, or the names are trusted as given.
+
+  :param client: Lambda client
+  :param high_name: Function meant to have more resources
+  :param low_name: Function meant to have fewer resources
+  :return: (high tier function, low tier function)
+  """
+  now = time.time()
+  if tiers["high"] and tiers["expires"] > now and {tiers["high"], tiers["low"]} == {high_name, low_name}:
+    return tiers["high"], tiers["low"]
+  try:
+    high_memory = int(client.get_function_configuration(FunctionName=high_name)["MemorySize"])
+    low_memory = int(client.get_function_configuration(FunctionName=low_name)["MemorySize"])
+  except Exception as e:
+    print("Unable to read the function configurations", e)
+    if tiers["high"] and {tiers["high"], tiers["low"]} == {high_name, low_name}:
+      return tiers["high"], tiers["low"]
+    return high_name, low_name
+  if low_memory > high_memory:
+    high_name, low_name = low_name, high_name
+  tiers.update({"high": high_name, "low": low_name, "expires": now + config_ttl})
+  return high_name, low_name
+
+def category(key, formats):
+  # PDFs are checked first since older file_formats.yml files list them under image too
+  name = key.lower()
+  for kind in ("pdf", "video", "image"):
+    if name.endswith(tuple(formats.get(kind) or ())):
+      return kind
+  return None
+
+def tier(kind, key, size):
+  """Estimate which tier a file needs from its category, extension and size
+
+  :param kind: Result of category()
+  :param key: Object key, for the extension
+  :param size: Object size in bytes from the event, None when unknown
+  :return: "high" or "low"
+  """
+  if size is None:
+    return "high" if kind == "video" else "low"
+  if kind == "video":
+    return "low" if size < small_video_size else "high"
+  if kind == "pdf":
+    return "high" if size >= large_pdf_size else "low"
+  threshold = large_image_size // 4 if key.lower().endswith(heavy_image_extensions) else large_image_size
+  return "high" if size >= threshold else "low"
+
+def route(client, key, size, formats):
+  # Returns the category, tier and function name for the object, all None when it isn't supported
+  kind = category(key, formats)
+  if kind is None:
+    return None, None, None
+  high, low = resolve_tiers(client, os.environ['high_resource_lambda_name'], os.environ['low_resource_lambda_name'])
+  level = tier(kind, key, size)
+  return kind, level, high if level == "high" else low
+
+def batches(records, level):
+  # Small objects are coalesced so a flood of uploads doesn't pay one invocation each,
+  # high tier objects take long enough that they get an invocation of their own
+  size = batch_size if level == "low" else 1
+  for start in range(0, len(records), size):
+    yield records[start:start + size]
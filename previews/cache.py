@@ -0,0 +1,57 @@
+import hashlib
+import json
+
+cache_version = 2 # Bump when the pipeline changes what it makes out of the same settings
+cache_prefix = "previews/cache"
+# Full object checksums S3 can return, in order of preference
+checksum_fields = ("ChecksumSHA256", "ChecksumSHA1", "ChecksumCRC64NVME", "ChecksumCRC32C", "ChecksumCRC32")
+
+def is_multipart_etag(etag):
+  # Multipart ETags are the MD5 of the part MD5s plus "-<parts>", so the same bytes uploaded with another part size differ
+  return "-" in etag.strip('"')
+
+def object_checksum(head):
+  # A full object checksum from head_object(ChecksumMode="ENABLED"), composite ones depend on the parts like the ETag
+  if head.get("ChecksumType", "FULL_OBJECT") != "FULL_OBJECT":
+    return None
+  for field in checksum_fields:
+    if head.get(field):
+      return f"{field}:{head[field]}"
+  return None
+
+def content_identity(etag, size, checksum=None):
+  """Identify the content of an object without reading it
+
+  :param etag: ETag from the notification, with or without quotes
+  :param size: Size of the object in bytes
+  :param checksum: Full object checksum, preferred over multipart ETags
+  :return: String identifying the bytes of the object, None when there is nothing to go by
+  """
+  if checksum:
+    return f"{checksum}:{size}"
+  if not etag:
+    return None
+  return f"etag:{etag.strip(chr(34))}:{size}"
+
+def index_key(identity, settings):
+  # Same content rendered with the same settings gives the same previews
+  fingerprint = json.dumps({"identity": identity, "settings": settings, "version": cache_version}, sort_keys=True)
+  return f"{cache_prefix}/{hashlib.sha256(fingerprint.encode()).hexdigest()}.json"
+
+def index_entry(preview_path, object_names, source):
+  # Object names are relative to the preview prefix so they can be copied under a new one
+  prefix = f"{preview_path}/"
+  return json.dumps({
+    "preview_path": preview_path,
+    "objects": [name[len(prefix):] for name in object_names if name.startswith(prefix)],
+    "source": source
+  }).encode()
+
+def parse_entry(body):
+  try:
+    entry = json.loads(body)
+  except ValueError:
+    return None
+  if not isinstance(entry, dict) or not entry.get("preview_path") or not entry.get("objects"):
+    return None
+  return entry
@@ -0,0 +1,190 @@
+import struct
+
+head_read_size = 1 << 16 # Usually covers the TIFF IFDs, the RAF header or the PSD image resources
+max_ifds = 32
+# Photometric interpretations of decodable JPEG strips (RGB, YCbCr), raw sensor data uses others or none at all
+preview_photometrics = {2, 6}
+# Lossless and hierarchical SOF markers, used for raw sensor data that libjpeg can't decode
+lossless_markers = {0xC3, 0xC7, 0xCB, 0xCF}
+orientations = {
+  1: "TopLeft",
+  2: "TopRight",
+  3: "BottomRight",
+  4: "BottomLeft",
+  5: "LeftTop",
+  6: "RightTop",
+  7: "RightBottom",
+  8: "LeftBottom"
+}
+
+class RangeReader:
+  """Serves reads from the head of the file when possible, otherwise with a ranged read"""
+
+  def __init__(self, read_range, file_size):
+    self.read_range = read_range
+    self.file_size = file_size
+    self.head = read_range(0, min(head_read_size, file_size) - 1)
+
+  def read(self, offset, length):
+    if offset < 0 or length <= 0 or offset + length > self.file_size:
+      raise ValueError(f"Read of {length} bytes at {offset} is outside of the file")
+    if offset + length <= len(self.head):
+      return self.head[offset:offset + length]
+    return self.read_range(offset, offset + length - 1)
+
+def read_ifd(reader, base, offset, endian):
+  # Returns the tags of one IFD as {tag: (type, count, value or offset field)} and the next IFD offset
+  count = struct.unpack(endian + "H", reader.read(base + offset, 2))[0]
+  data = reader.read(base + offset + 2, count * 12 + 4)
+  tags = {}
+  for index in range(count):
+    tag, field_type, field_count = struct.unpack_from(endian + "HHI", data, index * 12)
+    value = data[index * 12 + 8:index * 12 + 12]
+    if field_type == 3 and field_count <= 2: # SHORT values are packed in the field itself
+      tags[tag] = struct.unpack_from(endian + "H", value)[0]
+    elif field_type in (4, 13) and field_count == 1: # LONG or IFD
+      tags[tag] = struct.unpack_from(endian + "I", value)[0]
+    else:
+      tags[tag] = (field_type, field_count, struct.unpack_from(endian + "I", value)[0])
+  next_offset = struct.unpack_from(endian + "I", data, count * 12)[0]
+  return tags, next_offset
+
+def read_offsets(reader, base, value, endian):
+  # SubIFDs can be a single IFD offset or a list of them
+  if isinstance(value, int):
+    return [value]
+  field_type, count, offset = value
+  if count == 1:
+    return [offset]
+  size = 2 if field_type == 3 else 4
+  data = reader.read(base + offset, count * size)
+  return list(struct.unpack(endian + ("H" if size == 2 else "I") * count, data))
+
+def tiff_previews(reader, base=0):
+  """Find the JPEG previews stored in a TIFF based file (CR2, NEF, ARW, DNG, ORF, PEF, TIFF, EXIF)
+
+  :param reader: RangeReader over the file
+  :param base: Offset of the TIFF header, used for the EXIF block inside of a JPEG
+  :return: Tuple with a list of (offset, length) candidates and the orientation of IFD0
+  """
+  byte_order = reader.read(base, 2)
+  if byte_order not in (b"II", b"MM"):
+    return [], 1
+  endian = "<" if byte_order == b"II" else ">"
+  offset = struct.unpack(endian + "I", reader.read(base + 4, 4))[0]
+  pending = [offset]
+  seen = set()
+  candidates = []
+  orientation = None
+  while pending and len(seen) < max_ifds:
+    offset = pending.pop(0)
+    if not offset or offset in seen:
+      continue
+    seen.add(offset)
+    tags, next_offset = read_ifd(reader, base, offset, endian)
+    if orientation is None:
+      orientation = tags.get(0x0112, 1) if isinstance(tags.get(0x0112, 1), int) else 1
+    pending.append(next_offset)
+    if 0x014A in tags: # SubIFDs, where NEF, ARW and DNG keep their larger previews
+      pending.extend(read_offsets(reader, base, tags[0x014A], endian))
+    # Old style JPEG thumbnail pointers
+    if isinstance(tags.get(0x0201), int) and isinstance(tags.get(0x0202), int):
+      candidates.append((base + tags[0x0201], tags[0x0202]))
+    # A single JPEG compressed strip that isn't raw sensor data
+    elif tags.get(0x0103) in (6, 7) and tags.get(0x0106) in preview_photometrics \
+      and isinstance(tags.get(0x0111), int) and isinstance(tags.get(0x0117), int):
+      candidates.append((base + tags[0x0111], tags[0x0117]))
+  return candidates, orientation or 1
+
+def raf_previews(reader):
+  # Fujifilm RAF keeps the offset and length of a full size JPEG in its fixed header
+  offset, length = struct.unpack(">II", reader.read(84, 8))
+  return [(offset, length)]
+
+def psd_previews(reader):
+  # Thumbnail resource (1036, or 1033 in Photoshop 4) from the image resources section
+  color_mode_length = struct.unpack(">I", reader.read(26, 4))[0]
+  offset = 30 + color_mode_length
+  resources_length = struct.unpack(">I", reader.read(offset, 4))[0]
+  offset += 4
+  end = offset + resources_length
+  while offset + 12 <= end:
+    signature, resource_id, name_length = struct.unpack(">4sHB", reader.read(offset, 7))
+    if signature != b"8BIM":
+      break
+    name_size = name_length + 1
+    name_size += name_size % 2
+    size = struct.unpack(">I", reader.read(offset + 6 + name_size, 4))[0]
+    data_offset = offset + 10 + name_size
+    if resource_id in (1036, 1033) and size > 28:
+      # 28 bytes of thumbnail header come before the JFIF data
+      return [(data_offset + 28, size - 28)]
+    offset = data_offset + size + size % 2
+  return []
+
+def jpeg_previews(reader):
+  # The EXIF block of a JPEG is a TIFF structure inside the APP1 segment
+  offset = 2
+  while offset + 4 <= reader.file_size:
+    marker, length = struct.unpack(">HH", reader.read(offset, 4))
+    if marker == 0xFFE1 and reader.read(offset + 4, 6) == b"Exif\x00\x00":
+      return tiff_previews(reader, offset + 10)
+    if marker in (0xFFDA, 0xFFD9) or marker >> 8 != 0xFF:
+      break
+    offset += 2 + length
+  return [], 1
+
+def jpeg_size(data):
+  # Width and height from the first SOF marker of a JPEG, or None if it isn't a JPEG
+  if data[:2] != b"\xff\xd8":
+    return None
+  offset = 2
+  while offset + 9 <= len(data):
+    if data[offset] != 0xFF:
+      return None
+    marker = data[offset + 1]
+    length = struct.unpack_from(">H", data, offset + 2)[0]
+    if marker in lossless_markers:
+      return None
+    if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+      height, width = struct.unpack_from(">HH", data, offset + 5)
+      return width, height
+    offset += 2 + length
+  return None
+
+def extract_preview(read_range, file_size, kind, min_size):
+  """Extract the largest embedded JPEG preview with a few ranged reads
+
+  :param read_range: Function taking inclusive (start, end) byte offsets and returning bytes
+  :param file_size: Size of the whole object in bytes
+  :param kind: Container type from file_formats.yml, one of tiff, raf, psd or jpeg
+  :param min_size: Smallest acceptable preview, in pixels along its longest side
+  :return: Tuple of (JPEG bytes, ImageMagick orientation) or None when no usable preview was found
+  """
+  try:
+    reader = RangeReader(read_range, file_size)
+    orientation = 1
+    if kind == "tiff":
+      candidates, orientation = tiff_previews(reader)
+    elif kind == "raf" and reader.read(0, 15) == b"FUJIFILMCCD-RAW":
+      candidates = raf_previews(reader)
+    elif kind == "psd" and reader.read(0, 4) == b"8BPS":
+      candidates = psd_previews(reader)
+    elif kind == "jpeg":
+      candidates, orientation = jpeg_previews(reader)
+    else:
+      candidates = []
+    for offset, length in sorted(candidates, key=lambda candidate: candidate[1], reverse=True):
+      if offset <= 0 or length <= 0 or offset + length > file_size:
+        continue
+      data = reader.read(offset, length)
+      size = jpeg_size(data)
+      if size and max(size) >= min_size:
+        print(f"Found embedded preview of {size[0]}x{size[1]} at {offset}, {length} bytes")
+        return data, orientations.get(orientation, "TopLeft")
+      if size:
+        # Candidates are sorted by length, the rest will be even smaller
+        break
+  except (ValueError, struct.error) as e:
+    print(f"Unable to read embedded preview: {e}")
+  return None
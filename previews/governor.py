@@ -0,0 +1,79 @@
+import os
+import shutil
+import time
+
+reserve_mb = 150 # Python, the SDKs and the previews written to /tmp before they're uploaded
+min_tool_memory_mb = 64
+# Encoder speed arguments as (normal, short on time), the fastest settings that still look fine at 1400k
+encoder_speed = {
+  "libx264": ("-preset veryfast", "-preset ultrafast"),
+  "libopenh264": ("", "-allow_skip_frames 1"),
+  "libsvtav1": ("-preset 10", "-preset 12"),
+  "libvpx-vp9": ("-deadline realtime -cpu-used 6", "-deadline realtime -cpu-used 8")
+}
+
+def remaining_seconds(context):
+  # AWS passes a context object, IBM Cloud Functions (OpenWhisk) sets the deadline in milliseconds since the epoch
+  if hasattr(context, "get_remaining_time_in_millis"):
+    return context.get_remaining_time_in_millis() / 1000
+  deadline = os.environ.get("__OW_DEADLINE", "")
+  if deadline.isdigit():
+    return int(deadline) / 1000 - time.time()
+  return None
+
+def tmp_free_mb(path="/tmp"):
+  return shutil.disk_usage(path).free >> 20
+
+def plan(memory_mb, disk_mb, cpu_cores, remaining, content_length, provider, streaming=False, tight_seconds=60):
+  """Size every tool from what the function actually has
+
+  :param memory_mb: Memory of the function in MB
+  :param disk_mb: Space that can be used in /tmp in MB
+  :param cpu_cores: CPUs available to the process
+  :param remaining: Seconds left in the invocation, None when unknown
+  :param content_length: Size of the object in bytes
+  :param provider: AWS reads through a presigned URL, IBM pipes the object or downloads it
+  :param streaming: Whether the IBM object can be piped in chunks instead of held in memory
+  :param tight_seconds: Below this many seconds left, the fastest encoder settings are used
+  :return: Dict with the in-memory and disk size limits, the source strategy (url, stream, memory, disk
+    or None when the object doesn't fit anywhere), the ImageMagick limits and the ffmpeg threads
+  """
+  max_mem_size = (memory_mb << 20) // 2 - (reserve_mb << 20)
+  max_disk_size = (disk_mb << 20) - (reserve_mb << 20)
+  if provider == "AWS":
+    strategy = "url"
+  elif streaming:
+    strategy = "stream"
+  elif content_length <= max_mem_size:
+    strategy = "memory"
+  elif content_length <= max_disk_size:
+    strategy = "disk"
+  else:
+    strategy = None
+  # Whatever holds the object can't be used by the tools at the same time
+  held_mb = content_length >> 20 if strategy == "memory" else 0
+  spilled_mb = content_length >> 20 if strategy == "disk" else 0
+  tool_memory_mb = max(min_tool_memory_mb, memory_mb - reserve_mb - held_mb)
+  return {
+    "max_mem_size": max_mem_size,
+    "max_disk_size": max_disk_size,
+    "strategy": strategy,
+    "remaining": remaining,
+    "tight": remaining is not None and remaining < tight_seconds,
+    "threads": cpu_cores,
+    # Pixel cache in memory first, then memory mapped files, then /tmp
+    "imagemagick_limits": {
+      "memory": f"{tool_memory_mb // 2}MiB",
+      "map": f"{tool_memory_mb}MiB",
+      "disk": f"{max(0, disk_mb - reserve_mb - spilled_mb)}MiB",
+      "thread": str(cpu_cores)
+    }
+  }
+
+def imagemagick_environment(limits):
+  # Same as "-limit name value" on every convert command, policy.xml only sets the ceiling
+  return {f"MAGICK_{name.upper()}_LIMIT": value for name, value in limits.items()}
+
+def encoder_args(encoder, tight, threads):
+  speed = encoder_speed.get(encoder, ("", ""))[1 if tight else 0]
+  return f"{speed} -threads {threads}".strip()
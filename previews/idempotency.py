@@ -0,0 +1,136 @@
+import hashlib
+import json
+
+lease_prefix = "previews/leases"
+lease_ttl = 120 # Seconds a lease lasts unless its holder renews it, so a crashed holder only blocks retries briefly
+heartbeat_interval = 30 # Seconds between renewals while the preview is being generated
+
+class LeaseTaken(Exception):
+  """The conditional write lost against another invocation"""
+
+class S3LeaseStore:
+  """Lease objects written with conditional puts, so only one invocation can create or replace them"""
+
+  def __init__(self, client, bucket):
+    self.client = client
+    self.bucket = bucket
+
+  def create(self, name, body):
+    return self.put(name, body, IfNoneMatch="*")
+
+  def replace(self, name, body, etag):
+    return self.put(name, body, IfMatch=etag)
+
+  def put(self, name, body, **condition):
+    try:
+      return self.client.put_object(Bucket=self.bucket, Key=name, Body=body, **condition)["ETag"]
+    except Exception as e:
+      if is_conflict(e):
+        raise LeaseTaken(name)
+      raise
+
+  def read(self, name):
+    try:
+      response = self.client.get_object(Bucket=self.bucket, Key=name)
+    except Exception as e:
+      if getattr(e, "response", {}).get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+        return None
+      raise
+    return response["Body"].read(), response["ETag"]
+
+  def delete(self, name, etag):
+    # Only deletes the lease this invocation wrote, not one another invocation has taken over since
+    try:
+      self.client.delete_object(Bucket=self.bucket, Key=name, IfMatch=etag)
+    except Exception as e:
+      if is_conflict(e):
+        raise LeaseTaken(name)
+      raise
+
+class MemoryLeaseStore:
+  """Same conditional semantics as S3LeaseStore, kept in a dict for tests and local runs"""
+
+  def __init__(self):
+    self.objects = {}
+    self.version = 0
+
+  def put(self, name, body):
+    self.version += 1
+    self.objects[name] = (body, f'"{self.version}"')
+    return self.objects[name][1]
+
+  def create(self, name, body):
+    if name in self.objects:
+      raise LeaseTaken(name)
+    return self.put(name, body)
+
+  def replace(self, name, body, etag):
+    if name not in self.objects or self.objects[name][1] != etag:
+      raise LeaseTaken(name)
+    return self.put(name, body)
+
+  def read(self, name):
+    return self.objects.get(name)
+
+  def delete(self, name, etag):
+    if name in self.objects and self.objects[name][1] != etag:
+      raise LeaseTaken(name)
+    self.objects.pop(name, None)
+
+def is_conflict(error):
+  response = getattr(error, "response", {})
+  status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+  # 412 when the condition doesn't hold, 409 when another conditional write is in flight
+  return status in (409, 412) or response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict")
+
+def lease_key(bucket, key, version):
+  # The version id, or the sequencer when the bucket isn't versioned, tells apart uploads of the same key
+  identity = json.dumps([bucket, key, version])
+  return f"{lease_prefix}/{hashlib.sha256(identity.encode()).hexdigest()}.json"
+
+def lease_body(state, owner, expires, preview_path=None, request=None):
+  return json.dumps({"state": state, "owner": owner, "expires": expires, "preview_path": preview_path, "request": request}).encode()
+
+def acquire(store, name, owner, ttl, now, request=None):
+  """Take the lease for one object version, or find out what an earlier invocation got done
+
+  :param store: S3LeaseStore or MemoryLeaseStore
+  :param name: Lease object name from lease_key()
+  :param owner: Id of this invocation
+  :param ttl: Seconds the lease is held before another invocation can take over
+  :param now: Current time in seconds since the epoch
+  :param request: Request id of the invocation, the same for the retries of an event, which take over right away
+  :return: Dict with the action ("run", "skip" or "resume"), the lease etag and the recorded lease
+  """
+  body = lease_body("in_progress", owner, now + ttl, request=request)
+  try:
+    return {"action": "run", "etag": store.create(name, body), "lease": None}
+  except LeaseTaken:
+    pass
+  current = store.read(name)
+  if current is None:
+    # Released between the two requests, the retry of the event will get it
+    return {"action": "skip", "etag": None, "lease": None}
+  data, etag = current
+  lease = json.loads(data)
+  if lease["state"] == "done":
+    return {"action": "skip", "etag": etag, "lease": lease}
+  if lease["state"] == "uploaded":
+    # Everything is uploaded already, only the tags are missing
+    return {"action": "resume", "etag": etag, "lease": lease}
+  retry = request is not None and lease.get("request") == request
+  if lease["expires"] > now and not retry:
+    return {"action": "skip", "etag": etag, "lease": lease}
+  try:
+    # The previous owner timed out or crashed, either it stopped renewing or this is the retry of its event
+    return {"action": "run", "etag": store.replace(name, body, etag), "lease": lease}
+  except LeaseTaken:
+    return {"action": "skip", "etag": None, "lease": lease}
+
+def record(store, name, etag, state, owner, expires, preview_path=None, request=None):
+  # Moves the lease forward or renews it, returns the new etag or None when another invocation took it over
+  try:
+    return store.replace(name, lease_body(state, owner, expires, preview_path, request), etag)
+  except LeaseTaken:
+    print(f"Lease {name} was taken over by another invocation")
+    return None
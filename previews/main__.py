@@ -5,20 +5,30 @@ import os
 import pathlib
 import re
 import shlex
+import shutil
 import subprocess as sp
+import sys
+import threading
 import time
 import urllib.parse
 import uuid
 from shlex import quote
 
-import ibm_boto3
-import yaml
-from ibm_botocore.client import ClientError, Config
+import cache
+import governor
+import idempotency
+import profiles
+import renderers
+# embedded, mp4, multipart, pdf and storyboard are imported where they're used, most invocations never need them
 
-if os.environ.get("LAMBDA_TASK_ROOT"):
-    import boto3  # For some reason can't find boto3 when using IBM Functions even though it works just fine in AWS
-    from botocore.exceptions import ClientError
-    from botocore.client import Config
+# Provider SDKs are imported by load_provider_sdk() so a container only pays for the cloud it runs on
+boto3 = None
+ibm_boto3 = None
+Config = None
+
+class ClientError(Exception):
+  # Stands in until load_provider_sdk() replaces it, so an except clause never sees None
+  pass
 
 key = ""
 is_downloaded = False
@@ -28,6 +38,29 @@ provider = ""
 uuid_str = ""
 cpu_cores = 0
 default_preview_duration = 15
+s3_max_pool_connections = 16
+publish_workers = 4
+min_segment_duration = 2
+chunked_encoders = {"libsvtav1", "libvpx-vp9"} # Software encoders slow enough to be worth splitting across cores
+score_width = 64 # Size of the grayscale copy used to score poster candidates
+score_height = 36
+black_frame_luma = 20
+min_frame_entropy = 4.0
+stream_chunk_size = 1 << 20 # Bytes copied at a time from S3 into a child process' stdin
+runtime = None # Built once per container and reused by warm invocations, see get_runtime()
+lease = None # Lease on the object version held by this invocation, see acquire_lease()
+lease_lock = threading.Lock() # The heartbeat renews the lease from its own thread
+resources = {"tight": False, "threads": 0} # Set per invocation by governor.plan(), 0 threads lets ffmpeg decide
+encode_profile = profiles.default_profile # Set per invocation by profiles.select_profile() from the source video
+work_dir = "/tmp" # Every record of a batch gets its own directory, see process_batch()
+batch_share = 1 # Records of a batch running at the same time, each gets this share of the memory, disk and CPUs
+
+# Preferred order when more than one encoder is installed, vp9 is always available as the default build
+encoder_libraries = {
+  "libx264": "libx264",
+  "libopenh264": "libopenh264",
+  "libsvtav1": "libSvtAv1Enc"
+}
 
 def get_video_duration(file, is_downloaded):
   try:
@@ -46,96 +79,453 @@ def get_video_duration(file, is_downloaded):
     error = "Unable to get video duration, please check file extension"
     export_error(error)
 
-def pdf_thumb(file, output):
+def pdf_thumb(file, output, sizes=(800,)):
   print(f"Creating pdf thumbnail for {output}")
+  ladder = ladder_args(output, sizes, "x{size}\\>")
   if is_downloaded:
-    os.system(f"convert -size x800 -background white -flatten {file}[0] {output}")
+    os.system(f"convert -size x{sizes[0]} -background white -flatten {file}[0]" + ladder)
   else:
-    cmd = ["convert", "-size", "x800", "-background", "white", "-flatten", "-[0]", f"{output}"]
-    sp.run(cmd, input=file)
+    cmd = ["convert", "-size", f"x{sizes[0]}", "-background", "white", "-flatten", "-[0]"] + shlex.split(ladder)
+    if run_piped(cmd, file).returncode != 0:
+      export_error("Unable to create the pdf thumbnail")
 
-def image_thumb(file, output):
+def image_thumb(file, output, hint="", sizes=(800,)):
   print(f"Creating image thumbnail for {output}")
+  ladder = ladder_args(output, sizes, "{size}x{size}\\>", "+dither -posterize 40")
   if is_downloaded:
-    cmd = f"convert {file}[0] -auto-orient -thumbnail 800x800\\>"\
-      f" -quality 95 +dither -posterize 40 '{output}'; optipng '{output}'"
+    cmd = f"convert {hint} {file}[0] -auto-orient -quality 95" + ladder
     os.system(cmd)
   else:
-    cmd = ["convert", "-[0]", "-auto-orient", "-thumbnail", "800x800", "-quality", "95", "+dither", "-posterize", "40", f"{output}"]
-    cmd2 = ["optipng", f"{output}"]
-    sp.run(cmd, input=file)
-    sp.run(cmd2)
+    cmd = ["convert"] + shlex.split(hint) + ["-[0]", "-auto-orient", "-quality", "95"] + shlex.split(ladder)
+    if run_piped(cmd, file).returncode != 0:
+      export_error("Unable to create the image thumbnail")
+  for size in sizes:
+    sp.run(["optipng", thumb_output(output, size, sizes)])
 
 def txt_thumb(file, output, height):
   cmd = f"convert -size x{height}\\> -background white {file}[0] {output}"
   return os.system()
 
 # Old method to generate a clip, can still be used later on for other cloud providers.
-def generate_clip(file, output, is_downloaded, duration, clip_duration, max_mem_size=""):
+def generate_clip(file, output, is_downloaded, duration, clip_duration, max_mem_size="", stream=None):
   time_offset = duration // 2
-  encoder = "libsvtav1"
-  if os.system("test -e /usr/local/lib/libx264*") == 0:
-    encoder = "libx264"
-  elif os.system("test -e /usr/local/lib/libopenh264*") == 0:
-    encoder = "libopenh264"
+  encoder = video_encoder()
   print(f"Generating clip with output: {output} using encoder: {encoder}")
   if is_downloaded:
-    cmd = f"/function/bin/ffmpeg -y -ss {time_offset} -t {clip_duration} -i {file} -vf fps=24,scale=1280x720 -b:v 1400k -an -cpu-used -{cpu_cores} -deadline realtime {output}"
+    cmd = f"/function/bin/ffmpeg -y -ss {time_offset} -t {clip_duration} -i {file} -vf {profiles.filter_args(encode_profile)} {profiles.rate_args(encode_profile)} -an -threads {resources['threads']} -deadline realtime {output}"
     return os.system(cmd)
-  cmd = ["/function/bin/ffmpeg", "-y",  "-ss", f"{time_offset}", "-t", f"{clip_duration}", "-i", "-", "-vf", "fps=24,scale=1280x720", "-an", "-cpu-used", f"-{cpu_cores}", "-deadline", "realtime", output]
-  sp.run(cmd, input=get_item(max_mem_size))
+  cmd = ["/function/bin/ffmpeg", "-y",  "-ss", f"{time_offset}", "-t", f"{clip_duration}", "-i", "-", "-vf", profiles.filter_args(encode_profile)] + profiles.rate_args(encode_profile).split() + ["-an", "-threads", f"{resources['threads']}", "-deadline", "realtime", output]
+  if run_piped(cmd, stream if stream is not None else get_item(max_mem_size)).returncode != 0:
+    export_error("Unable to generate the clip")
+
+def probe_video(url):
+  # Size, frame rate, codec and duration of the source in one ffprobe, empty values fall back to the default profile
+  try:
+    output = sp.run(profiles.probe_command(url), capture_output=True, text=True).stdout
+  except OSError as e:
+    print("Unable to probe the video", e)
+    output = ""
+  source = profiles.parse_probe(output)
+  print("Source video", source)
+  return source
+
+def first_keyframe_after(url, seconds):
+  # Only reads a few packets after the seek point, ffmpeg fetches them with range requests
+  cmd = "/function/bin/ffprobe -v error -select_streams v:0 -read_intervals \"" + f"{seconds}%+#100\" \
+  -show_entries packet=pts_time,flags -of csv=p=0 \"" + url + "\""
+  command = shlex.split(cmd)
+  packets = sp.run(command, capture_output=True, text=True).stdout.splitlines()
+  for packet in packets:
+    pts_time, _, flags = packet.partition(",")
+    try:
+      if "K" in flags and float(pts_time) >= seconds:
+        return float(pts_time)
+    except ValueError:
+      continue
+  return seconds
+
+def get_clip_offset(url, mode, clip_duration, duration=None):
+  if mode in ("", "start"):
+    return 0
+  duration = duration or get_video_duration(quote(url), True)
+  if mode == "middle":
+    offset = duration // 2
+  elif mode.endswith("%") and mode[:-1].replace(".", "", 1).isdigit():
+    offset = duration * float(mode[:-1]) / 100
+  elif mode.startswith("keyframe:") and mode[9:].replace(".", "", 1).isdigit():
+    offset = first_keyframe_after(url, float(mode[9:]))
+  else:
+    print(f"Unknown preview_offset '{mode}', using the start of the video")
+    return 0
+  # Keeps the whole clip inside the video when the offset is too close to the end
+  offset = max(0, min(offset, duration - clip_duration))
+  print("Clip offset", offset)
+  return offset
 
-def generate_clipv2(url, output, clip_duration, preview_audio):
+def poster_output(size, sizes):
+  # The first size keeps the historical name so the rest of the pipeline doesn't change
+  return f"{work_dir}/thumb.jpg" if size == sizes[0] else f"{work_dir}/thumb-{size}.jpg"
+
+def video_filter_graph(poster_sizes):
+  # One decode feeds the clip and every poster size through split outputs
+  labels = ["clip"] + [f"poster{size}" for size in poster_sizes]
+  graph = f"[0:v]split={len(labels)}" + "".join(f"[{label}]" for label in labels)
+  graph += f";[clip]{profiles.filter_args(encode_profile)}[vclip]"
+  for size in poster_sizes:
+    graph += f";[poster{size}]scale={size}:{size}:force_original_aspect_ratio=decrease[vposter{size}]"
+  return graph
+
+def poster_candidate_graph(poster_times, poster_sizes):
+  # Every candidate keyframe is scaled to each poster size, plus a tiny grayscale copy used to score it
+  graph = ""
+  for index in range(1, len(poster_times) + 1):
+    labels = [f"cand{index}_{size}" for size in poster_sizes] + [f"score{index}"]
+    graph += f";[{index}:v]trim=end_frame=1,setpts=PTS-STARTPTS,split={len(labels)}" + "".join(f"[{label}]" for label in labels)
+    for size in poster_sizes:
+      graph += f";[cand{index}_{size}]scale={size}:{size}:force_original_aspect_ratio=decrease[vcand{index}_{size}]"
+    graph += f";[score{index}]scale={score_width}:{score_height},format=gray[vscore{index}]"
+  return graph
+
+def clip_command(url, output, clip_duration, encoder, audio_arg, poster_sizes, time_offset, extra_args="", poster_times=(), threads=None):
+  # Seeking before the input makes ffmpeg skip straight to the offset instead of decoding up to it
+  seek_arg = f"-ss {time_offset} " if time_offset else ""
+  # Poster candidates are extra inputs with keyframe-only decoding, so their cost doesn't grow with the video length
+  candidate_inputs = "".join(f" -skip_frame nokey -noaccurate_seek -ss {seconds:.3f} -i \"" + url + "\"" for seconds in poster_times)
+  graph = video_filter_graph(poster_sizes) + poster_candidate_graph(poster_times, poster_sizes)
+  speed_args = governor.encoder_args(encoder, resources["tight"], threads or resources["threads"])
+  cmd = f"/function/bin/ffmpeg -y {seek_arg}-i \"" + url + f"\"{candidate_inputs} -filter_complex \"{graph}\" \
+  -map [vclip] -t {clip_duration} -c:v {encoder} {profiles.rate_args(encode_profile)} {audio_arg} {speed_args} {extra_args} {output}"
+  for size in poster_sizes:
+    cmd += f" -map [vposter{size}] -frames:v 1 {poster_output(size, poster_sizes)}"
+  for index in range(1, len(poster_times) + 1):
+    for size in poster_sizes:
+      cmd += f" -map [vcand{index}_{size}] -frames:v 1 {work_dir}/candidate-{index}-{size}.jpg"
+    cmd += f" -map [vscore{index}] -frames:v 1 -f rawvideo {work_dir}/candidate-{index}.gray"
+  return shlex.split(cmd)
+
+def print_command(label, command, url):
+  print(label, ' '.join(arg for arg in command if arg != url)) # Printing command wihout presigned url
+
+def poster_times_for(duration, candidates):
+  # Skips the very start and end, where black frames and slates usually are
+  return [duration * (index + 1) / (candidates + 1) for index in range(candidates)]
+
+def score_frame(data):
+  # Returns (mean luma, histogram entropy in bits) of a grayscale frame
+  histogram = [0] * 256
+  for pixel in data:
+    histogram[pixel] += 1
+  mean = sum(data) / len(data)
+  entropy = -sum(count / len(data) * math.log2(count / len(data)) for count in histogram if count)
+  return mean, entropy
+
+def select_poster(poster_times, poster_sizes):
+  best = None
+  for index in range(1, len(poster_times) + 1):
+    try:
+      with open(f"{work_dir}/candidate-{index}.gray", "rb") as f:
+        data = f.read()
+    except OSError:
+      continue
+    if len(data) != score_width * score_height:
+      continue
+    mean, entropy = score_frame(data)
+    print(f"Poster candidate {index} at {poster_times[index - 1]:.2f}s: luma {mean:.1f} entropy {entropy:.2f}")
+    if mean < black_frame_luma or entropy < min_frame_entropy:
+      continue
+    if best is None or entropy > best[1]:
+      best = (index, entropy)
+  if best is not None:
+    for size in poster_sizes:
+      os.replace(f"{work_dir}/candidate-{best[0]}-{size}.jpg", poster_output(size, poster_sizes))
+    print(f"Selected poster candidate {best[0]}")
+  else:
+    print("No poster candidate passed the checks, keeping the first frame of the clip")
+  for index in range(1, len(poster_times) + 1):
+    for name in [f"{work_dir}/candidate-{index}.gray"] + [f"{work_dir}/candidate-{index}-{size}.jpg" for size in poster_sizes]:
+      if os.path.exists(name):
+        os.remove(name)
+  return best[0] if best else None
+
+def generate_clipv2(url, output, clip_duration, preview_audio, poster_sizes=(320,), time_offset=0, poster_times=()):
   start = time.time()
-  encoder = "libvpx-vp9"
+  encoder = video_encoder()
   audio_arg = "-an"
-  if os.system("find /usr/local/lib/ -name 'libx264*' -print -quit | grep -q .") == 0:
-    encoder = "libx264"
-  elif os.system("find /usr/local/lib/ -name 'libopenh264*' -print -quit | grep -q .") == 0:
-    encoder = "libopenh264"
-  elif os.system("find /usr/local/lib/ -name 'libSvtAv1Enc*' -print -quit | grep -q .") == 0:
-    encoder = "libsvtav1"
   print(f"Generating clip with output: {output} using encoder: {encoder}")
 
   if preview_audio:
-    audio_arg = "-b:a 96k"
+    audio_arg = "-map 0:a? -b:a 96k"
 
-  cmd = "/function/bin/ffmpeg -y -i \"" + url + f"\" -t {clip_duration} \
-  -c:v {encoder} -vf fps=24,scale=1280x720 -b:v 1400k {audio_arg} -cpu-used -{cpu_cores} -deadline realtime {output}"
-  command = shlex.split(cmd)
-  print("RUNNING FFMPEG VIDEO COMMAND: ", ' '.join(command[:3] + command[4:])) # Printing command wihout presigned url
+  command = clip_command(url, output, clip_duration, encoder, audio_arg, poster_sizes, time_offset, poster_times=poster_times)
+  print_command("RUNNING FFMPEG VIDEO COMMAND: ", command, url)
   sp.run(command)
-  video_thumb(url, "/tmp/thumb.jpg")
   end = time.time()
   print(end - start, " FINISHED GENERATING A CLIP")
 
-def video_thumb(url, output):
-  cmd = "/function/bin/ffmpeg -y -i \"" + url + f"\" -vf 'scale=320:320:force_original_aspect_ratio=decrease' -vframes 1 {output}"
-  command = shlex.split(cmd)
-  print("RUNNING FFMPEG IMAGE COMMAND: ", ' '.join(command[:3] + command[4:])) # Printing command wihout presigned url
-  sp.run(command)
+def generate_clip_streamed(url, object_name, clip_duration, preview_audio, poster_sizes=(320,), time_offset=0, poster_times=()):
+  """Encode the clip into a pipe that is uploaded in parts while ffmpeg is still running
+
+  Fragmented MP4 doesn't need to seek back to write the moov atom, so the clip never touches /tmp.
+  The posters are still written to /tmp since they're tiny and go through the usual upload.
+  """
+  start = time.time()
+  encoder = video_encoder()
+  audio_arg = "-map 0:a? -b:a 96k" if preview_audio else "-an"
+  print(f"Streaming clip to: {object_name} using encoder: {encoder}")
+  command = clip_command(url, "pipe:1", clip_duration, encoder, audio_arg, poster_sizes, time_offset,
+    "-f mp4 -movflags frag_keyframe+empty_moov+default_base_moof", poster_times)
+  print_command("RUNNING FFMPEG VIDEO COMMAND: ", command, url)
+  process = sp.Popen(command, stdout=sp.PIPE)
+
+  def check_encode():
+    if process.wait() != 0:
+      raise RuntimeError(f"ffmpeg exited with {process.returncode}")
+
+  import multipart
+  client = s3 if provider == "AWS" else s3.meta.client
+  try:
+    multipart.upload_stream(client, bucket, object_name, process.stdout, publish_workers, check=check_encode)
+  except Exception as e:
+    process.kill()
+    print(e)
+    error = f"Couldn't stream the preview to '{object_name}', something went wrong with ffmpeg or the upload."
+    export_error(error)
+  finally:
+    process.stdout.close()
+    process.wait()
+  end = time.time()
+  print(end - start, " FINISHED STREAMING A CLIP")
+
+def keyframes_between(url, start, duration):
+  cmd = "/function/bin/ffprobe -v error -select_streams v:0 -read_intervals \"" + f"{start}%+{duration}\" \
+  -show_entries packet=pts_time,flags -of csv=p=0 \"" + url + "\""
+  keyframes = []
+  for packet in sp.run(shlex.split(cmd), capture_output=True, text=True).stdout.splitlines():
+    pts_time, _, flags = packet.partition(",")
+    try:
+      if "K" in flags:
+        keyframes.append(float(pts_time))
+    except ValueError:
+      continue
+  return keyframes
+
+def segment_boundaries(keyframes, start, duration, segments):
+  # Splits the clip as evenly as possible, but only on keyframes so every segment starts with a cheap seek
+  end = start + duration
+  boundaries = [start]
+  for segment in range(1, segments):
+    target = start + duration * segment / segments
+    candidates = [keyframe for keyframe in keyframes if boundaries[-1] < keyframe < end]
+    if not candidates:
+      break
+    boundary = min(candidates, key=lambda keyframe: abs(keyframe - target))
+    if boundary not in boundaries:
+      boundaries.append(boundary)
+  boundaries.append(end)
+  return [(boundaries[i], boundaries[i + 1] - boundaries[i]) for i in range(len(boundaries) - 1)]
+
+def generate_clip_chunked(url, output, clip_duration, preview_audio, poster_sizes=(320,), time_offset=0, segments=2, poster_times=()):
+  from concurrent.futures import ThreadPoolExecutor
+  start = time.time()
+  encoder = video_encoder()
+  keyframes = keyframes_between(url, time_offset, clip_duration)
+  chunks = segment_boundaries(keyframes, time_offset, clip_duration, segments)
+  if len(chunks) < 2:
+    print("Not enough keyframes to split the clip, encoding it in a single process")
+    return generate_clipv2(url, output, clip_duration, preview_audio, poster_sizes, time_offset, poster_times)
+  workers = min(len(chunks), cpu_cores)
+  threads = max(1, cpu_cores // workers)
+  print(f"Generating clip with output: {output} using encoder: {encoder} in {len(chunks)} segments")
+
+  commands = []
+  for index, (chunk_start, chunk_duration) in enumerate(chunks):
+    # Posters come from the first segment so they still don't need a decode of their own
+    chunk_posters = poster_sizes if index == 0 else ()
+    chunk_poster_times = poster_times if index == 0 else ()
+    commands.append(clip_command(url, f"{work_dir}/chunk-{index}.mp4", chunk_duration, encoder, "-an", chunk_posters, chunk_start, "", chunk_poster_times, threads))
+  chunk_files = [f"{work_dir}/chunk-{index}.mp4" for index in range(len(chunks))] + [f"{work_dir}/chunks.txt"]
+  try:
+    # Each worker thread only waits on its ffmpeg process, so threads are enough to keep every core busy
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(lambda command: sp.run(command).returncode, commands))
+    if not any(results):
+      with open(f"{work_dir}/chunks.txt", "w") as f:
+        f.writelines(f"file '{work_dir}/chunk-{index}.mp4'\n" for index in range(len(chunks)))
+      # The segments are joined without re-encoding, audio is encoded here in one go to avoid gaps between segments
+      cmd = f"/function/bin/ffmpeg -y -f concat -safe 0 -i {work_dir}/chunks.txt"
+      if preview_audio:
+        seek_arg = f"-ss {time_offset} " if time_offset else ""
+        cmd += f" {seek_arg}-t {clip_duration} -i \"" + url + "\" -map 0:v -map 1:a? -b:a 96k"
+      cmd += f" -c:v copy {output}"
+      command = shlex.split(cmd)
+      if preview_audio:
+        print_command("RUNNING FFMPEG CONCAT COMMAND: ", command, url)
+      else:
+        print("RUNNING FFMPEG CONCAT COMMAND: ", ' '.join(command))
+      sp.run(command)
+  finally:
+    # Failed segments are removed too, before the fallback needs the space in /tmp
+    for chunk_file in chunk_files:
+      if os.path.exists(chunk_file):
+        os.remove(chunk_file)
+  if any(results):
+    print(f"Segment encoding failed with {results}, encoding it in a single process")
+    return generate_clipv2(url, output, clip_duration, preview_audio, poster_sizes, time_offset, poster_times)
+  end = time.time()
+  print(end - start, " FINISHED GENERATING A CHUNKED CLIP")
+
+def chunked_segments(encoder, clip_duration, config):
+  # Returns how many segments to encode in parallel, 1 means the single process path
+  if encoder not in chunked_encoders:
+    return 1
+  segments = config.get("chunked_segments", 0) or cpu_cores
+  # Segments shorter than a couple of seconds cost more in process start up than they save
+  return max(1, min(segments, cpu_cores, clip_duration // min_segment_duration))
+
+def benchmark_clip(url, clip_duration, preview_audio, poster_sizes, time_offset, segments):
+  timings = {}
+  for name, generate in (("single", generate_clipv2), ("chunked", generate_clip_chunked)):
+    start = time.time()
+    if name == "single":
+      generate(url, f"{work_dir}/benchmark-{name}.mp4", clip_duration, preview_audio, poster_sizes, time_offset)
+    else:
+      generate(url, f"{work_dir}/benchmark-{name}.mp4", clip_duration, preview_audio, poster_sizes, time_offset, max(segments, 2))
+    timings[name] = time.time() - start
+    os.remove(f"{work_dir}/benchmark-{name}.mp4")
+  print(f"BENCHMARK single: {timings['single']:.2f}s chunked: {timings['chunked']:.2f}s speedup: {timings['single'] / timings['chunked']:.2f}x")
+  return timings
 
-def pdf_thumbv2(url, output):
+def thumb_output(output, size, sizes):
+  # The largest size keeps the historical name, the rest of the ladder goes next to it
+  return output if size == sizes[0] else f"{os.path.splitext(output)[0]}-{size}.png"
+
+def ladder_args(output, sizes, geometry, finish=""):
+  # Each size is derived from the previous one in the same process, so the source is only decoded once
+  args = ""
+  for size in sizes:
+    args += f" -thumbnail {geometry.format(size=size)} '(' +clone {finish} -write '{thumb_output(output, size, sizes)}' ')' +delete"
+  return args + " null:"
+
+def ladder_written(output, sizes):
+  return all(os.path.isfile(thumb_output(output, size, sizes)) for size in sizes)
+
+def pdf_thumbv2(url, output, sizes=(800,)):
   start = time.time()
-  cmd = f"convert -size x800 -background white -flatten {url}[0] {output}"
+  cmd = f"convert -size x{sizes[0]} -background white {url}[0] -flatten" + ladder_args(output, sizes, "x{size}\\>")
   command = shlex.split(cmd)
-  print("RUNNING IMAGEMAGICK COMMAND: ", ' '.join(command[:6] + command[7:])) # Printing command wihout presigned url
+  print("RUNNING IMAGEMAGICK COMMAND: ", ' '.join(command[:5] + command[6:])) # Printing command wihout presigned url
   sp.run(command)
   end = time.time()
   print(end - start, " FINISHED GENERATING A PDF THUMBNAIL")
 
-def image_thumbv2(url, output):
+def image_thumbv2(url, output, sizes=(800,), hint=""):
   start = time.time()
-  cmd = f"convert {url}[0] -auto-orient -thumbnail 800x800\\>"\
-      f" -quality 95 +dither -posterize 40 '{output}'"
+  cmd = f"convert {hint} {url}[0] -auto-orient -quality 95" + ladder_args(output, sizes, "{size}x{size}\\>", "+dither -posterize 40")
   command = shlex.split(cmd)
-  print("RUNNING IMAGEMAGICK COMMAND: ", ' '.join(command[:1] + command[2:])) # Printing command wihout presigned url
+  print("RUNNING IMAGEMAGICK COMMAND: ", ' '.join(arg for arg in command if arg != f"{url}[0]")) # Printing command wihout presigned url
   sp.run(command)
   # cmd2 = ["optipng", f"{output}"]
   # sp.run(cmd2)
   end = time.time()
   print(end - start, " FINISHED GENERATING A PNG THUMBNAIL")
-  
+
+def embedded_thumb(data, orientation, output, sizes=(800,)):
+  start = time.time()
+  # The embedded preview doesn't always carry the orientation of the original, so it's set from IFD0
+  orient = f"-orient {orientation}" if orientation != "TopLeft" else ""
+  cmd = f"convert -define jpeg:size={sizes[0] * 2}x{sizes[0] * 2} jpeg:-[0] {orient} -auto-orient -quality 95" + ladder_args(output, sizes, "{size}x{size}\\>", "+dither -posterize 40")
+  command = shlex.split(cmd)
+  print("RUNNING IMAGEMAGICK COMMAND: ", ' '.join(command))
+  result = run_piped(command, data)
+  end = time.time()
+  print(end - start, " FINISHED GENERATING A PNG THUMBNAIL FROM THE EMBEDDED PREVIEW")
+  return result
+
+@renderers.register("embedded", ["image"], cost=1)
+def embedded_image_thumb(job):
+  # Nothing is written when there is no embedded preview large enough, so the whole file gets decoded instead
+  container = embedded_container(job["file_name"])
+  if container is None or job["content_length"] <= 0:
+    return []
+  import embedded
+  embedded_preview = embedded.extract_preview(get_range, job["content_length"], container, job["sizes"][0])
+  if embedded_preview is None:
+    return []
+  result = embedded_thumb(*embedded_preview, job["output"], job["sizes"])
+  if result.returncode != 0 or not ladder_written(job["output"], job["sizes"]):
+    print("Unable to convert the embedded preview, decoding the whole file")
+    return []
+  return list(job["sizes"])
+
+@renderers.register("linearized-pdf", ["pdf"], cost=2)
+def linearized_pdf_thumb(job):
+  """Render the first page of a linearized PDF from the first page section only
+
+  :param job: Renderer job, the output is the path of the largest thumbnail and sizes are heights, largest first
+  :return: The sizes written, or an empty list when the PDF isn't linearized or Ghostscript can't render it
+  """
+  import pdf
+  start = time.time()
+  content_length, output, sizes = job["content_length"], job["output"], job["sizes"]
+  if content_length <= 0:
+    return []
+  linearization = pdf.probe(get_range, content_length)
+  if linearization is None:
+    print("PDF isn't linearized, rendering it from the whole file")
+    return []
+  prefix = get_range(0, linearization["first_page_end"] - 1)
+  print(f"Fetched the first page section, {len(prefix)} of {content_length} bytes")
+  _, page_height, use_crop_box = pdf.page_size(prefix, linearization["first_page_object"])
+  document_file_name = f"{work_dir}/first-page.pdf"
+  page_file_name = f"{work_dir}/first-page.png"
+  write_file(document_file_name, pdf.first_page_document(prefix, linearization))
+  command = pdf.render_command(document_file_name, page_file_name, pdf.render_dpi(page_height, sizes[0]), use_crop_box)
+  print("RUNNING GHOSTSCRIPT COMMAND: ", ' '.join(command))
+  result = sp.run(command)
+  os.remove(document_file_name)
+  if result.returncode != 0 or not os.path.isfile(page_file_name):
+    print("Unable to render the first page section, rendering it from the whole file")
+    return []
+  result = sp.run(shlex.split(f"convert {page_file_name}" + ladder_args(output, sizes, "x{size}\\>")))
+  os.remove(page_file_name)
+  if result.returncode != 0 or not ladder_written(output, sizes):
+    print("Unable to resize the first page, rendering it from the whole file")
+    return []
+  end = time.time()
+  print(end - start, " FINISHED GENERATING A PDF THUMBNAIL FROM THE FIRST PAGE")
+  return list(sizes)
+
+@renderers.register("imagemagick", ["image", "pdf"], cost=10)
+def imagemagick_thumb(job):
+  # Decodes the whole file with convert, it handles every format so it's always the last resort
+  global is_downloaded
+  output, sizes = job["output"], job["sizes"]
+  if provider == "IBM":
+    if job["strategy"] == "stream":
+      fileData = open_item()
+      is_downloaded = False
+    elif job["strategy"] == "memory":
+      fileData = get_item(job["max_mem_size"])
+      is_downloaded = False
+    elif job["strategy"] == "disk":
+      download_file_to_disk(job["tmp_path"])
+      is_downloaded = True
+    else:
+      error = "File size is too big, please consider increasing memory/disk limits"
+      export_error(error)
+
+    source = job["shellsafe_file"] if is_downloaded else fileData
+    if job["category"] == "pdf":
+      pdf_thumb(source, output, sizes)
+    else:
+      image_thumb(source, output, decode_hint(job["file_name"], sizes[0]), sizes)
+    return list(sizes)
+  if job["category"] == "pdf":
+    pdf_thumbv2(job["url"], output, sizes)
+  else:
+    image_thumbv2(job["url"], output, sizes, decode_hint(job["file_name"], sizes[0]))
+  return list(sizes)
+
 def create_presigned_url_aws(expiration=600):
     """Generate a presigned URL to share an S3 object
 
@@ -200,6 +590,74 @@ def get_item(max_mem_size):
       error = f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function."
       export_error(error)
 
+def open_item():
+  # Same as get_item() but hands back the StreamingBody so the object is never held in memory
+  try:
+    print(f"Opening file stream: {key}")
+    if provider == "AWS":
+      return s3.get_object(Bucket=bucket, Key=key)["Body"]
+    elif provider == "IBM":
+      return s3.Object(bucket, key).get()["Body"]
+  except Exception as e:
+      print(e)
+      error = f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function."
+      export_error(error)
+
+def open_range(start, end):
+  try:
+    byte_range = f"bytes={start}-{end}"
+    if provider == "AWS":
+      return s3.get_object(Bucket=bucket, Key=key, Range=byte_range)["Body"]
+    elif provider == "IBM":
+      return s3.Object(bucket, key).get(Range=byte_range)["Body"]
+  except Exception as e:
+      print(e)
+      error = f"Error getting object {key} from bucket {bucket}. Make sure they exist and your bucket is in the same region as this function."
+      export_error(error)
+
+def get_range(start, end):
+  # Small ranged reads used to look inside a file without downloading it
+  return open_range(start, end).read()
+
+def pump_stream(body, process, failures):
+  # The pipe buffer provides the backpressure, only one chunk is held in memory at a time
+  copied = 0
+  try:
+    for chunk in iter(lambda: body.read(stream_chunk_size), b""):
+      try:
+        process.stdin.write(chunk)
+      except (BrokenPipeError, ValueError):
+        # The child process stopped reading, which is expected once ffmpeg has the whole clip
+        break
+      copied += len(chunk)
+  except Exception as e:
+    # A failed read would look like the end of the file to the child, it must not finish with a truncated input
+    failures.append(e)
+    process.kill()
+  finally:
+    body.close()
+    try:
+      process.stdin.close()
+    except BrokenPipeError:
+      pass
+  print(f"Streamed {copied} bytes of {key}")
+
+def run_piped(cmd, data):
+  if isinstance(data, (bytes, bytearray)):
+    return sp.run(cmd, input=data)
+  start = time.time()
+  process = sp.Popen(cmd, stdin=sp.PIPE)
+  failures = []
+  pump = threading.Thread(target=pump_stream, args=(data, process, failures), daemon=True)
+  pump.start()
+  process.wait()
+  pump.join()
+  end = time.time()
+  print(end - start, "FINISHED STREAMING INTO", cmd[0])
+  if failures:
+    export_error(f"Unable to stream the file into {cmd[0]}: {failures[0]}")
+  return process
+
 def write_file(name, fileData):
   f = open(name, "wb")
   f.write(fileData)
@@ -207,6 +665,7 @@ def write_file(name, fileData):
   print(f"Wrote file '{name}' to disk")
 
 def read_yaml(file):
+  import yaml # Only needed when there isn't a precompiled table, see compile_tables()
   with open(file, "r") as stream:
     try:
       return yaml.safe_load(stream)
@@ -215,6 +674,22 @@ def read_yaml(file):
       error = f"Couldn't read yml file {file}"
       export_error(error)
 
+def read_table(file):
+  # Prefers the json copy generated at build time, unless the yml file was edited afterwards
+  compiled_file = os.path.splitext(file)[0] + ".json"
+  if os.path.exists(compiled_file) and os.path.getmtime(compiled_file) >= os.path.getmtime(file):
+    with open(compiled_file, "r") as stream:
+      return json.load(stream)
+  return read_yaml(file)
+
+def compile_tables():
+  # Runs during the docker build so yaml parsing stays out of the cold start
+  script_path = str(pathlib.Path(__file__).parent.resolve())
+  for name in ("file_formats", "main_thumb"):
+    with open(f"{script_path}/{name}.json", "w", encoding="utf-8") as f:
+      json.dump(read_yaml(f"{script_path}/{name}.yml"), f)
+    print(f"Compiled {name}.yml")
+
 def download_file_to_disk(object_name):
   try: 
     start = time.time()
@@ -233,14 +708,15 @@ def export_error(error):
     "method": "local disk" if is_downloaded else "pipe",
     "error": f"{error}"
   }
-  output_file = "/tmp/error.json"
+  output_file = f"{work_dir}/error.json"
 
   with open(output_file, "w", encoding="utf-8") as f:
     json.dump(data, f, ensure_ascii=False, indent=4)
   upload_file(output_file, f"previews/{uuid_str}.asp-preview/error.json")
+  release_lease()
   raise Exception(error)
 
-def set_tags(provider, s3, new_tag):
+def set_tags(provider, s3, new_tags):
   try:
     if provider == "IBM":
       s3 = s3.meta.client
@@ -249,13 +725,14 @@ def set_tags(provider, s3, new_tag):
       Key=key
     )["TagSet"]
     tag_list = []
+    new_keys = [new_tag["Key"] for new_tag in new_tags]
 
     # used to avoid getting an error with repeated tags, useful in testing
     for tag in tags:
-      if tag["Key"] == new_tag["Key"]:
+      if tag["Key"] in new_keys:
         continue
       tag_list.append(tag)
-    tag_list.append(new_tag)
+    tag_list.extend(new_tags)
     s3.put_object_tagging(
       Bucket=bucket,
       Key=key,
@@ -263,19 +740,440 @@ def set_tags(provider, s3, new_tag):
         "TagSet": tag_list
       }
     )
-    print(f"Added tag {new_tag} to {key}")
+    print(f"Added tags {new_tags} to {key}")
   except Exception as e:
     print(e)
     error = f"Unable to set tag to file: {key}. Try again later or add it manually."
     export_error(e)
 
+def put_object(object_name, body=b""):
+  # Small objects are written straight from memory instead of going through a file in /tmp
+  try:
+    client = s3.meta.client if provider == "IBM" else s3
+    client.put_object(Bucket=bucket, Key=object_name, Body=body)
+    print(f"Put object: {object_name}")
+  except ClientError as e:
+    print(e)
+    export_error(e)
+
+def preview_settings(category, config):
+  # Everything that changes what the previews look like, so cached previews are only reused when they'd come out the same
+  if category != "video":
+    sizes = config.get("thumb_pdf_sizes" if category == "pdf" else "thumb_image_sizes") or [800]
+    return {"provider": provider, "category": category, "sizes": sorted(sizes, reverse=True)}
+  duration = int(os.environ.get('preview_duration')) if 'preview_duration' in os.environ and os.environ.get('preview_duration').isdigit() else default_preview_duration
+  if duration < 1:
+    print("Previews should be at least 1 second long")
+    duration = 1
+  settings = {
+    "provider": provider,
+    "category": category,
+    "duration": duration,
+    "audio": os.getenv('preview_audio', 'false').lower() in ['true'],
+    "offset": os.getenv('preview_offset', 'start').strip().lower(),
+    "encoder": video_encoder(),
+    # Tight runs encode with a smaller profile, those previews aren't reused by runs with room for the full one
+    "tight": resources["tight"],
+    "poster_sizes": config.get("thumb_video_sizes") or [320],
+    "poster_mode": config.get("poster_mode", "first"),
+    "poster_candidates": config.get("poster_candidates", 5)
+  }
+  if config.get("storyboard", False):
+    settings["storyboard"] = [config.get(name) for name in ("storyboard_frames", "storyboard_columns", "storyboard_width", "storyboard_format")]
+  return settings
+
+def source_identity(etag, size):
+  # Multipart ETags depend on the part size, a full object checksum matches more copies of the same content
+  checksum = None
+  if etag and cache.is_multipart_etag(etag):
+    try:
+      client = s3.meta.client if provider == "IBM" else s3
+      checksum = cache.object_checksum(client.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED"))
+    except Exception as e:
+      print(e)
+  return cache.content_identity(etag, size, checksum)
+
+def get_cache_entry(cache_key):
+  try:
+    client = s3.meta.client if provider == "IBM" else s3
+    entry = cache.parse_entry(client.get_object(Bucket=bucket, Key=cache_key)["Body"].read())
+  except Exception as e:
+    print(f"No cached preview at {cache_key}: {e}")
+    return None
+  return entry
+
+def copy_cached_preview(entry, preview_path):
+  """Server-side copy of cached previews under a new prefix, nothing is downloaded or encoded
+
+  :param entry: Cache index entry with the preview prefix and its objects
+  :param preview_path: Prefix of the new preview
+  :return: The copied object names, or None when the cached previews can't be copied anymore
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  start = time.time()
+  client = s3.meta.client if provider == "IBM" else s3
+  def copy(name):
+    client.copy_object(Bucket=bucket, Key=f"{preview_path}/{name}",
+      CopySource={"Bucket": bucket, "Key": f"{entry['preview_path']}/{name}"})
+    return f"{preview_path}/{name}"
+  try:
+    with ThreadPoolExecutor(max_workers=publish_workers) as executor:
+      object_names = list(executor.map(copy, entry["objects"]))
+  except Exception as e:
+    print(f"Unable to reuse the previews from {entry['preview_path']}: {e}")
+    return None
+  end = time.time()
+  print(end - start, f"FINISHED COPYING CACHED PREVIEWS FROM {entry['preview_path']}")
+  return object_names
+
+def acquire_lease(version, context):
+  """Take the lease on this object version so duplicate events don't generate the same preview again
+
+  :param version: Version id or sequencer of the object from the event
+  :param context: Invocation context, its request id lets the retries of this event take the lease over
+  :return: Dict with the action to take, "run", "skip" or "resume", and the recorded lease
+  """
+  global lease
+  client = s3.meta.client if provider == "IBM" else s3
+  store = idempotency.S3LeaseStore(client, bucket)
+  name = idempotency.lease_key(bucket, key, version)
+  request = getattr(context, "aws_request_id", None)
+  now = time.time()
+  try:
+    decision = idempotency.acquire(store, name, uuid_str, idempotency.lease_ttl, now, request)
+  except Exception as e:
+    # Storage without conditional writes shouldn't stop previews from being made
+    print(f"Unable to take the lease, processing without it: {e}")
+    return {"action": "run", "lease": None}
+  if decision["action"] == "run":
+    lease = {"store": store, "name": name, "etag": decision["etag"], "expires": now + idempotency.lease_ttl,
+      "owner": uuid_str, "request": request, "state": "in_progress"}
+    threading.Thread(target=lease_heartbeat, args=(uuid_str,), daemon=True).start()
+  elif decision["action"] == "resume":
+    lease = {"store": store, "name": name, "etag": decision["etag"], "expires": decision["lease"]["expires"],
+      "owner": uuid_str, "request": request, "state": "uploaded"}
+  print(f"Lease {name}: {decision['action']}")
+  return decision
+
+def renew_lease(owner):
+  # Returns False once there's nothing left to renew, which stops the heartbeat
+  global lease
+  with lease_lock:
+    if lease is None or lease["owner"] != owner or lease["state"] != "in_progress":
+      return False
+    expires = time.time() + idempotency.lease_ttl
+    etag = idempotency.record(lease["store"], lease["name"], lease["etag"], "in_progress", owner, expires, None, lease["request"])
+    lease = dict(lease, etag=etag, expires=expires) if etag else None
+    return etag is not None
+
+def lease_heartbeat(owner):
+  # A short lease that's renewed while the preview is generated, a timeout or crash stops renewing it
+  while True:
+    time.sleep(idempotency.heartbeat_interval)
+    try:
+      if not renew_lease(owner):
+        return
+    except Exception as e:
+      print(f"Unable to renew the lease: {e}")
+
+def record_lease(state, preview_path=None):
+  global lease
+  with lease_lock:
+    if lease is None:
+      return
+    etag = idempotency.record(lease["store"], lease["name"], lease["etag"], state, lease["owner"], lease["expires"], preview_path, lease["request"])
+    lease = dict(lease, etag=etag, state=state) if etag and state != "done" else None
+
+def release_lease():
+  # Lets the retry of a failed invocation start right away instead of waiting for the lease to expire
+  global lease
+  with lease_lock:
+    if lease is None:
+      return
+    if lease["state"] == "uploaded":
+      # Everything is uploaded, the retry only has to set the tags
+      lease = None
+      return
+    try:
+      lease["store"].delete(lease["name"], lease["etag"])
+    except idempotency.LeaseTaken:
+      print(f"Lease {lease['name']} was taken over by another invocation, leaving it")
+    except Exception as e:
+      print(e)
+    lease = None
+
+def preview_tags(preview_path):
+  return [
+    {"Key": "previews", "Value": "true"}, # Used as a flag in previews-checker
+    {"Key": "previews-location", "Value": f"{preview_path}/"} # Defines the location of the preview
+  ]
+
+def publish(artifacts, objects, markers, tags, on_uploaded=None):
+  """Upload every artifact of a preview concurrently, then write the markers and tag the source file
+
+  :param artifacts: List of (file_name, object_name) tuples uploaded from /tmp
+  :param objects: List of (object_name, body) tuples written from memory along with the artifacts
+  :param markers: List of (object_name, body) tuples written once every artifact is uploaded
+  :param tags: Tags applied to the source file in a single read-modify-write
+  :param on_uploaded: Called once everything is uploaded, before the tags are set
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  start = time.time()
+  # Boto3 clients are thread safe, so every worker shares the one cached for this container
+  with ThreadPoolExecutor(max_workers=publish_workers) as executor:
+    futures = [executor.submit(upload_file, file_name, object_name) for file_name, object_name in artifacts]
+    futures += [executor.submit(put_object, object_name, body) for object_name, body in objects]
+    for future in futures:
+      future.result()
+    # previews-checker skips a file once its .asp-location marker exists, so the markers wait for the artifacts
+    for future in [executor.submit(put_object, object_name, body) for object_name, body in markers]:
+      future.result()
+  if on_uploaded is not None:
+    on_uploaded()
+  # Tags go last since previews-checker takes them as proof that the preview exists
+  set_tags(provider, s3, tags)
+  end = time.time()
+  print(end - start, "FINISHED PUBLISHING PREVIEW")
+
 def check_output(preview_file_name, lib):
-  if os.system(f"test -e {preview_file_name}") != 0:
+  if not os.path.exists(preview_file_name):
     error = f"Couldn't generate preview with file '{preview_file_name}', something went wrong with {lib}."
     export_error(error)
 
+def probe_encoders():
+  # A single `ffmpeg -encoders` run instead of one shell pipeline per encoder on every clip
+  try:
+    output = sp.run(["/function/bin/ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True).stdout
+  except OSError as e:
+    print(e)
+    output = ""
+  available = set()
+  for line in output.splitlines():
+    fields = line.split()
+    if len(fields) > 1 and fields[0][0] in "VAS" and fields[1] != "=":
+      available.add(fields[1])
+  # ffmpeg lists every encoder it was built with, the shared library tells which one was installed
+  libraries = os.listdir("/usr/local/lib") if os.path.isdir("/usr/local/lib") else []
+  encoders = {}
+  for encoder, library in encoder_libraries.items():
+    built = not available or encoder in available
+    encoders[encoder] = built and any(name.startswith(library) for name in libraries)
+  encoders["libvpx-vp9"] = not available or "libvpx-vp9" in available
+  print("Encoders", encoders)
+  return encoders
+
+def video_encoder():
+  encoders = get_runtime()["encoders"]
+  for encoder in encoder_libraries:
+    if encoders[encoder]:
+      return encoder
+  return "libvpx-vp9"
+
+def get_runtime():
+  global runtime
+  if runtime is None:
+    start = time.time()
+    script_path = str(pathlib.Path(__file__).parent.resolve())
+    formats = read_table(f"{script_path}/file_formats.yml")
+    runtime = {
+      "config": read_table(f"{script_path}/main_thumb.yml"),
+      "formats": formats,
+      "extensions": {category: tuple(ext.lower() for ext in formats[category]) for category in ("video", "pdf", "image")},
+      "decode_hints": {ext.lower(): hint["args"] for hint in formats.get("decode_hints", []) for ext in hint["extensions"]},
+      "embedded_previews": {ext.lower(): entry["container"] for entry in formats.get("embedded_previews", []) for ext in entry["extensions"]},
+      "cpu_cores": len(os.sched_getaffinity(0)),
+      "encoders": probe_encoders(),
+      "clients": {}
+    }
+    end = time.time()
+    print(end - start, "FINISHED BUILDING RUNTIME CONTEXT")
+  return runtime
+
+def reset_runtime():
+  # Used by tests to drop cached configs, clients and encoder probes
+  global runtime
+  runtime = None
+
+def load_provider_sdk(provider):
+  global boto3
+  global ibm_boto3
+  global ClientError
+  global Config
+  start = time.time()
+  if provider == "AWS":
+    import boto3  # For some reason can't find boto3 when using IBM Functions even though it works just fine in AWS
+    from botocore.exceptions import ClientError
+    from botocore.client import Config
+  elif provider == "IBM":
+    import ibm_boto3
+    from ibm_botocore.client import ClientError, Config
+  end = time.time()
+  print(end - start, f"FINISHED IMPORTING {provider} SDK")
+
+def parse_import_times(output):
+  # Lines from `python -X importtime` look like: "import time:   self [us] |  cumulative | package"
+  import_times = []
+  for line in output.splitlines():
+    if not line.startswith("import time:"):
+      continue
+    fields = line[len("import time:"):].split("|")
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+      continue
+    import_times.append({
+      "module": fields[2].strip(),
+      "self_us": int(fields[0]),
+      "cumulative_us": int(fields[1]),
+      "top_level": not fields[2].startswith("  ")
+    })
+  return import_times
+
+def profile_imports(provider, top=20):
+  # Reruns the cold imports in a fresh interpreter since this one already has them cached
+  script_path = str(pathlib.Path(__file__).parent.resolve())
+  code = f"import main__; main__.load_provider_sdk('{provider}'); main__.read_table('{script_path}/file_formats.yml')"
+  result = sp.run([sys.executable, "-X", "importtime", "-c", code], cwd=script_path, capture_output=True, text=True)
+  import_times = parse_import_times(result.stderr)
+  total = sum(import_time["self_us"] for import_time in import_times)
+  print(f"IMPORT TIME REPORT ({provider}): {total / 1000:.1f} ms over {len(import_times)} modules")
+  top_level = [import_time for import_time in import_times if import_time["top_level"]]
+  for import_time in sorted(top_level, key=lambda x: x["cumulative_us"], reverse=True)[:top]:
+    print(f"{import_time['cumulative_us'] / 1000:10.1f} ms  {import_time['module']}")
+  return import_times
+
+def decode_hint(file_name, size):
+  # Codec specific shrink-on-load options for ImageMagick, empty when the format doesn't support it
+  hint = get_runtime()["decode_hints"].get(os.path.splitext(file_name)[1].lower(), "")
+  return hint.format(width=size * 2, height=size * 2)
+
+def embedded_container(file_name):
+  # Container type to look for an embedded JPEG preview in, None when the format doesn't have one
+  return get_runtime()["embedded_previews"].get(os.path.splitext(file_name)[1].lower())
+
+def get_s3_client(provider, event):
+  if provider == "AWS" and boto3 is None or provider == "IBM" and ibm_boto3 is None:
+    load_provider_sdk(provider)
+  clients = get_runtime()["clients"]
+  if provider == "AWS":
+    client_key = ("AWS",)
+  else:
+    client_key = ("IBM", event["cosApiKey"], event["cosInstanceId"], event["endpoint"])
+  if client_key not in clients:
+    if provider == "AWS":
+      clients[client_key] = boto3.client("s3", config=Config(signature_version='s3v4', max_pool_connections=s3_max_pool_connections))
+    else:
+      clients[client_key] = ibm_boto3.resource("s3",
+        ibm_api_key_id = event["cosApiKey"],
+        ibm_service_instance_id = event["cosInstanceId"],
+        config = Config(signature_version="oauth", max_pool_connections=s3_max_pool_connections),
+        endpoint_url = "https://" + event["endpoint"]
+      )
+  return clients[client_key]
+
+def s3_records(records):
+  # SQS deliveries wrap whole S3 notifications in the body of each message
+  flattened = []
+  for record in records:
+    if "s3" in record:
+      flattened.append(record)
+    elif "body" in record:
+      flattened += s3_records(json.loads(record["body"]).get("Records", []))
+  return flattened
+
+def record_worker(record, context, share, directory, sender):
+  # Runs in a forked child, so the module globals of one record don't leak into another
+  global work_dir
+  global batch_share
+  work_dir = directory
+  batch_share = share
+  # The pooled connections of the parent's client came through the fork, they can't be shared with it
+  get_runtime()["clients"].clear()
+  os.makedirs(directory, exist_ok=True)
+  try:
+    result = main({"Records": [record]}, context)
+  except Exception as e:
+    result = {"statusCode": 500, "body": json.dumps(f"{e}")}
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  sender.send(result)
+  sender.close()
+
+def process_batch(event, context, concurrency):
+  """Generate the previews of every record in the event
+
+  Each record runs in a child forked from this warm container, so they share the loaded SDK
+  and the runtime tables, and at most concurrency of them run at the same time. Every child
+  creates its own S3 client.
+  A single record at a time runs in this process instead.
+
+  :param event: S3 notification with more than one record
+  :param context: Lambda context, passed on to every record
+  :param concurrency: Records processed at the same time
+  :return: Response with the result of every record, in the order of the records
+  """
+  start = time.time()
+  records = event["Records"]
+  workers = max(1, min(concurrency, len(records)))
+  results = [None] * len(records)
+  if workers == 1:
+    for index, record in enumerate(records):
+      try:
+        results[index] = main({"Records": [record]}, context)
+      except Exception as e:
+        results[index] = {"statusCode": 500, "body": json.dumps(f"{e}")}
+  else:
+    # Imported once here so the children don't each pay for it
+    if boto3 is None:
+      load_provider_sdk("AWS")
+    import multiprocessing
+    from multiprocessing import connection
+    fork = multiprocessing.get_context("fork")
+    pending = list(enumerate(records))
+    running = {}
+    while pending or running:
+      while pending and len(running) < workers:
+        index, record = pending.pop(0)
+        # Pipes instead of queues, Lambda has no /dev/shm for the semaphores they need
+        receiver, sender = fork.Pipe(duplex=False)
+        worker = fork.Process(target=record_worker, args=(record, context, workers, f"/tmp/record-{index}", sender))
+        worker.start()
+        sender.close()
+        running[receiver] = (worker, index)
+      for receiver in connection.wait(list(running)):
+        worker, index = running.pop(receiver)
+        try:
+          results[index] = receiver.recv()
+        except EOFError:
+          results[index] = {"statusCode": 500, "body": json.dumps("Record worker exited without a result")}
+        receiver.close()
+        worker.join()
+  end = time.time()
+  failed = [records[index]["s3"]["object"]["key"] for index, result in enumerate(results) if result["statusCode"] != 200]
+  print(end - start, f"FINISHED BATCH OF {len(records)} RECORDS, {len(failed)} FAILED")
+  if failed:
+    # The whole event is retried, the records that succeeded are skipped through their leases
+    raise Exception(f"Unable to generate previews for {failed}")
+  return {
+    "statusCode": 200,
+    "body": json.dumps("Hello from Lambda!"),
+    "results": results
+  }
+
 def main(event, context=""):
   print("Received event: " + json.dumps(event, indent=2))
+  if os.environ.get("LAMBDA_TASK_ROOT") and "Records" in event:
+    event = {"Records": s3_records(event["Records"])}
+    if len(event["Records"]) > 1:
+      return process_batch(event, context, get_runtime()["config"].get("batch_concurrency", 2))
+  global lease
+  lease = None
+  try:
+    return generate_preview(event, context)
+  except BaseException:
+    # Not every failure goes through export_error, the retry must not find the lease still held
+    release_lease()
+    raise
+
+def generate_preview(event, context):
   global key
   global is_downloaded
   global s3
@@ -283,36 +1181,42 @@ def main(event, context=""):
   global provider
   global uuid_str
   global cpu_cores
+  global resources
+  global encode_profile
 
-  cpu_cores = int(os.popen("nproc").read())
-  script_path = str(pathlib.Path(__file__).parent.resolve())
-  config = read_yaml(f"{script_path}/main_thumb.yml")
-  overhead = (1 << 20) * 150
+  runtime_context = get_runtime()
+  cpu_cores = max(1, runtime_context["cpu_cores"] // batch_share)
+  config = runtime_context["config"]
   uuid_str = str(uuid.uuid4())
 
   if os.environ.get("LAMBDA_TASK_ROOT"):
-    s3 = boto3.client("s3", config=Config(signature_version='s3v4'))
     provider = "AWS"
+    s3 = get_s3_client(provider, event)
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     key = urllib.parse.unquote_plus(event["Records"][0]["s3"]["object"]["key"], encoding="utf-8")
-    max_disk_size = int(os.popen("df /tmp | awk 'NR > 1 {print $4}'").read()) // 1024 # Gets available disk size in MB from /tmp partition
-    max_mem_size = int(os.environ["AWS_LAMBDA_FUNCTION_MEMORY_SIZE"])
+    disk_mb = governor.tmp_free_mb() // batch_share
+    memory_mb = int(os.environ["AWS_LAMBDA_FUNCTION_MEMORY_SIZE"]) // batch_share
     content_length = event["Records"][0]["s3"]["object"]["size"]
+    version = event["Records"][0]["s3"]["object"].get("versionId") or event["Records"][0]["s3"]["object"].get("sequencer")
+    etag = event["Records"][0]["s3"]["object"].get("eTag")
     url = create_presigned_url_aws()
+    streaming = False
 
   else: # Later on need to check for specific ENV variable in IBM Cloud Functions
-    s3 = ibm_boto3.resource("s3",
-      ibm_api_key_id = event["cosApiKey"],
-      ibm_service_instance_id = event["cosInstanceId"],
-      config = Config(signature_version="oauth"),
-      endpoint_url = "https://" + event["endpoint"]
-    )
     provider = "IBM"
+    s3 = get_s3_client(provider, event)
     bucket = event["bucket"]
     key = event["key"]
-    max_disk_size = config["ibm_max_disk"]
-    max_mem_size = config["ibm_max_memory"]
+    disk_mb = config["ibm_max_disk"]
+    memory_mb = config["ibm_max_memory"]
     content_length = event["notification"]["object_length"]
+    version = event["notification"].get("object_version") or event["notification"].get("request_id")
+    etag = event["notification"].get("object_etag")
+    url = None
+    streaming = config.get("ibm_streaming", False)
+  if os.getenv('profile_imports', 'false').lower() in ['true'] and "imports_profiled" not in runtime_context:
+    profile_imports(provider)
+    runtime_context["imports_profiled"] = True
   if "previews" in key:
     print("Stopping lambda: Preview files are ignored")
     return {
@@ -321,97 +1225,193 @@ def main(event, context=""):
     }
 
   file_name = os.path.basename(key)
-  formats = read_yaml(f"{script_path}/file_formats.yml")
-  is_video = file_name.lower().endswith(tuple(formats["video"]))
-  is_pdf = file_name.lower().endswith(tuple(formats["pdf"]))
-  is_image = file_name.lower().endswith(tuple(formats["image"]))
+  extensions = runtime_context["extensions"]
+  is_video = file_name.lower().endswith(extensions["video"])
+  is_pdf = file_name.lower().endswith(extensions["pdf"])
+  is_image = file_name.lower().endswith(extensions["image"])
   if not is_pdf and not is_image and not is_video:
     error = "File extension not supported"
     export_error(error)
-  # gets size in GiB with a slight overhead to avoid reaching limits
-  max_mem_size = (max_mem_size << 20) // 2 - overhead
+  if config.get("idempotency", False) and version:
+    decision = acquire_lease(version, context)
+    if decision["action"] == "skip":
+      print("Stopping lambda: Preview is already being generated or done for this version")
+      return {
+        "statusCode": 200,
+        "body": json.dumps("Stopping lambda: Preview is already being generated or done for this version")
+      }
+    if decision["action"] == "resume":
+      # An earlier invocation uploaded everything and failed before tagging, so only the tags are left
+      preview_path = decision["lease"]["preview_path"]
+      set_tags(provider, s3, preview_tags(preview_path))
+      record_lease("done", preview_path)
+      return {
+        "statusCode": 200,
+        "body": json.dumps("Hello from Lambda!"),
+        "provider": f"{provider}",
+        "method": "resume"
+      }
+  # One plan for every tool, sized from what this function has and how much time is left
+  resources = governor.plan(memory_mb, disk_mb, cpu_cores, governor.remaining_seconds(context), int(content_length),
+    provider, streaming, config.get("tight_time_budget", 60))
+  os.environ.update(governor.imagemagick_environment(resources["imagemagick_limits"]))
+  max_mem_size = resources["max_mem_size"]
+  max_disk_size = resources["max_disk_size"]
   print("Max_mem_size", max_mem_size)
-  max_disk_size = (max_disk_size << 20) - overhead
   print("content_length", content_length)
+  print("Resources", resources["strategy"], resources["imagemagick_limits"], "tight" if resources["tight"] else "")
 
-  tmp_path = f"/tmp/{file_name}"
+  tmp_path = f"{work_dir}/{file_name}"
   shellsafe_file = quote(tmp_path)
-  path_file = "/tmp/path.txt"
+  preview_path = f"previews/{uuid_str}.asp-preview"
+  artifacts = []
+  extra_objects = []
+  streamed = False
+
+  settings = preview_settings("video" if is_video else "pdf" if is_pdf else "image", config)
+  identity = source_identity(etag, int(content_length)) if config.get("preview_cache", False) else None
+  cache_key = cache.index_key(identity, settings) if identity else None
+  cached_entry = get_cache_entry(cache_key) if cache_key else None
+  cached_objects = copy_cached_preview(cached_entry, preview_path) if cached_entry else None
 
   path_to_file = os.path.splitext(key)[0]
-  if is_video:
-    preview_duration = int(os.environ.get('preview_duration')) if 'preview_duration' in os.environ and os.environ.get('preview_duration').isdigit() else default_preview_duration
-    preview_audio = os.getenv('preview_audio', 'false').lower() in ['true']
-    if preview_duration < 1:
-      print("Previews should be at least 1 second long")
-      preview_duration = 1
-    preview_file_name = "/tmp/preview.mp4"
+  if cached_objects:
+    print(f"Reused the previews of {cached_entry['source']}, same content and settings")
+  elif is_video:
+    preview_duration = settings["duration"]
+    preview_audio = settings["audio"]
+    preview_offset = settings["offset"]
+    preview_file_name = f"{work_dir}/preview.mp4"
+    poster_sizes = settings["poster_sizes"]
     if provider == "IBM":
-      # Downloads a portion of the file just to check the moov atom
-      fileData = get_item((1<<20) * 20)
-      print(fileData.find(b"moov"), "MOOV")
-      # The moov atom should be at the very beginning of the file, starting at byte 32~, need more files to test this
-      if 0 < int(fileData.find(b"moov")) <= 200:
+      import mp4
+      # Reads the MP4/MOV box headers with a few small ranged reads to find where the moov atom is
+      video_info = mp4.probe(get_range, int(content_length)) if int(content_length) > 0 else None
+      stream = None
+      if video_info:
+        print("MOOV", video_info["placement"], video_info["tracks"])
+      encode_profile = profiles.select_profile(profiles.container_source(video_info), resources["tight"])
+      print("Encode profile", encode_profile)
+      if video_info and video_info["placement"] == "head":
+        stream = open_item() if resources["strategy"] == "stream" else None
+      elif video_info and video_info["placement"] == "tail" and resources["strategy"] == "stream":
+        # Moves the moov atom to the front while streaming, the same way qt-faststart does
+        stream = mp4.faststart_stream(video_info, get_range, open_range, int(content_length))
+      if stream is not None or video_info and video_info["placement"] == "head":
         is_downloaded = False
       elif int(content_length) <= max_disk_size:
         download_file_to_disk(tmp_path)
-        fileData = ""
         is_downloaded = True
       else:
         error = "File size is too big, please change the 'moov atom' of the file to the beginning"
         export_error(error)
 
-      duration = get_video_duration(shellsafe_file, True) if is_downloaded else get_video_duration(fileData, False)
+      if is_downloaded:
+        duration = get_video_duration(shellsafe_file, True)
+      else:
+        duration = video_info["duration"] or get_video_duration(get_item((1<<20) * 20), False)
       print("video_duration", duration)
       start_clip = time.time()
       if is_downloaded:
-        generate_clip(shellsafe_file, preview_file_name, True, duration, config["preview_duration"])
+        generate_clip(shellsafe_file, preview_file_name, True, duration, preview_duration)
+      elif stream is not None:
+        # The whole object goes through the pipe, so there's no need to clip the duration to what fits in memory
+        generate_clip(key, preview_file_name, False, duration, preview_duration, stream=stream)
       else:
         clipped_duration = max_mem_size / int(content_length)
         clipped_duration = 1 if clipped_duration > 1 else clipped_duration
         clipped_duration = math.floor(clipped_duration * duration)
         print("Clipped_duration", clipped_duration)
-        generate_clip(key, preview_file_name, False, clipped_duration, config["preview_duration"],  max_mem_size)
+        generate_clip(key, preview_file_name, False, clipped_duration, preview_duration, max_mem_size)
       end_clip = time.time()
       print(end_clip- start_clip, "FINISHED CREATING A CLIP")
     elif provider == "AWS":
-      generate_clipv2(url, preview_file_name, preview_duration, preview_audio)
+      poster_mode = config.get("poster_mode", "first")
+      # Probed once here since the profile, offset, poster candidates and storyboard all need it
+      source = probe_video(url)
+      encode_profile = profiles.select_profile(source, resources["tight"])
+      print("Encode profile", encode_profile)
+      video_duration = source["duration"]
+      if video_duration is None and (poster_mode == "smart" or config.get("storyboard", False)):
+        video_duration = get_video_duration(quote(url), True)
+      time_offset = get_clip_offset(url, preview_offset, preview_duration, video_duration)
+      poster_times = poster_times_for(video_duration, config.get("poster_candidates", 5)) if poster_mode == "smart" else ()
+      segments = chunked_segments(video_encoder(), preview_duration, config)
+      if os.getenv('preview_benchmark', 'false').lower() in ['true']:
+        benchmark_clip(url, preview_duration, preview_audio, poster_sizes, time_offset, segments)
+      # Chunked encoding writes its segments to /tmp anyway, so it always goes through the usual upload
+      streamed = config.get("stream_upload", False) and segments == 1
+      if segments > 1:
+        generate_clip_chunked(url, preview_file_name, preview_duration, preview_audio, poster_sizes, time_offset, segments, poster_times)
+      elif streamed:
+        generate_clip_streamed(url, f"{preview_path}/preview.mp4", preview_duration, preview_audio, poster_sizes, time_offset, poster_times)
+      else:
+        generate_clipv2(url, preview_file_name, preview_duration, preview_audio, poster_sizes, time_offset, poster_times)
+      if poster_times:
+        select_poster(poster_times, poster_sizes)
 
-    check_output(f"{preview_file_name}", "ffmpeg")
-    check_output(f"/tmp/thumb.jpg", "ffmpeg")
-    upload_file(preview_file_name, f"previews/{uuid_str}.asp-preview/preview.mp4")
-    upload_file("/tmp/thumb.jpg", f"previews/{uuid_str}.asp-preview/preview.png")
+    if not streamed:
+      check_output(f"{preview_file_name}", "ffmpeg")
+      artifacts.append((preview_file_name, f"{preview_path}/preview.mp4"))
+    check_output(f"{work_dir}/thumb.jpg", "ffmpeg")
+    artifacts.append((f"{work_dir}/thumb.jpg", f"{preview_path}/preview.png"))
+    if provider == "AWS":
+      for size in poster_sizes[1:]:
+        check_output(poster_output(size, poster_sizes), "ffmpeg")
+        artifacts.append((poster_output(size, poster_sizes), f"{preview_path}/preview-{size}.png"))
+      if config.get("storyboard", False):
+        import storyboard
+        sprite_file_name = f"{work_dir}/storyboard.{config.get('storyboard_format', 'jpg')}"
+        vtt = storyboard.generate_storyboard(url, video_duration, config.get("storyboard_frames", 40),
+          config.get("storyboard_columns", 8), config.get("storyboard_width", 160), sprite_file_name)
+        check_output(sprite_file_name, "ffmpeg")
+        artifacts.append((sprite_file_name, f"{preview_path}/{os.path.basename(sprite_file_name)}"))
+        extra_objects.append((f"{preview_path}/storyboard.vtt", vtt.encode()))
     # upload_file(s3, preview_file_name, bucket, provider, f"{path_to_file}-previews-{timestamp}-{rnumber}.mp4")
   else:
-    preview_file_name = "/tmp/thumbnail.png"
-    if provider == "IBM":
-      if int(content_length) <= max_mem_size:
-        fileData = get_item(max_mem_size)
-        is_downloaded = False
-      elif int(content_length) <= max_disk_size:
-        download_file_to_disk(tmp_path)
-        is_downloaded = True
-      else:
-        error = "File size is too big, please consider increasing memory/disk limits"
-        export_error(error)
+    preview_file_name = f"{work_dir}/thumbnail.png"
+    thumb_sizes = settings["sizes"]
+    is_downloaded = False
+    category = "pdf" if is_pdf else "image"
+    job = {
+      "category": category,
+      "file_name": file_name,
+      "extension": os.path.splitext(file_name)[1].lower(),
+      "content_length": int(content_length),
+      "url": url,
+      "output": preview_file_name,
+      "sizes": thumb_sizes,
+      "outputs": [thumb_output(preview_file_name, size, thumb_sizes) for size in thumb_sizes],
+      "read": lambda: get_item(int(content_length)),
+      "max_in_process_size": min((config.get("in_process_max_size") or 25) << 20, max_mem_size),
+      "strategy": resources["strategy"],
+      "max_mem_size": max_mem_size,
+      "max_disk_size": max_disk_size,
+      "tmp_path": tmp_path,
+      "shellsafe_file": shellsafe_file
+    }
+    rendered = renderers.render(job)
+    if rendered is None:
+      error = f"No renderer available for {job['extension']} files"
+      export_error(error)
+    renderer, rendered_sizes = rendered
+    for size in rendered_sizes:
+      check_output(thumb_output(preview_file_name, size, thumb_sizes), renderer)
+      name = "preview.png" if size == thumb_sizes[0] else f"preview-{size}.png"
+      artifacts.append((thumb_output(preview_file_name, size, thumb_sizes), f"{preview_path}/{name}"))
 
-      if is_pdf:
-        pdf_thumb(shellsafe_file, preview_file_name) if is_downloaded else pdf_thumb(fileData, file_name)
-      elif is_image:
-        image_thumb(shellsafe_file, preview_file_name) if is_downloaded else image_thumb(fileData, file_name)
-    elif provider == "AWS":
-      if is_pdf:
-        pdf_thumbv2(url, preview_file_name)
-      elif is_image:
-        image_thumbv2(url, preview_file_name)
-    check_output(f"{preview_file_name}", "ImageMagick")
-    upload_file(preview_file_name, f"previews/{uuid_str}.asp-preview/preview.png")
-
-  write_file(path_file, key.encode())
-  set_tags(provider, s3, {"Key": "previews", "Value": "true"}) # Used as a flag in previews-checker
-  set_tags(provider, s3, {"Key": "previews-location", "Value": f"previews/{uuid_str}.asp-preview/"}) # Defines the location of the preview
-  upload_file(path_file, f"previews/{uuid_str}.asp-preview/preview-path.txt")
-  s3.put_object(Bucket=bucket, Key=f"previews/{uuid_str}.asp-preview/{key}.asp-location") # Useful to know the name of original file
+  markers = [
+    (f"{preview_path}/preview-path.txt", key.encode()),
+    (f"{preview_path}/{key}.asp-location", b"") # Useful to know the name of original file
+  ]
+  tags = preview_tags(preview_path)
+  publish(artifacts, extra_objects, markers, tags, lambda: record_lease("uploaded", preview_path))
+  record_lease("done", preview_path)
+  if cache_key and not cached_objects:
+    # Only indexed once everything is uploaded, so a hit never points at a partial preview
+    object_names = [object_name for _, object_name in artifacts] + [object_name for object_name, _ in extra_objects]
+    object_names += [f"{preview_path}/preview.mp4"] if streamed else []
+    put_object(cache_key, cache.index_entry(preview_path, object_names, key))
 
   if is_downloaded:
     start = time.time()
@@ -424,5 +1424,5 @@ def main(event, context=""):
     "statusCode": 200,
     "body": json.dumps("Hello from Lambda!"),
     "provider": f"{provider}",
-    "method": "local disk" if is_downloaded else "pipe"
+    "method": "cache" if cached_objects else "local disk" if is_downloaded else "pipe"
   }
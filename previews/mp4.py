@@ -0,0 +1,197 @@
+import io
+import struct
+
+# Boxes that only hold other boxes, walked to reach the track headers and sample tables
+container_boxes = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"}
+# Any of these can start an ISO-BMFF (MP4/MOV) file, otherwise it isn't worth looking for a moov atom
+first_boxes = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot"}
+head_read_size = 1 << 16 # Usually covers ftyp and the start of moov in a single request
+max_top_level_boxes = 64
+
+def parse_box_header(data, offset):
+  # Returns (type, size, header_size) or None when the header doesn't fit in data
+  if len(data) - offset < 8:
+    return None
+  size, box_type = struct.unpack_from(">I4s", data, offset)
+  header_size = 8
+  if size == 1:
+    if len(data) - offset < 16:
+      return None
+    size = struct.unpack_from(">Q", data, offset + 8)[0]
+    header_size = 16
+  return box_type, size, header_size
+
+def read_top_level_boxes(read_range, file_size):
+  """Walk the top level box headers of an ISO-BMFF file with a few small ranged reads
+
+  :param read_range: Function taking inclusive (start, end) byte offsets and returning bytes
+  :param file_size: Size of the whole object in bytes
+  :return: List of boxes as dicts, or None if it isn't an ISO-BMFF file
+  """
+  boxes = []
+  buffer_start = 0
+  buffer = read_range(0, min(head_read_size, file_size) - 1)
+  offset = 0
+  while offset < file_size and len(boxes) < max_top_level_boxes:
+    header = parse_box_header(buffer, offset - buffer_start)
+    if header is None:
+      buffer_start = offset
+      buffer = read_range(offset, min(offset + 15, file_size - 1))
+      header = parse_box_header(buffer, 0)
+      if header is None:
+        break
+    box_type, size, header_size = header
+    if size == 0: # The last box can extend to the end of the file
+      size = file_size - offset
+    if not boxes and box_type not in first_boxes:
+      return None
+    if size < header_size or offset + size > file_size or not box_type.isalnum():
+      print(f"Invalid box at offset {offset}, stopped walking the file")
+      break
+    boxes.append({"type": box_type.decode("latin-1"), "offset": offset, "size": size, "header_size": header_size})
+    offset += size
+  return boxes
+
+def iter_boxes(data, start, end):
+  offset = start
+  while offset + 8 <= end:
+    header = parse_box_header(data, offset)
+    if header is None: # A 64 bit size cut off by the end of the data
+      break
+    box_type, size, header_size = header
+    if size == 0:
+      size = end - offset
+    if size < header_size or offset + size > end:
+      break
+    yield box_type, offset, size, header_size
+    offset += size
+
+def walk_boxes(data, start, end):
+  # Depth first walk that descends into container boxes
+  for box_type, offset, size, header_size in iter_boxes(data, start, end):
+    yield box_type, offset, size, header_size
+    if box_type in container_boxes:
+      yield from walk_boxes(data, offset + header_size, offset + size)
+
+def parse_duration(data, offset):
+  # mvhd and mdhd share the same layout up to the duration
+  version = data[offset]
+  if version == 1:
+    timescale, duration = struct.unpack_from(">IQ", data, offset + 20)
+  else:
+    timescale, duration = struct.unpack_from(">II", data, offset + 12)
+  return duration / timescale if timescale else None
+
+def parse_trak(data, start, end):
+  track = {"handler": None, "codec": None, "width": None, "height": None, "duration": None}
+  for box_type, offset, size, header_size in walk_boxes(data, start, end):
+    body = offset + header_size
+    if box_type == b"tkhd" and size >= header_size + 8:
+      width, height = struct.unpack_from(">II", data, offset + size - 8)
+      track["width"], track["height"] = width >> 16, height >> 16 # 16.16 fixed point
+    elif box_type == b"hdlr":
+      track["handler"] = data[body + 8:body + 12].decode("latin-1")
+    elif box_type == b"mdhd":
+      track["duration"] = parse_duration(data, body)
+    elif box_type == b"stsd" and track["codec"] is None:
+      track["codec"] = data[body + 12:body + 16].decode("latin-1")
+  return track
+
+def parse_moov(moov_data):
+  info = {"duration": None, "tracks": []}
+  _, size, header_size = parse_box_header(moov_data, 0)
+  for box_type, offset, size, child_header_size in iter_boxes(moov_data, header_size, len(moov_data)):
+    if box_type == b"mvhd":
+      info["duration"] = parse_duration(moov_data, offset + child_header_size)
+    elif box_type == b"trak":
+      info["tracks"].append(parse_trak(moov_data, offset + child_header_size, offset + size))
+  return info
+
+def probe(read_range, file_size):
+  """Find where the moov atom is and read the duration and tracks from it
+
+  :param read_range: Function taking inclusive (start, end) byte offsets and returning bytes
+  :param file_size: Size of the whole object in bytes
+  :return: Dict with the boxes, moov placement ("head", "tail" or None), duration and tracks.
+    None if the file isn't ISO-BMFF.
+  """
+  boxes = read_top_level_boxes(read_range, file_size)
+  if not boxes:
+    return None
+  info = {"boxes": boxes, "moov": None, "placement": None, "moov_data": None, "duration": None, "tracks": []}
+  moov = next((box for box in boxes if box["type"] == "moov"), None)
+  mdat = next((box for box in boxes if box["type"] == "mdat"), None)
+  if moov is None:
+    return info
+  info["moov"] = moov
+  info["placement"] = "head" if mdat is None or moov["offset"] < mdat["offset"] else "tail"
+  info["moov_data"] = read_range(moov["offset"], moov["offset"] + moov["size"] - 1)
+  info.update(parse_moov(info["moov_data"]))
+  return info
+
+def shift_chunk_offsets(moov_data, shift):
+  # Same as qt-faststart: chunk offsets are absolute, so moving moov before mdat moves every chunk
+  moov_data = bytearray(moov_data)
+  _, size, header_size = parse_box_header(moov_data, 0)
+  for box_type, offset, size, child_header_size in walk_boxes(moov_data, header_size, len(moov_data)):
+    body = offset + child_header_size
+    if box_type not in (b"stco", b"co64"):
+      continue
+    entry_count = struct.unpack_from(">I", moov_data, body + 4)[0]
+    entry_format = ">I" if box_type == b"stco" else ">Q"
+    entry_size = struct.calcsize(entry_format)
+    for entry in range(entry_count):
+      position = body + 8 + entry * entry_size
+      value = struct.unpack_from(entry_format, moov_data, position)[0] + shift
+      if box_type == b"stco" and value > 0xFFFFFFFF:
+        return None # Would need to be rewritten as co64, not worth it for a preview
+      struct.pack_into(entry_format, moov_data, position, value)
+  return bytes(moov_data)
+
+class ChainedStream:
+  """Read-only file-like object over byte strings and functions that open a stream"""
+
+  def __init__(self, parts):
+    self.parts = list(parts)
+    self.current = None
+
+  def read(self, size=None):
+    while True:
+      if self.current is None:
+        if not self.parts:
+          return b""
+        part = self.parts.pop(0)
+        self.current = io.BytesIO(part) if isinstance(part, bytes) else part()
+      data = self.current.read(size)
+      if data:
+        return data
+      self.current.close()
+      self.current = None
+
+  def close(self):
+    if self.current is not None:
+      self.current.close()
+      self.current = None
+    self.parts = []
+
+def faststart_stream(info, read_range, open_range, file_size):
+  """Stream the file with moov moved to the front so it can be piped into ffmpeg
+
+  :param info: Result of probe() for a file with moov at the tail
+  :param read_range: Function taking inclusive (start, end) byte offsets and returning bytes
+  :param open_range: Function taking inclusive (start, end) byte offsets and returning a stream
+  :return: ChainedStream, or None if the chunk offsets can't be shifted
+  """
+  moov = info["moov"]
+  moov_data = shift_chunk_offsets(info["moov_data"], moov["size"])
+  if moov_data is None:
+    return None
+  first_box = info["boxes"][0]
+  head_end = first_box["size"] if first_box["type"] == "ftyp" else 0
+  moov_end = moov["offset"] + moov["size"]
+  parts = [read_range(0, head_end - 1)] if head_end else []
+  parts.append(moov_data)
+  parts.append(lambda: open_range(head_end, moov["offset"] - 1))
+  if moov_end < file_size:
+    parts.append(lambda: open_range(moov_end, file_size - 1))
+  return ChainedStream(parts)
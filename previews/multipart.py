@@ -0,0 +1,73 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+part_size = 8 << 20 # S3 needs at least 5 MiB for every part but the last one
+
+def read_part(stream, size):
+  # Pipes return whatever is available, so keep reading until the part is full or the stream ends
+  chunks = []
+  remaining = size
+  while remaining:
+    chunk = stream.read(remaining)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return b"".join(chunks)
+
+def upload_stream(client, bucket, key, stream, workers=4, size=part_size, check=None):
+  """Upload a stream with a multipart upload while it's still being written
+
+  At most workers + 1 parts are held in memory, reading blocks until a worker frees a slot,
+  which in turn makes the process writing into the pipe wait.
+
+  :param client: Low level S3 client, the IBM resource exposes it as meta.client
+  :param bucket: Bucket to upload to
+  :param key: Object name
+  :param stream: File-like object, usually the stdout of a child process
+  :param workers: Parts uploaded at the same time
+  :param size: Size of every part but the last one
+  :param check: Called once the stream ends and before completing, raising aborts the upload
+  :return: Number of bytes uploaded
+  """
+  start = time.time()
+  upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+  slots = threading.BoundedSemaphore(workers + 1)
+
+  def upload_part(number, data):
+    try:
+      response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+      return {"PartNumber": number, "ETag": response["ETag"]}
+    finally:
+      slots.release()
+
+  total = 0
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = []
+      while True:
+        slots.acquire()
+        data = read_part(stream, size)
+        if not data and futures:
+          slots.release()
+          break
+        futures.append(executor.submit(upload_part, len(futures) + 1, data))
+        total += len(data)
+        # Fails fast instead of encoding the rest of the clip when a part can't be uploaded
+        for future in futures:
+          if future.done() and future.exception():
+            raise future.exception()
+        if len(data) < size:
+          break
+      parts = [future.result() for future in futures]
+    if check is not None:
+      check()
+    client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+  except BaseException:
+    print(f"Aborting multipart upload of {key}")
+    client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    raise
+  end = time.time()
+  print(end - start, f"FINISHED STREAMING UPLOAD: {key}, {total} bytes in {len(parts)} parts")
+  return total
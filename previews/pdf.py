@@ -0,0 +1,134 @@
+import re
+
+gs = "gs"
+head_read_size = 1 << 16 # The linearization dictionary and the first page cross-reference section
+linearization_size = 1024 # The linearization dictionary has to start within the first 1024 bytes
+default_page_size = (612, 792) # US Letter in points, used when the first page doesn't give its size
+linearized_pattern = re.compile(rb"<<\s*/Linearized\s[^>]*>>")
+object_pattern = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+box_pattern = re.compile(rb"/(MediaBox|CropBox)\s*\[\s*([-\d.\s]+?)\s*\]")
+rotate_pattern = re.compile(rb"/Rotate\s+(-?\d+)")
+
+def dictionary_value(dictionary, name):
+  match = re.search(rb"/" + name + rb"\s+(\d+)", dictionary)
+  return int(match.group(1)) if match else None
+
+def parse_linearization(head, file_size):
+  """Read the linearization parameters of a PDF from the start of the file
+
+  :param head: First bytes of the file
+  :param file_size: Size of the whole object, a linearized file that was updated since doesn't match /L
+  :return: Dict with the first page object, the end of the first page section and the first page
+    cross-reference offset, or None if the file isn't linearized
+  """
+  match = linearized_pattern.search(head[:linearization_size])
+  if match is None:
+    return None
+  dictionary = match.group(0)
+  linearization = {
+    "length": dictionary_value(dictionary, b"L"),
+    "first_page_object": dictionary_value(dictionary, b"O"),
+    "first_page_end": dictionary_value(dictionary, b"E"),
+    "pages": dictionary_value(dictionary, b"N")
+  }
+  if None in linearization.values() or linearization["length"] != file_size:
+    return None
+  # The first page cross-reference section comes right after the linearization dictionary
+  end = head.find(b"endobj", match.end())
+  if end < 0:
+    return None
+  xref_offset = end + len(b"endobj")
+  while xref_offset < len(head) and head[xref_offset:xref_offset + 1].isspace():
+    xref_offset += 1
+  if head.startswith(b"xref", xref_offset):
+    trailer = head.find(b"trailer", xref_offset)
+    xref_end = head.find(b"startxref", trailer) if trailer >= 0 else -1
+    if xref_end < 0:
+      return None
+    xref_dictionary = (trailer, xref_end)
+  elif object_pattern.match(head, xref_offset):
+    xref_end = head.find(b"stream", xref_offset)
+    if xref_end < 0 or b"/XRef" not in head[xref_offset:xref_end]:
+      return None
+    xref_dictionary = (xref_offset, xref_end)
+  else:
+    return None
+  size = dictionary_value(head[xref_dictionary[0]:xref_dictionary[1]], b"Size")
+  if size is None or linearization["first_page_end"] <= xref_end:
+    return None
+  linearization.update({"xref_offset": xref_offset, "xref_dictionary": xref_dictionary, "size": size})
+  return linearization
+
+def page_size(data, object_number=None):
+  """Size of the first page in points, taking /Rotate into account
+
+  :param data: PDF bytes that hold the first page object
+  :param object_number: First page object from the linearization dictionary, otherwise the first box found is used
+  :return: Tuple of (width, height, uses_crop_box)
+  """
+  start, end = 0, len(data)
+  if object_number is not None:
+    match = re.search(rb"(?<!\d)" + str(object_number).encode() + rb"\s+0\s+obj\b", data)
+    if match:
+      start, end = match.end(), data.find(b"endobj", match.end())
+  page = data[start:end]
+  boxes = {match.group(1): match.group(2).split() for match in box_pattern.finditer(page)}
+  box = boxes.get(b"CropBox") or boxes.get(b"MediaBox")
+  if box is None or len(box) != 4:
+    return default_page_size + (False,)
+  left, bottom, right, top = (float(value) for value in box)
+  width, height = abs(right - left), abs(top - bottom)
+  rotate = rotate_pattern.search(page)
+  if rotate and int(rotate.group(1)) % 180:
+    width, height = height, width
+  if not width or not height:
+    return default_page_size + (False,)
+  return width, height, b"CropBox" in boxes
+
+def render_dpi(page_height, height):
+  # Rendering straight at the thumbnail height, instead of the default density and a rescale
+  return max(1, round(height * 72 / page_height, 2))
+
+def first_page_document(prefix, linearization):
+  """Turn the first page section of a linearized PDF into a document that only has the first page
+
+  Nothing is moved, so every offset in the original cross-reference section stays valid. The link to
+  the main cross-reference section is renamed to an unknown key of the same length, and an incremental
+  update adds a page tree with only the first page, since the original page tree is past the first page section.
+  """
+  document = bytearray(prefix)
+  start, end = linearization["xref_dictionary"]
+  prev = document.find(b"/Prev", start, end)
+  if prev >= 0:
+    document[prev:prev + 5] = b"/Xrev"
+  pages, catalog = linearization["size"], linearization["size"] + 1
+  document += b"\n"
+  pages_offset = len(document)
+  document += f"{pages} 0 obj\n<< /Type /Pages /Kids [{linearization['first_page_object']} 0 R] /Count 1 >>\nendobj\n".encode()
+  catalog_offset = len(document)
+  document += f"{catalog} 0 obj\n<< /Type /Catalog /Pages {pages} 0 R >>\nendobj\n".encode()
+  xref_offset = len(document)
+  document += (f"xref\n0 1\n0000000000 65535 f \n{pages} 2\n{pages_offset:010} 00000 n \n{catalog_offset:010} 00000 n \n"
+    f"trailer\n<< /Size {catalog + 1} /Root {catalog} 0 R /Prev {linearization['xref_offset']} >>\n"
+    f"startxref\n{xref_offset}\n%%EOF\n").encode()
+  return bytes(document)
+
+def probe(read_range, file_size):
+  """Read the start of a PDF to find out if the first page can be rendered without the rest of the file
+
+  :param read_range: Function taking inclusive (start, end) byte offsets and returning bytes
+  :param file_size: Size of the whole object in bytes
+  :return: Linearization parameters, or None if it isn't a linearized PDF
+  """
+  head = read_range(0, min(head_read_size, file_size) - 1)
+  if not head.startswith(b"%PDF-"):
+    return None
+  return parse_linearization(head, file_size)
+
+def render_command(source, output, dpi, use_crop_box=False):
+  # Only the first page, onto an opaque white background like the -flatten of the convert command
+  cmd = [gs, "-q", "-dSAFE", "-dBATCH", "-dNOPAUSE", "-dFirstPage=1", "-dLastPage=1",
+    "-sDEVICE=png16m", "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4", f"-r{dpi}"]
+  if use_crop_box:
+    cmd.append("-dUseCropBox")
+  return cmd + [f"-sOutputFile={output}", source]
@@ -0,0 +1,97 @@
+import json
+
+ffprobe = "/function/bin/ffprobe"
+# Long side x short side of the box a clip has to fit in, the tight one is used when time is running out
+full_box = (1280, 720)
+tight_box = (854, 480)
+max_fps = 24
+reference_bitrate = 1400 # kbps for 1280x720 at 24 fps, other sizes get the same bits per pixel
+min_bitrate = 250
+default_profile = {"width": 1280, "height": 720, "fps": max_fps, "bitrate": reference_bitrate}
+
+def probe_command(url):
+  # One ffprobe for everything the profile and the rest of the pipeline need about the source
+  return [ffprobe, "-v", "error", "-select_streams", "v:0",
+    "-show_entries", "stream=width,height,codec_name,avg_frame_rate,r_frame_rate:stream_tags=rotate:stream_side_data=rotation:format=duration",
+    "-of", "json", url]
+
+def parse_rate(rate):
+  # ffprobe gives frame rates as fractions like 30000/1001, 0/0 when it doesn't know
+  numerator, _, denominator = (rate or "").partition("/")
+  try:
+    value = float(numerator) / float(denominator or 1)
+  except (ValueError, ZeroDivisionError):
+    return None
+  return value if value > 0 else None
+
+def parse_probe(output):
+  """Read the source video properties from the ffprobe json output
+
+  :param output: Output of probe_command()
+  :return: Dict with the displayed width and height, fps, codec and duration, values ffprobe didn't give are None
+  """
+  try:
+    data = json.loads(output or "{}")
+  except ValueError:
+    data = {}
+  stream = (data.get("streams") or [{}])[0]
+  source = {
+    "width": stream.get("width"),
+    "height": stream.get("height"),
+    "fps": parse_rate(stream.get("avg_frame_rate")) or parse_rate(stream.get("r_frame_rate")),
+    "codec": stream.get("codec_name"),
+    "duration": None
+  }
+  try:
+    source["duration"] = float(data.get("format", {}).get("duration"))
+  except (TypeError, ValueError):
+    pass
+  rotation = stream.get("tags", {}).get("rotate")
+  for side_data in stream.get("side_data_list", []):
+    rotation = side_data.get("rotation", rotation)
+  # ffmpeg rotates the frames on decode, so the clip has the displayed orientation
+  try:
+    if rotation is not None and int(float(rotation)) % 180 and source["width"] and source["height"]:
+      source["width"], source["height"] = source["height"], source["width"]
+  except ValueError:
+    pass
+  return source
+
+def container_source(info):
+  # Same keys as parse_probe() from mp4.probe(), the MP4 headers have the size and codec but not the frame rate
+  for track in (info or {}).get("tracks", []):
+    if track["handler"] == "vide":
+      return {"width": track["width"], "height": track["height"], "fps": None, "codec": track["codec"], "duration": info["duration"]}
+  return {}
+
+def even(value):
+  return max(2, int(round(value / 2)) * 2)
+
+def select_profile(source, tight=False):
+  """Pick the output size, frame rate and bitrate of the clip for this source
+
+  Never upscales, keeps the aspect ratio of the source and fits it in a 1280x720 box in its own
+  orientation, or 854x480 when the time budget is tight.
+
+  :param source: Result of parse_probe() or the same keys from the container metadata
+  :param tight: Whether the invocation is running out of time
+  :return: Dict with width, height, fps and bitrate in kbps
+  """
+  long_side, short_side = tight_box if tight else full_box
+  width, height = source.get("width"), source.get("height")
+  if not width or not height:
+    width, height = (long_side, short_side)
+  box_width, box_height = (long_side, short_side) if width >= height else (short_side, long_side)
+  scale = min(1, box_width / width, box_height / height)
+  fps = min(max_fps, source.get("fps") or max_fps)
+  profile = {"width": even(width * scale), "height": even(height * scale), "fps": round(fps, 3)}
+  pixels_ratio = profile["width"] * profile["height"] / (full_box[0] * full_box[1])
+  profile["bitrate"] = max(min_bitrate, int(reference_bitrate * pixels_ratio * fps / max_fps))
+  return profile
+
+def filter_args(profile):
+  return f"fps={profile['fps']},scale={profile['width']}:{profile['height']}"
+
+def rate_args(profile):
+  # Capped VBR, short clips would otherwise spend most of their bits on the first keyframes
+  return f"-b:v {profile['bitrate']}k -maxrate {profile['bitrate'] * 3 // 2}k -bufsize {profile['bitrate'] * 2}k"
@@ -0,0 +1,100 @@
+import importlib.util
+import io
+import time
+
+# Formats the in-process backend decodes, anything else still goes through ImageMagick
+pillow_extensions = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+pillow_posterize_bits = 6 # Closest to the "-posterize 40" of the convert command without adding banding
+
+class Renderer:
+  """A backend that makes thumbnails for some of the file_formats.yml categories
+
+  The render function takes the job dict and returns the sizes it wrote, or an empty list
+  when it can't handle that particular file so the next cheapest renderer gets a chance.
+  """
+
+  def __init__(self, name, categories, cost, render, extensions=None, available=None):
+    self.name = name
+    self.categories = tuple(categories)
+    self.cost = cost
+    self.render = render
+    self.extensions = extensions
+    self.available = available
+    self.is_available = None
+
+  def supports(self, category, extension):
+    if category not in self.categories:
+      return False
+    if self.extensions is not None and extension not in self.extensions:
+      return False
+    if self.is_available is None:
+      # Only checked once per container, e.g. whether an optional module is installed
+      self.is_available = self.available is None or bool(self.available())
+    return self.is_available
+
+registry = []
+
+def register(name, categories, cost, extensions=None, available=None):
+  # Decorator that adds a render function to the registry
+  def decorator(render):
+    registry.append(Renderer(name, categories, cost, render, extensions, available))
+    return render
+  return decorator
+
+def candidates(category, extension):
+  # Cheapest first, the order of registration breaks ties
+  capable = [renderer for renderer in registry if renderer.supports(category, extension)]
+  return sorted(capable, key=lambda renderer: renderer.cost)
+
+def render(job):
+  """Render the thumbnails with the cheapest renderer that can handle the file
+
+  :param job: Dict with at least the category, extension, output and sizes of the thumbnails
+  :return: Tuple of the renderer name and the sizes it wrote, or None if no renderer could handle the file
+  """
+  for renderer in candidates(job["category"], job["extension"]):
+    start = time.time()
+    sizes = renderer.render(job)
+    end = time.time()
+    if sizes:
+      print(end - start, f"FINISHED RENDERING WITH {renderer.name}")
+      return renderer.name, sizes
+    print(end - start, f"Renderer {renderer.name} can't handle this file, trying the next one")
+  return None
+
+def pillow_available():
+  return importlib.util.find_spec("PIL") is not None
+
+def posterize(image, bits):
+  from PIL import Image, ImageOps
+  if image.mode in ("RGBA", "LA"):
+    *bands, alpha = image.split()
+    color = ImageOps.posterize(Image.merge(image.mode[:-1], bands), bits)
+    color.putalpha(alpha)
+    return color
+  return ImageOps.posterize(image, bits)
+
+@register("pillow", ["image"], cost=3, extensions=pillow_extensions, available=pillow_available)
+def pillow_thumb(job):
+  """Decode and resize common raster formats in process, without spawning convert
+
+  :param job: Needs read, content_length, max_in_process_size, sizes and outputs
+  :return: The sizes written, or an empty list for files that are too large or Pillow can't read
+  """
+  if job["content_length"] > job["max_in_process_size"]:
+    return []
+  from PIL import Image, ImageOps
+  try:
+    image = Image.open(io.BytesIO(job["read"]()))
+    # Shrink-on-load for JPEG, the same as the jpeg:size decode hint
+    image.draft("RGB", (job["sizes"][0] * 2, job["sizes"][0] * 2))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+      image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+    for size, output in zip(job["sizes"], job["outputs"]):
+      image.thumbnail((size, size))
+      posterize(image, pillow_posterize_bits).save(output, "PNG")
+  except (OSError, ValueError, Image.DecompressionBombError) as e:
+    print(f"Pillow can't render this file: {e}")
+    return []
+  return list(job["sizes"])
@@ -0,0 +1,64 @@
+import shlex
+import subprocess as sp
+import time
+
+ffmpeg = "/function/bin/ffmpeg"
+
+def frame_times(duration, frames):
+  # Evenly spaced, taken from the middle of each interval so the first tile isn't the usual black frame
+  interval = duration / frames
+  return [interval * (frame + 0.5) for frame in range(frames)]
+
+def tile_size(width):
+  height = width * 9 // 16
+  return width, height + height % 2
+
+def sprite_command(url, times, columns, width, output):
+  """Build the ffmpeg command that writes every tile of the sprite sheet in one process
+
+  Every frame gets its own input with an input-side seek and keyframe-only decoding,
+  so ffmpeg only fetches the byte ranges around each keyframe instead of the whole video.
+  """
+  tile_width, tile_height = tile_size(width)
+  rows = -(-len(times) // columns)
+  cmd = [ffmpeg, "-y", "-v", "error"]
+  graph = []
+  for index, seconds in enumerate(times):
+    cmd += ["-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{seconds:.3f}", "-i", url]
+    graph.append(f"[{index}:v]trim=end_frame=1,setpts=PTS-STARTPTS,"
+      f"scale={tile_width}:{tile_height}:force_original_aspect_ratio=decrease,"
+      f"pad={tile_width}:{tile_height}:(ow-iw)/2:(oh-ih)/2,setsar=1[tile{index}]")
+  inputs = "".join(f"[tile{index}]" for index in range(len(times)))
+  graph.append(f"{inputs}concat=n={len(times)}:v=1:a=0,tile={columns}x{rows}[sprite]")
+  cmd += ["-filter_complex", ";".join(graph), "-map", "[sprite]", "-frames:v", "1", output]
+  return cmd
+
+def format_timestamp(seconds):
+  hours, remainder = divmod(seconds, 3600)
+  minutes, seconds = divmod(remainder, 60)
+  return f"{int(hours):02}:{int(minutes):02}:{seconds:06.3f}"
+
+def webvtt(duration, frames, columns, width, sprite_name):
+  # Maps each time range to the tile that represents it with media fragment coordinates
+  tile_width, tile_height = tile_size(width)
+  interval = duration / frames
+  lines = ["WEBVTT", ""]
+  for frame in range(frames):
+    x = (frame % columns) * tile_width
+    y = (frame // columns) * tile_height
+    lines.append(f"{format_timestamp(frame * interval)} --> {format_timestamp(min((frame + 1) * interval, duration))}")
+    lines.append(f"{sprite_name}#xywh={x},{y},{tile_width},{tile_height}")
+    lines.append("")
+  return "\n".join(lines)
+
+def generate_storyboard(url, duration, frames, columns, width, output):
+  start = time.time()
+  # Very short videos don't have enough keyframes to fill every tile
+  frames = max(1, min(frames, int(duration)))
+  times = frame_times(duration, frames)
+  command = sprite_command(url, times, columns, width, output)
+  print("RUNNING FFMPEG STORYBOARD COMMAND: ", " ".join(shlex.quote(arg) for arg in command if arg != url)) # Printing command wihout presigned url
+  sp.run(command)
+  end = time.time()
+  print(end - start, " FINISHED GENERATING A STORYBOARD")
+  return webvtt(duration, frames, columns, width, output.rsplit("/", 1)[-1])
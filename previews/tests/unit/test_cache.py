@@ -0,0 +1,37 @@
+import json
+import unittest
+
+from cache import content_identity, index_entry, index_key, is_multipart_etag, object_checksum, parse_entry
+
+
+class PreviewCacheKeyTest(unittest.TestCase):
+
+    def test_identity(self):
+        self.assertEqual(content_identity('"abc"', 10), "etag:abc:10")
+        self.assertEqual(content_identity("abc-3", 10, "ChecksumSHA256:xyz"), "ChecksumSHA256:xyz:10")
+        self.assertIsNone(content_identity(None, 10))
+
+    def test_multipart_etag(self):
+        self.assertTrue(is_multipart_etag('"9b2cf535f27731c974343645a3985328-12"'))
+        self.assertFalse(is_multipart_etag("06a83081d2bb215"))
+
+    def test_object_checksum(self):
+        self.assertEqual(object_checksum({"ChecksumCRC32": "a", "ChecksumSHA256": "b"}), "ChecksumSHA256:b")
+        self.assertIsNone(object_checksum({"ChecksumCRC32": "a-4", "ChecksumType": "COMPOSITE"}))
+        self.assertIsNone(object_checksum({}))
+
+    # The same content with different settings must not share previews
+    def test_settings_change_key(self):
+        settings = {"category": "video", "duration": 15, "poster_sizes": [320]}
+        self.assertEqual(index_key("etag:abc:10", settings), index_key("etag:abc:10", dict(settings)))
+        self.assertNotEqual(index_key("etag:abc:10", settings), index_key("etag:abc:10", dict(settings, duration=30)))
+        self.assertNotEqual(index_key("etag:abc:10", settings), index_key("etag:abd:10", settings))
+        self.assertTrue(index_key("etag:abc:10", settings).startswith("previews/cache/"))
+
+    def test_entry_round_trip(self):
+        body = index_entry("previews/1.asp-preview", ["previews/1.asp-preview/preview.mp4", "previews/1.asp-preview/preview.png"], "a.mp4")
+        entry = parse_entry(body)
+        self.assertEqual(entry["objects"], ["preview.mp4", "preview.png"])
+        self.assertEqual(entry["source"], "a.mp4")
+        self.assertIsNone(parse_entry(b"not json"))
+        self.assertIsNone(parse_entry(json.dumps({"preview_path": "p", "objects": []})))
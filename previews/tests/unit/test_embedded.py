@@ -0,0 +1,149 @@
+import struct
+import unittest
+
+from embedded import extract_preview, jpeg_size
+
+def fake_jpeg(width, height, padding=64):
+    sof = b"\xff\xc0" + struct.pack(">HBHHB", 11, 8, height, width, 3) + b"\x00" * 3
+    return b"\xff\xd8" + sof + b"\x00" * padding + b"\xff\xd9"
+
+def ifd(entries, next_offset=0):
+    # entries are (tag, type, count, value) with values that fit in the entry
+    data = struct.pack("<H", len(entries))
+    for tag, field_type, count, value in entries:
+        packed = struct.pack("<HH", value, 0) if field_type == 3 else struct.pack("<I", value)
+        data += struct.pack("<HHI", tag, field_type, count) + packed
+    return data + struct.pack("<I", next_offset)
+
+def build_raw(preview, thumbnail, orientation=6):
+    # IFD0 has a small thumbnail and points at a SubIFD with the larger preview, like NEF and DNG
+    ifd0_offset = 8
+    ifd0_size = 2 + 4 * 12 + 4
+    sub_ifd_offset = ifd0_offset + ifd0_size
+    sub_ifd_size = 2 + 4 * 12 + 4
+    thumbnail_offset = sub_ifd_offset + sub_ifd_size
+    preview_offset = thumbnail_offset + len(thumbnail)
+    ifd0 = ifd([
+        (0x0112, 3, 1, orientation),
+        (0x014A, 4, 1, sub_ifd_offset),
+        (0x0201, 4, 1, thumbnail_offset),
+        (0x0202, 4, 1, len(thumbnail))
+    ])
+    sub_ifd = ifd([
+        (0x0103, 3, 1, 7),
+        (0x0106, 3, 1, 6),
+        (0x0111, 4, 1, preview_offset),
+        (0x0117, 4, 1, len(preview))
+    ])
+    return b"II*\x00" + struct.pack("<I", ifd0_offset) + ifd0 + sub_ifd + thumbnail + preview + b"\x00" * 4096
+
+def lossless_jpeg(width, height, padding=64):
+    # Raw sensor data stored as lossless (SOF3) JPEG, which libjpeg can't decode
+    sof = b"\xff\xc3" + struct.pack(">HBHHB", 11, 14, height, width, 2) + b"\x00" * 3
+    return b"\xff\xd8" + sof + b"\x00" * padding + b"\xff\xd9"
+
+def build_cr2(preview, raw, raw_photometric=None):
+    # IFD0 has the full size preview as a JPEG strip, the last IFD has the raw strip without a photometric tag
+    ifd0_offset = 8
+    ifd_size = 2 + 4 * 12 + 4
+    raw_ifd_offset = ifd0_offset + ifd_size
+    raw_entries = [(0x0103, 3, 1, 6)] + ([(0x0106, 3, 1, raw_photometric)] if raw_photometric else [])
+    preview_offset = raw_ifd_offset + 2 + (len(raw_entries) + 2) * 12 + 4
+    raw_offset = preview_offset + len(preview)
+    ifd0 = ifd([
+        (0x0103, 3, 1, 6),
+        (0x0106, 3, 1, 6),
+        (0x0111, 4, 1, preview_offset),
+        (0x0117, 4, 1, len(preview))
+    ], raw_ifd_offset)
+    raw_ifd = ifd(raw_entries + [
+        (0x0111, 4, 1, raw_offset),
+        (0x0117, 4, 1, len(raw))
+    ])
+    return b"II*\x00" + struct.pack("<I", ifd0_offset) + ifd0 + raw_ifd + preview + raw + b"\x00" * 4096
+
+def build_psd(thumbnail):
+    header = b"8BPS" + struct.pack(">H", 1) + b"\x00" * 6 + struct.pack(">HIIHH", 3, 1000, 1000, 8, 3)
+    resource_data = b"\x00" * 28 + thumbnail
+    resource = b"8BIM" + struct.pack(">H", 1036) + b"\x00\x00" + struct.pack(">I", len(resource_data)) + resource_data
+    resource += b"\x00" * (len(resource_data) % 2)
+    return header + struct.pack(">I", 0) + struct.pack(">I", len(resource)) + resource + b"\x00" * 100
+
+def build_raf(preview):
+    header = b"FUJIFILMCCD-RAW 0201FF383501".ljust(84, b"\x00")
+    return header + struct.pack(">II", 100, len(preview)) + b"\x00" * 8 + preview + b"\x00" * 100
+
+def reader(data):
+    reads = []
+    def read_range(start, end):
+        reads.append((start, end))
+        return data[start:end + 1]
+    return read_range, reads
+
+
+class EmbeddedPreviewTest(unittest.TestCase):
+
+    def test_jpeg_size(self):
+        self.assertEqual(jpeg_size(fake_jpeg(1620, 1080)), (1620, 1080))
+        self.assertIsNone(jpeg_size(b"\x89PNG\r\n\x1a\n"))
+        self.assertIsNone(jpeg_size(lossless_jpeg(2600, 3500)))
+
+    def test_largest_tiff_preview(self):
+        preview = fake_jpeg(1620, 1080, 70000)
+        data = build_raw(preview, fake_jpeg(160, 120))
+        read_range, reads = reader(data)
+        result = extract_preview(read_range, len(data), "tiff", 800)
+        self.assertEqual(result, (preview, "RightTop"))
+        # The head read covers the IFDs, then the preview itself is read
+        self.assertEqual(len(reads), 2)
+
+    def test_preview_too_small(self):
+        data = build_raw(fake_jpeg(640, 480), fake_jpeg(160, 120))
+        read_range, _ = reader(data)
+        self.assertIsNone(extract_preview(read_range, len(data), "tiff", 800))
+
+    def test_raw_sensor_data_is_skipped(self):
+        data = bytearray(build_raw(fake_jpeg(1620, 1080), fake_jpeg(160, 120)))
+        # Photometric interpretation of the SubIFD set to CFA, which is lossless JPEG sensor data
+        position = data.index(struct.pack("<HHI", 0x0106, 3, 1)) + 8
+        data[position:position + 2] = struct.pack("<H", 32803)
+        read_range, _ = reader(bytes(data))
+        self.assertIsNone(extract_preview(read_range, len(data), "tiff", 800))
+
+    # The raw strip of a CR2 is larger than the preview, but it's lossless JPEG with no photometric tag
+    def test_cr2_raw_strip_is_skipped(self):
+        preview = fake_jpeg(1620, 1080, 70000)
+        data = build_cr2(preview, lossless_jpeg(2600, 3500, 200000))
+        read_range, _ = reader(data)
+        self.assertEqual(extract_preview(read_range, len(data), "tiff", 800), (preview, "TopLeft"))
+
+    # Even when a candidate isn't JPEG data, the smaller ones are still tried
+    def test_undecodable_candidate_falls_through(self):
+        preview = fake_jpeg(1620, 1080, 70000)
+        # A YCbCr photometric on the raw strip, so only jpeg_size can reject it
+        data = build_cr2(preview, lossless_jpeg(2600, 3500, 200000), raw_photometric=6)
+        read_range, _ = reader(data)
+        self.assertEqual(extract_preview(read_range, len(data), "tiff", 800), (preview, "TopLeft"))
+
+    def test_psd_thumbnail(self):
+        thumbnail = fake_jpeg(160, 160)
+        data = build_psd(thumbnail)
+        read_range, _ = reader(data)
+        self.assertEqual(extract_preview(read_range, len(data), "psd", 96), (thumbnail, "TopLeft"))
+
+    def test_raf_preview(self):
+        preview = fake_jpeg(1920, 1280)
+        data = build_raf(preview)
+        read_range, _ = reader(data)
+        self.assertEqual(extract_preview(read_range, len(data), "raf", 800), (preview, "TopLeft"))
+
+    def test_not_a_container(self):
+        data = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+        read_range, _ = reader(data)
+        self.assertIsNone(extract_preview(read_range, len(data), "tiff", 800))
+        self.assertIsNone(extract_preview(read_range, len(data), "psd", 800))
+
+    def test_truncated_file(self):
+        data = build_raw(fake_jpeg(1620, 1080), fake_jpeg(160, 120))[:60]
+        read_range, _ = reader(data)
+        self.assertIsNone(extract_preview(read_range, len(data), "tiff", 800))
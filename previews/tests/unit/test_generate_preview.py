@@ -1,6 +1,13 @@
 import unittest
+import json
+import io
 import pathlib
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from unittest import mock
 from unittest.mock import patch
 
@@ -8,7 +15,9 @@ file_name = "vid.mpeg"
 
 # Setting the default AWS region environment variable required by the Python SDK boto3
 with mock.patch.dict('os.environ', {'AWS_REGION': 'us-west-2', 'LAMBDA_TASK_ROOT': 'true'}, clear=True):
-    from main__ import main
+    from main__ import main, get_clip_offset, get_runtime, reset_runtime, parse_import_times, run_piped, segment_boundaries, score_frame, poster_times_for
+    import main__
+    sdk_placeholder_error = main__.ClientError
 
 def mocked_get_item(max_mem_size):
     script_path = str(pathlib.Path(__file__).parent.parent.parent.parent.resolve())
@@ -25,14 +34,17 @@ def mocked_download_file_to_disk(object_name):
     os.system("ls /tmp/")
     return
 
-def mocked_set_tags(provider, s3):
+def mocked_set_tags(provider, s3, tags):
     print("TAGGED")
     return
 
+def mocked_put_object(object_name, body=b""):
+    return
+
 def mocked_upload_file(file_name, object_name=None):
     return
 
-def generate_clipv2(url, output, clip_duration, size):
+def generate_clipv2(url, output, clip_duration, size, poster_sizes=(320,), time_offset=0, poster_times=()):
     os.system("touch /tmp/preview.webm")
     return
 
@@ -62,6 +74,9 @@ def delete_files():
 
 
 
+@patch('main__.acquire_lease', new=lambda version, context: {"action": "run", "lease": None})
+@patch('main__.get_cache_entry', new=lambda cache_key: None)
+@patch('main__.put_object', side_effect=mocked_put_object)
 @patch('main__.get_item', side_effect=mocked_get_item)
 @patch('main__.download_file_to_disk', side_effect=mocked_download_file_to_disk)
 @patch('main__.set_tags', side_effect=mocked_set_tags)
@@ -76,7 +91,7 @@ class GeneratePreviewTest(unittest.TestCase):
 
     # Test for valid file type (.mpeg)
     def test_valid_file(self, get_item_mock, download_file_to_disk_mock,
-     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock):
+     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock, put_object_mock):
         global file_name
         file_name = "vid.mpeg"
         response = main(self.s3_upload_event(file_name, 18735828), "")
@@ -90,18 +105,17 @@ class GeneratePreviewTest(unittest.TestCase):
         self.assertEqual(get_item_mock.call_count, 1)
         self.assertEqual(download_file_to_disk_mock.call_count, 1)
         self.assertEqual(set_tags_mock.call_count, 2)
-        self.assertEqual(upload_file_mock.call_count, 3)
+        self.assertEqual(upload_file_mock.call_count, 2)
+        self.assertEqual(put_object_mock.call_count, 3) # Markers plus the cache index
         self.assertEqual(response, expected_response)
         self.assertTrue(os.path.isfile("/tmp/preview.webm"))
-        self.assertTrue(os.path.isfile("/tmp/path.txt"))
-        self.assertTrue(os.path.getsize("/tmp/path.txt") > 0)
         self.assertFalse(os.path.isfile(f"/tmp/{file_name}"))
         print(response)
         delete_files()
 
     # Test for invalid file type (.asd)
     def test_invalid_file(self, get_item_mock, download_file_to_disk_mock,
-     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock):
+     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock, put_object_mock):
         global file_name
         file_name = "vid.asd"
         with self.assertRaises(Exception) as context:
@@ -135,7 +149,7 @@ class GeneratePreviewTest(unittest.TestCase):
 
     # Test for previews skip
     def test_name(self, get_item_mock, download_file_to_disk_mock,
-     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock):
+     set_tags_mock, upload_file_mock, create_presigned_url_aws_mock, generate_clipv2_mock, check_output_mock, put_object_mock):
         global file_name
         file_name = "previews/03a1cc02-0f06-434c-b06b-0587b329f5ec.asp-previews/preview.webm"
         with self.assertRaises(Exception) as context:
@@ -194,3 +208,434 @@ class GeneratePreviewTest(unittest.TestCase):
             }
         ]
     }
+
+
+
+@patch('main__.get_video_duration', return_value=100.0)
+class ClipOffsetTest(unittest.TestCase):
+
+    def test_start_skips_probe(self, get_video_duration_mock):
+        self.assertEqual(get_clip_offset("url", "start", 15), 0)
+        self.assertEqual(get_video_duration_mock.call_count, 0)
+
+    def test_middle(self, get_video_duration_mock):
+        self.assertEqual(get_clip_offset("url", "middle", 15), 50)
+
+    def test_percentage(self, get_video_duration_mock):
+        self.assertEqual(get_clip_offset("url", "25%", 15), 25)
+
+    # The clip must still fit inside the video
+    def test_offset_near_end(self, get_video_duration_mock):
+        self.assertEqual(get_clip_offset("url", "95%", 15), 85)
+
+    def test_unknown_mode(self, get_video_duration_mock):
+        self.assertEqual(get_clip_offset("url", "somewhere", 15), 0)
+
+
+
+class RuntimeContextTest(unittest.TestCase):
+
+    def tearDown(self):
+        reset_runtime()
+
+    # Warm invocations should reuse the parsed configs instead of rebuilding them
+    def test_runtime_is_cached(self):
+        reset_runtime()
+        runtime = get_runtime()
+        self.assertIs(get_runtime(), runtime)
+        self.assertIn(".mp4", runtime["extensions"]["video"])
+        self.assertEqual(runtime["config"]["thumb_video_sizes"], [320])
+
+    def test_reset_runtime(self):
+        runtime = get_runtime()
+        reset_runtime()
+        self.assertIsNot(get_runtime(), runtime)
+
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    def test_parse_import_times(self):
+        output = "import time: self [us] | cumulative | imported package\n"\
+            "import time:       120 |        120 |   botocore.compat\n"\
+            "import time:      3000 |       3120 | boto3\n"\
+            "unrelated line\n"
+        import_times = parse_import_times(output)
+        self.assertEqual(len(import_times), 2)
+        self.assertEqual(import_times[1]["module"], "boto3")
+        self.assertEqual(import_times[1]["cumulative_us"], 3120)
+        self.assertTrue(import_times[1]["top_level"])
+        self.assertFalse(import_times[0]["top_level"])
+
+    # Modules only some invocations use are left out of the cold start
+    def test_lazy_imports(self):
+        script_path = str(pathlib.Path(__file__).parent.parent.parent.resolve())
+        code = "import sys, main__; print(' '.join(sys.modules))"
+        output = subprocess.run([sys.executable, "-c", code], cwd=script_path, capture_output=True, text=True,
+            env=dict(os.environ, AWS_REGION="us-west-2")).stdout.split()
+        self.assertIn("main__", output)
+        for module in ["multiprocessing", "concurrent.futures", "embedded", "mp4", "multipart", "pdf", "storyboard"]:
+            self.assertNotIn(module, output)
+
+    # Before the SDK is imported, an error in an S3 call comes out as itself instead of a TypeError from "except None"
+    @patch('main__.provider', "AWS")
+    def test_errors_before_sdk_import(self):
+        with patch('main__.ClientError', sdk_placeholder_error), patch('main__.s3', mock.Mock(**{"put_object.side_effect": ConnectionError("offline")})):
+            with self.assertRaises(ConnectionError):
+                main__.put_object("previews/marker")
+
+
+
+class StreamingPipeTest(unittest.TestCase):
+
+    def test_stream_whole_body(self):
+        body = io.BytesIO(b"x" * (3 << 20))
+        process = run_piped(["wc", "-c"], body)
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(body.closed)
+
+    # The child can stop reading early, like ffmpeg does once it has the whole clip
+    def test_child_stops_reading(self):
+        body = io.BytesIO(b"x" * (16 << 20))
+        process = run_piped(["head", "-c", "10"], body)
+        self.assertEqual(process.returncode, 0)
+        self.assertTrue(body.closed)
+
+    # A read failing halfway must not look like the end of the file to the child
+    @patch('main__.export_error', side_effect=Exception("streaming failed"))
+    def test_read_failure(self, export_error_mock):
+        class FailingBody(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() >= 1 << 20:
+                    raise ConnectionResetError("connection reset")
+                return super().read(size)
+        body = FailingBody(b"x" * (4 << 20))
+        with self.assertRaises(Exception):
+            run_piped(["wc", "-c"], body)
+        self.assertIn("connection reset", export_error_mock.call_args[0][0])
+        self.assertTrue(body.closed)
+
+
+
+class EncoderProbeTest(unittest.TestCase):
+
+    # The encoder comes from the runtime detection cached per container, no shell probe per clip
+    @patch('main__.os.system')
+    @patch('main__.run_piped', return_value=mock.Mock(returncode=0))
+    @patch('main__.video_encoder', return_value="libx264")
+    def test_clip_uses_cached_encoder(self, video_encoder_mock, run_piped_mock, system_mock):
+        main__.generate_clip("vid.mp4", "/tmp/preview.webm", False, 60, 15, stream=io.BytesIO(b"video"))
+        self.assertEqual(video_encoder_mock.call_count, 1)
+        self.assertEqual(system_mock.call_count, 0)
+
+    @patch('main__.os.system')
+    @patch('main__.export_error', side_effect=Exception("missing"))
+    def test_check_output(self, export_error_mock, system_mock):
+        main__.check_output(__file__, "ffmpeg")
+        with self.assertRaises(Exception):
+            main__.check_output("/tmp/does-not-exist.webm", "ffmpeg")
+        self.assertEqual(system_mock.call_count, 0)
+
+
+
+class SegmentBoundariesTest(unittest.TestCase):
+
+    def test_split_on_keyframes(self):
+        keyframes = [0, 2.5, 5, 7.5, 10, 12.5]
+        chunks = segment_boundaries(keyframes, 0, 15, 3)
+        self.assertEqual(chunks, [(0, 5), (5, 5), (10, 5)])
+
+    def test_nearest_keyframe(self):
+        chunks = segment_boundaries([10, 14, 23], 10, 15, 2)
+        self.assertEqual(chunks, [(10, 4), (14, 11)])
+
+    # Without keyframes inside the clip there's nothing to split on
+    def test_no_keyframes(self):
+        self.assertEqual(segment_boundaries([0], 0, 15, 4), [(0, 15)])
+
+    # Segments written before one of them failed are removed before the single process fallback
+    @patch('main__.generate_clipv2')
+    @patch('main__.video_encoder', return_value="libx264")
+    @patch('main__.keyframes_between', return_value=[0, 5, 10])
+    def test_failed_segments_removed(self, keyframes_mock, encoder_mock, generate_clipv2_mock):
+        directory = tempfile.mkdtemp()
+        def encode(command):
+            chunk = next(arg for arg in command if arg.startswith(f"{directory}/chunk-"))
+            pathlib.Path(chunk).write_bytes(b"mp4")
+            return mock.Mock(returncode=1 if chunk.endswith("-1.mp4") else 0)
+        try:
+            with patch('main__.work_dir', directory), patch('main__.sp.run', side_effect=encode):
+                main__.generate_clip_chunked("https://url", f"{directory}/preview.mp4", 15, False, segments=3)
+            self.assertEqual(generate_clipv2_mock.call_count, 1)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class PosterSelectionTest(unittest.TestCase):
+
+    def test_poster_times(self):
+        self.assertEqual(poster_times_for(60, 5), [10, 20, 30, 40, 50])
+
+    def test_black_frame(self):
+        mean, entropy = score_frame(bytes([0] * 2304))
+        self.assertEqual(mean, 0)
+        self.assertEqual(entropy, 0)
+
+    def test_detailed_frame(self):
+        mean, entropy = score_frame(bytes(range(256)) * 9)
+        self.assertEqual(entropy, 8)
+
+
+
+class ThumbnailLadderTest(unittest.TestCase):
+
+    # Every size comes out of a single convert process reading the source once
+    @patch('main__.sp.run')
+    def test_image_ladder(self, run_mock):
+        main__.image_thumbv2("https://url", "/tmp/thumbnail.png", [800, 320, 96])
+        self.assertEqual(run_mock.call_count, 1)
+        command = run_mock.call_args[0][0]
+        self.assertEqual(command.count("https://url[0]"), 1)
+        for output in ["/tmp/thumbnail.png", "/tmp/thumbnail-320.png", "/tmp/thumbnail-96.png"]:
+            self.assertEqual(command[command.index(output) - 1], "-write")
+        self.assertLess(command.index("800x800>"), command.index("320x320>"))
+
+    # The piped commands used on IBM write the whole ladder too
+    @patch('main__.sp.run')
+    @patch('main__.run_piped', return_value=mock.Mock(returncode=0))
+    def test_piped_ladder(self, run_piped_mock, run_mock):
+        with patch('main__.is_downloaded', False):
+            main__.image_thumb(io.BytesIO(b"image"), "/tmp/thumbnail.png", "", [800, 320])
+            main__.pdf_thumb(io.BytesIO(b"pdf"), "/tmp/thumbnail.png", [800, 320])
+        for call in run_piped_mock.call_args_list:
+            command = call[0][0]
+            self.assertEqual(command.count("-[0]"), 1)
+            for output in ["/tmp/thumbnail.png", "/tmp/thumbnail-320.png"]:
+                self.assertEqual(command[command.index(output) - 1], "-write")
+        self.assertEqual([call[0][0][1] for call in run_mock.call_args_list], ["/tmp/thumbnail.png", "/tmp/thumbnail-320.png"])
+
+    # A failed conversion of the embedded preview falls back to decoding the whole file
+    @patch('main__.embedded_container', return_value="tiff")
+    @patch('embedded.extract_preview', return_value=(b"jpeg", "TopLeft"))
+    def test_embedded_failure(self, extract_mock, container_mock):
+        job = {"file_name": "a.nef", "content_length": 1000, "output": "/tmp/ladder-test.png", "sizes": [800, 320]}
+        with patch('main__.run_piped', return_value=mock.Mock(returncode=1)):
+            self.assertEqual(main__.embedded_image_thumb(job), [])
+        # A zero exit code isn't enough, every size of the ladder has to be written
+        with patch('main__.run_piped', return_value=mock.Mock(returncode=0)):
+            self.assertEqual(main__.embedded_image_thumb(job), [])
+        def convert(command, data):
+            for output in ["/tmp/ladder-test.png", "/tmp/ladder-test-320.png"]:
+                pathlib.Path(output).write_bytes(b"png")
+            return mock.Mock(returncode=0)
+        try:
+            with patch('main__.run_piped', side_effect=convert):
+                self.assertEqual(main__.embedded_image_thumb(job), [800, 320])
+        finally:
+            for output in ["/tmp/ladder-test.png", "/tmp/ladder-test-320.png"]:
+                pathlib.Path(output).unlink()
+
+
+
+class PublishTest(unittest.TestCase):
+
+    # previews-checker skips files with a marker, so a failed upload must not leave one behind
+    @patch('main__.set_tags')
+    @patch('main__.put_object')
+    @patch('main__.upload_file', side_effect=Exception("upload failed"))
+    def test_no_marker_after_failed_upload(self, upload_file_mock, put_object_mock, set_tags_mock):
+        markers = [("previews/abc.asp-preview/preview-path.txt", b"a.jpg"), ("previews/abc.asp-preview/a.jpg.asp-location", b"")]
+        with self.assertRaises(Exception):
+            main__.publish([("/tmp/preview.png", "previews/abc.asp-preview/preview.png")], [], markers, [])
+        self.assertEqual(put_object_mock.call_count, 0)
+        self.assertEqual(set_tags_mock.call_count, 0)
+
+    @patch('main__.set_tags')
+    @patch('main__.put_object')
+    @patch('main__.upload_file')
+    def test_markers_after_artifacts(self, upload_file_mock, put_object_mock, set_tags_mock):
+        calls = []
+        upload_file_mock.side_effect = lambda file_name, object_name: calls.append(object_name)
+        put_object_mock.side_effect = lambda object_name, body: calls.append(object_name)
+        markers = [("previews/abc.asp-preview/a.jpg.asp-location", b"")]
+        main__.publish([("/tmp/preview.png", "previews/abc.asp-preview/preview.png")], [("previews/abc.asp-preview/storyboard.vtt", b"")], markers, [])
+        self.assertEqual(calls[-1], "previews/abc.asp-preview/a.jpg.asp-location")
+        self.assertEqual(set_tags_mock.call_count, 1)
+
+
+
+class DecodeHintTest(unittest.TestCase):
+
+    def test_jpeg_hint(self):
+        self.assertEqual(main__.decode_hint("photos/IMG_0001.JPG", 800), "-define jpeg:size=1600x1600")
+
+    def test_no_hint(self):
+        self.assertEqual(main__.decode_hint("image.png", 800), "")
+
+
+@patch('main__.acquire_lease', new=lambda version, context: {"action": "run", "lease": None})
+@patch('main__.create_presigned_url_aws', side_effect=mocked_create_presigned_url_aws)
+@patch.dict('os.environ', {'AWS_REGION': 'us-west-2',
+                                        'LAMBDA_TASK_ROOT': 'true',
+                                        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '2048'}, clear=True)
+class PreviewCacheTest(unittest.TestCase):
+
+    # A duplicate is published from a server-side copy without encoding anything
+    @patch('main__.generate_clipv2')
+    @patch('main__.upload_file')
+    @patch('main__.put_object')
+    @patch('main__.set_tags')
+    @patch('main__.copy_cached_preview', return_value=["previews/new.asp-preview/preview.mp4"])
+    @patch('main__.get_cache_entry', return_value={"preview_path": "previews/old.asp-preview", "objects": ["preview.mp4"], "source": "a.mp4"})
+    def test_cache_hit(self, get_cache_entry_mock, copy_mock, set_tags_mock, put_object_mock, upload_file_mock, generate_clipv2_mock, presigned_mock):
+        response = main(GeneratePreviewTest.s3_upload_event(None, "vid.mp4", 1000), "")
+        self.assertEqual(response["method"], "cache")
+        self.assertEqual(generate_clipv2_mock.call_count, 0)
+        self.assertEqual(upload_file_mock.call_count, 0)
+        self.assertEqual(set_tags_mock.call_count, 1)
+        self.assertTrue(get_cache_entry_mock.call_args[0][0].startswith("previews/cache/"))
+        # Only the per file markers are written, the index already exists
+        self.assertEqual(put_object_mock.call_count, 2)
+
+    # Previews encoded with the smaller profile of a tight run are cached apart from the full ones
+    def test_tight_runs_cached_apart(self, presigned_mock):
+        with patch.dict(main__.resources, {"tight": False}):
+            full = main__.preview_settings("video", {})
+        with patch.dict(main__.resources, {"tight": True}):
+            tight = main__.preview_settings("video", {})
+        self.assertNotEqual(main__.cache.index_key("etag:abc:10", full), main__.cache.index_key("etag:abc:10", tight))
+
+
+@patch('main__.get_cache_entry', new=lambda cache_key: None)
+@patch('main__.check_output', side_effect=mocked_check_output)
+@patch('main__.create_presigned_url_aws', side_effect=mocked_create_presigned_url_aws)
+@patch.dict('os.environ', {'AWS_REGION': 'us-west-2',
+                                        'LAMBDA_TASK_ROOT': 'true',
+                                        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '2048'}, clear=True)
+class IdempotencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = main__.idempotency.MemoryLeaseStore()
+
+    # A duplicate notification of the same version exits without encoding again
+    @patch('main__.generate_clipv2', side_effect=generate_clipv2)
+    @patch('main__.upload_file')
+    @patch('main__.put_object')
+    @patch('main__.set_tags')
+    def test_duplicate_event(self, set_tags_mock, put_object_mock, upload_file_mock, generate_clipv2_mock, presigned_mock, check_output_mock):
+        event = GeneratePreviewTest.s3_upload_event(None, "vid.mp4", 1000)
+        with patch('main__.idempotency.S3LeaseStore', return_value=self.store):
+            self.assertEqual(main(event, "")["method"], "pipe")
+            response = main(event, "")
+        self.assertIn("already being generated or done", response["body"])
+        self.assertEqual(generate_clipv2_mock.call_count, 1)
+        self.assertEqual(json.loads(list(self.store.objects.values())[0][0])["state"], "done")
+        delete_files()
+
+    @patch('main__.generate_clipv2')
+    @patch('main__.set_tags')
+    def test_resume_after_upload(self, set_tags_mock, generate_clipv2_mock, presigned_mock, check_output_mock):
+        event = GeneratePreviewTest.s3_upload_event(None, "vid.mp4", 1000)
+        name = main__.idempotency.lease_key("my-bucket-name", "vid.mp4", "0060CCC3C")
+        self.store.put(name, main__.idempotency.lease_body("uploaded", "earlier", 0, "previews/earlier.asp-preview"))
+        with patch('main__.idempotency.S3LeaseStore', return_value=self.store):
+            response = main(event, "")
+        self.assertEqual(response["method"], "resume")
+        self.assertEqual(generate_clipv2_mock.call_count, 0)
+        self.assertEqual(set_tags_mock.call_args[0][2][1]["Value"], "previews/earlier.asp-preview/")
+
+    # A crash outside export_error releases the lease, so the retry of the event runs right away
+    @patch('main__.upload_file')
+    @patch('main__.put_object')
+    @patch('main__.set_tags')
+    def test_retry_after_crash(self, set_tags_mock, put_object_mock, upload_file_mock, presigned_mock, check_output_mock):
+        event = GeneratePreviewTest.s3_upload_event(None, "vid.mp4", 1000)
+        with patch('main__.idempotency.S3LeaseStore', return_value=self.store):
+            with patch('main__.generate_clipv2', side_effect=TypeError("crashed")):
+                with self.assertRaises(TypeError):
+                    main(event, "")
+            self.assertEqual(self.store.objects, {})
+            with patch('main__.generate_clipv2', side_effect=generate_clipv2):
+                self.assertEqual(main(event, "")["method"], "pipe")
+        delete_files()
+
+    # The retry of an invocation that timed out takes over its lease instead of waiting for it to expire
+    @patch('main__.upload_file')
+    @patch('main__.put_object')
+    @patch('main__.set_tags')
+    def test_retry_after_timeout(self, set_tags_mock, put_object_mock, upload_file_mock, presigned_mock, check_output_mock):
+        class Context:
+            def __init__(self, request):
+                self.aws_request_id = request
+        event = GeneratePreviewTest.s3_upload_event(None, "vid.mp4", 1000)
+        name = main__.idempotency.lease_key("my-bucket-name", "vid.mp4", "0060CCC3C")
+        self.store.put(name, main__.idempotency.lease_body("in_progress", "timed-out", time.time() + 100, request="request-1"))
+        with patch('main__.idempotency.S3LeaseStore', return_value=self.store), patch('main__.generate_clipv2', side_effect=generate_clipv2):
+            self.assertIn("already being generated", main(event, Context("request-2"))["body"])
+            self.assertEqual(main(event, Context("request-1"))["method"], "pipe")
+        self.assertEqual(json.loads(self.store.objects[name][0])["state"], "done")
+        delete_files()
+
+    def test_heartbeat(self, presigned_mock, check_output_mock):
+        decision = main__.idempotency.acquire(self.store, "lease", "owner", 60, time.time())
+        main__.lease = {"store": self.store, "name": "lease", "etag": decision["etag"], "expires": time.time() + 60,
+            "owner": "owner", "request": None, "state": "in_progress"}
+        try:
+            self.assertFalse(main__.renew_lease("someone-else"))
+            self.assertTrue(main__.renew_lease("owner"))
+            self.assertGreater(json.loads(self.store.objects["lease"][0])["expires"], time.time() + 60)
+            main__.record_lease("uploaded", "previews/abc.asp-preview")
+            # Nothing to renew once everything is uploaded
+            self.assertFalse(main__.renew_lease("owner"))
+        finally:
+            main__.lease = None
+
+def mocked_record_main(event, context=""):
+    key = event["Records"][0]["s3"]["object"]["key"]
+    if key.endswith(".asd"):
+        raise Exception("File extension not supported")
+    return {"statusCode": 200, "key": key}
+
+@patch('main__.get_s3_client')
+@patch('main__.main', side_effect=mocked_record_main)
+class BatchTest(unittest.TestCase):
+
+    @staticmethod
+    def batch_event(*keys):
+        return {"Records": [{"s3": {"bucket": {"name": "my-bucket-name"}, "object": {"key": key, "size": 1000}}} for key in keys]}
+
+    def test_sqs_records(self, main_mock, get_s3_client_mock):
+        event = self.batch_event("a.jpg", "b.jpg")
+        records = main__.s3_records([{"body": json.dumps(event)}] + self.batch_event("c.jpg")["Records"])
+        self.assertEqual([record["s3"]["object"]["key"] for record in records], ["a.jpg", "b.jpg", "c.jpg"])
+
+    def test_sequential(self, main_mock, get_s3_client_mock):
+        response = main__.process_batch(self.batch_event("a.jpg", "b.jpg", "c.jpg"), "", 1)
+        self.assertEqual([result["key"] for result in response["results"]], ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual(main_mock.call_count, 3)
+
+    # Every record runs in a forked child, the results come back in the order of the records
+    def test_concurrent(self, main_mock, get_s3_client_mock):
+        response = main__.process_batch(self.batch_event("a.jpg", "b.jpg", "c.jpg", "d.jpg"), "", 2)
+        self.assertEqual([result["key"] for result in response["results"]], ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+
+    # The failure of one record doesn't stop the others, the event is failed at the end so it's retried
+    def test_failed_record(self, main_mock, get_s3_client_mock):
+        with self.assertRaises(Exception) as context:
+            main__.process_batch(self.batch_event("a.jpg", "b.asd", "c.jpg"), "", 1)
+        self.assertIn("b.asd", str(context.exception))
+        self.assertEqual(main_mock.call_count, 3)
+
+    # The child builds its own client instead of using the connections inherited from the parent
+    def test_worker_drops_inherited_clients(self, main_mock, get_s3_client_mock):
+        get_runtime()["clients"][("AWS",)] = mock.Mock()
+        sender = mock.Mock()
+        try:
+            main__.record_worker(self.batch_event("a.jpg")["Records"][0], "", 2, "/tmp/record-test", sender)
+        finally:
+            main__.work_dir = "/tmp"
+            main__.batch_share = 1
+        self.assertEqual(get_runtime()["clients"], {})
+        self.assertEqual(sender.send.call_args[0][0]["key"], "a.jpg")
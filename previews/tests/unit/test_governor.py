@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from governor import encoder_args, imagemagick_environment, plan, remaining_seconds
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 42000
+
+
+class GovernorTest(unittest.TestCase):
+
+    def test_aws_uses_url(self):
+        resources = plan(2048, 512, 2, 300, 50 << 20, "AWS")
+        self.assertEqual(resources["strategy"], "url")
+        self.assertEqual(resources["max_mem_size"], (2048 << 20) // 2 - (150 << 20))
+        self.assertEqual(resources["imagemagick_limits"]["memory"], "949MiB")
+        self.assertEqual(resources["imagemagick_limits"]["thread"], "2")
+        self.assertFalse(resources["tight"])
+
+    def test_ibm_strategies(self):
+        self.assertEqual(plan(2048, 10240, 1, None, 1 << 30, "IBM", streaming=True)["strategy"], "stream")
+        self.assertEqual(plan(2048, 10240, 1, None, 100 << 20, "IBM")["strategy"], "memory")
+        self.assertEqual(plan(2048, 10240, 1, None, 5 << 30, "IBM")["strategy"], "disk")
+        self.assertIsNone(plan(2048, 1024, 1, None, 5 << 30, "IBM")["strategy"])
+
+    # Whatever holds the object isn't available to ImageMagick anymore
+    def test_held_object_lowers_limits(self):
+        in_memory = plan(2048, 10240, 1, None, 500 << 20, "IBM")
+        self.assertEqual(in_memory["imagemagick_limits"]["map"], f"{2048 - 150 - 500}MiB")
+        on_disk = plan(512, 10240, 1, None, 2 << 30, "IBM")
+        self.assertEqual(on_disk["imagemagick_limits"]["disk"], f"{10240 - 150 - 2048}MiB")
+
+    def test_small_function_keeps_a_minimum(self):
+        self.assertEqual(plan(128, 512, 1, None, 0, "AWS")["imagemagick_limits"]["map"], "64MiB")
+
+    def test_encoder_args(self):
+        self.assertEqual(encoder_args("libx264", False, 4), "-preset veryfast -threads 4")
+        self.assertEqual(encoder_args("libsvtav1", True, 2), "-preset 12 -threads 2")
+        self.assertEqual(encoder_args("mpeg4", False, 0), "-threads 0")
+
+    def test_tight_on_time(self):
+        self.assertTrue(plan(2048, 512, 2, 30, 0, "AWS")["tight"])
+        self.assertFalse(plan(2048, 512, 2, None, 0, "AWS")["tight"])
+
+    def test_remaining_seconds(self):
+        self.assertEqual(remaining_seconds(Context()), 42)
+        with mock.patch.dict("os.environ", {"__OW_DEADLINE": "4102444800000"}):
+            self.assertGreater(remaining_seconds(""), 0)
+        with mock.patch.dict("os.environ", {}, clear=True):
+            self.assertIsNone(remaining_seconds(""))
+
+    def test_imagemagick_environment(self):
+        self.assertEqual(imagemagick_environment({"memory": "1GiB", "thread": "2"}),
+            {"MAGICK_MEMORY_LIMIT": "1GiB", "MAGICK_THREAD_LIMIT": "2"})
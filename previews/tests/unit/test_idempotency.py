@@ -0,0 +1,84 @@
+import json
+import pathlib
+import unittest
+
+import yaml
+
+from cache import index_key
+from idempotency import LeaseTaken, MemoryLeaseStore, acquire, lease_body, lease_key, record
+
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryLeaseStore()
+        self.name = lease_key("bucket", "videos/a.mp4", "0060CCC3C")
+
+    def test_first_invocation_runs(self):
+        decision = acquire(self.store, self.name, "first", 60, 1000)
+        self.assertEqual(decision["action"], "run")
+        self.assertEqual(json.loads(self.store.read(self.name)[0])["owner"], "first")
+
+    def test_duplicate_skips_while_in_progress(self):
+        acquire(self.store, self.name, "first", 60, 1000)
+        self.assertEqual(acquire(self.store, self.name, "second", 60, 1030)["action"], "skip")
+
+    def test_expired_lease_is_taken_over(self):
+        acquire(self.store, self.name, "first", 60, 1000)
+        decision = acquire(self.store, self.name, "second", 60, 1100)
+        self.assertEqual(decision["action"], "run")
+        self.assertEqual(decision["lease"]["owner"], "first")
+        self.assertEqual(json.loads(self.store.read(self.name)[0])["owner"], "second")
+
+    def test_done_skips(self):
+        decision = acquire(self.store, self.name, "first", 60, 1000)
+        record(self.store, self.name, decision["etag"], "done", "first", 1060, "previews/1.asp-preview")
+        self.assertEqual(acquire(self.store, self.name, "second", 60, 5000)["action"], "skip")
+
+    # A failure after the upload only needs the tags to be set again
+    def test_uploaded_resumes(self):
+        decision = acquire(self.store, self.name, "first", 60, 1000)
+        record(self.store, self.name, decision["etag"], "uploaded", "first", 1060, "previews/1.asp-preview")
+        decision = acquire(self.store, self.name, "second", 60, 1010)
+        self.assertEqual(decision["action"], "resume")
+        self.assertEqual(decision["lease"]["preview_path"], "previews/1.asp-preview")
+
+    # The owner that lost the lease can't overwrite the one that took it over
+    def test_stale_owner_cannot_record(self):
+        first = acquire(self.store, self.name, "first", 60, 1000)
+        acquire(self.store, self.name, "second", 60, 1100)
+        self.assertIsNone(record(self.store, self.name, first["etag"], "done", "first", 1060))
+        self.assertEqual(json.loads(self.store.read(self.name)[0])["state"], "in_progress")
+
+    # A Lambda retry keeps the request id, so it takes over the lease of its own timed out attempt
+    def test_retry_takes_over(self):
+        acquire(self.store, self.name, "first", 60, 1000, "request-1")
+        self.assertEqual(acquire(self.store, self.name, "second", 60, 1010, "request-2")["action"], "skip")
+        decision = acquire(self.store, self.name, "retry", 60, 1020, "request-1")
+        self.assertEqual(decision["action"], "run")
+        self.assertEqual(json.loads(self.store.read(self.name)[0])["owner"], "retry")
+
+    def test_renewed_lease_stays(self):
+        first = acquire(self.store, self.name, "first", 60, 1000)
+        record(self.store, self.name, first["etag"], "in_progress", "first", 1100)
+        self.assertEqual(acquire(self.store, self.name, "second", 60, 1080)["action"], "skip")
+
+    # A slow holder can't delete the lease another invocation took over from it
+    def test_conditional_delete(self):
+        first = acquire(self.store, self.name, "first", 60, 1000)
+        acquire(self.store, self.name, "second", 60, 1100)
+        with self.assertRaises(LeaseTaken):
+            self.store.delete(self.name, first["etag"])
+        self.assertEqual(json.loads(self.store.read(self.name)[0])["owner"], "second")
+
+    # The S3 notification only has rules for the supported extensions, lease writes mustn't invoke the filter
+    def test_lease_has_no_preview_extension(self):
+        script_path = pathlib.Path(__file__).parent.parent.parent.parent
+        formats = yaml.safe_load((script_path / "previews-filter" / "file_formats.yml").read_text())
+        extensions = tuple(formats["video"] + formats["pdf"] + formats["image"])
+        self.assertFalse(self.name.lower().endswith(extensions))
+        self.assertFalse(index_key("etag:abc:10", {}).lower().endswith(extensions))
+
+    def test_versions_have_their_own_lease(self):
+        self.assertNotEqual(self.name, lease_key("bucket", "videos/a.mp4", "0060CCC3D"))
+        self.assertTrue(self.name.startswith("previews/leases/"))
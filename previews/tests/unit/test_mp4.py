@@ -0,0 +1,104 @@
+import io
+import struct
+import unittest
+
+from mp4 import faststart_stream, iter_boxes, probe, shift_chunk_offsets
+
+def box(box_type, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def full_box(box_type, payload=b""):
+    return box(box_type, b"\x00\x00\x00\x00" + payload)
+
+def build_moov(chunk_offset):
+    mvhd = full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, 5000) + b"\x00" * 80)
+    tkhd = full_box(b"tkhd", b"\x00" * 72 + struct.pack(">II", 1280 << 16, 720 << 16))
+    mdhd = full_box(b"mdhd", struct.pack(">IIII", 0, 0, 24, 120) + b"\x00" * 4)
+    hdlr = full_box(b"hdlr", b"\x00" * 4 + b"vide" + b"\x00" * 13)
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + box(b"avc1", b"\x00" * 8))
+    stco = full_box(b"stco", struct.pack(">II", 1, chunk_offset))
+    stbl = box(b"stbl", stsd + stco)
+    mdia = box(b"mdia", mdhd + hdlr + box(b"minf", stbl))
+    return box(b"moov", mvhd + box(b"trak", tkhd + mdia))
+
+def build_file(moov_at_tail):
+    ftyp = box(b"ftyp", b"isom\x00\x00\x02\x00")
+    mdat = box(b"mdat", b"SAMPLE-DATA")
+    if moov_at_tail:
+        return ftyp + mdat + build_moov(len(ftyp) + 8)
+    moov_size = len(build_moov(0))
+    return ftyp + build_moov(len(ftyp) + moov_size + 8) + mdat
+
+def reader(data):
+    reads = []
+    def read_range(start, end):
+        reads.append((start, end))
+        return data[start:end + 1]
+    def open_range(start, end):
+        return io.BytesIO(data[start:end + 1])
+    return read_range, open_range, reads
+
+
+class Mp4ProbeTest(unittest.TestCase):
+
+    def test_moov_at_head(self):
+        data = build_file(False)
+        read_range, _, _ = reader(data)
+        info = probe(read_range, len(data))
+        self.assertEqual(info["placement"], "head")
+        self.assertEqual(info["duration"], 5.0)
+        self.assertEqual(info["tracks"][0]["handler"], "vide")
+        self.assertEqual(info["tracks"][0]["codec"], "avc1")
+        self.assertEqual((info["tracks"][0]["width"], info["tracks"][0]["height"]), (1280, 720))
+        self.assertEqual(info["tracks"][0]["duration"], 5.0)
+
+    def test_moov_at_tail(self):
+        data = build_file(True)
+        read_range, _, reads = reader(data)
+        info = probe(read_range, len(data))
+        self.assertEqual(info["placement"], "tail")
+        self.assertEqual(info["duration"], 5.0)
+        # Only the head of the file and the moov atom are read
+        self.assertLessEqual(len(reads), 2)
+
+    # The bytes "moov" inside media data used to be taken as a moov atom
+    def test_moov_bytes_inside_mdat(self):
+        ftyp = box(b"ftyp", b"isom\x00\x00\x02\x00")
+        data = ftyp + box(b"mdat", b"xxmoovxx")
+        read_range, _, _ = reader(data)
+        info = probe(read_range, len(data))
+        self.assertIsNone(info["placement"])
+
+    def test_not_iso_bmff(self):
+        data = b"\x00\x00\x01\xba" + b"\x00" * 100 # MPEG program stream
+        read_range, _, _ = reader(data)
+        self.assertIsNone(probe(read_range, len(data)))
+
+    def test_faststart_stream(self):
+        data = build_file(True)
+        read_range, open_range, _ = reader(data)
+        info = probe(read_range, len(data))
+        stream = faststart_stream(info, read_range, open_range, len(data))
+        output = b""
+        for chunk in iter(lambda: stream.read(7), b""):
+            output += chunk
+        self.assertEqual(len(output), len(data))
+        read_range, _, _ = reader(output)
+        streamed_info = probe(read_range, len(output))
+        self.assertEqual(streamed_info["placement"], "head")
+        # The chunk offset still points at the sample after moov was moved in front of mdat
+        chunk_offset = struct.unpack(">I", streamed_info["moov_data"][-4:])[0]
+        self.assertEqual(output[chunk_offset:chunk_offset + 11], b"SAMPLE-DATA")
+
+    def test_shift_overflow(self):
+        moov = build_moov(0xFFFFFFF0)
+        self.assertIsNone(shift_chunk_offsets(moov, 0x100))
+
+    # A box with a 64 bit size whose header is cut off ends the walk instead of raising
+    def test_truncated_largesize_box(self):
+        data = box(b"free") + struct.pack(">I4s", 1, b"mdat") + b"\x00" * 4
+        self.assertEqual(list(iter_boxes(data, 0, len(data))), [(b"free", 0, 8, 8)])
+        moov = box(b"moov", build_moov(0)[8:] + struct.pack(">I4s", 1, b"udta") + b"\x00" * 4)
+        data = box(b"ftyp", b"isom\x00\x00\x02\x00") + moov
+        read_range, _, _ = reader(data)
+        self.assertEqual(probe(read_range, len(data))["duration"], 5.0)
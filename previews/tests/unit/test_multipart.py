@@ -0,0 +1,71 @@
+import io
+import threading
+import unittest
+
+from multipart import read_part, upload_stream
+
+class FakeClient:
+    def __init__(self, fail_part=None):
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.fail_part = fail_part
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise IOError("connection reset")
+        with self.lock:
+            self.parts[PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+class TrickleStream(io.BytesIO):
+    # Returns at most 3 bytes per read, like a pipe that is only partially filled
+    def read(self, size=-1):
+        return super().read(min(size, 3) if size and size > 0 else 3)
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def test_read_part_fills_up(self):
+        self.assertEqual(read_part(TrickleStream(b"abcdefghij"), 8), b"abcdefgh")
+
+    def test_upload_in_order(self):
+        data = bytes(range(256)) * 10
+        client = FakeClient()
+        total = upload_stream(client, "bucket", "key", TrickleStream(data), workers=2, size=100)
+        self.assertEqual(total, len(data))
+        self.assertEqual([part["PartNumber"] for part in client.completed], list(range(1, 27)))
+        self.assertEqual(b"".join(client.parts[number] for number in sorted(client.parts)), data)
+        self.assertFalse(client.aborted)
+
+    def test_exact_multiple(self):
+        client = FakeClient()
+        upload_stream(client, "bucket", "key", io.BytesIO(b"x" * 200), size=100)
+        self.assertEqual(len(client.completed), 2)
+
+    def test_failed_part_aborts(self):
+        client = FakeClient(fail_part=2)
+        with self.assertRaises(IOError):
+            upload_stream(client, "bucket", "key", io.BytesIO(b"x" * 1000), workers=2, size=100)
+        self.assertTrue(client.aborted)
+        self.assertIsNone(client.completed)
+
+    # The encoder failing after its output was read must not leave a truncated preview behind
+    def test_failed_check_aborts(self):
+        client = FakeClient()
+        def check():
+            raise RuntimeError("ffmpeg exited with 1")
+        with self.assertRaises(RuntimeError):
+            upload_stream(client, "bucket", "key", io.BytesIO(b"x" * 250), size=100, check=check)
+        self.assertTrue(client.aborted)
+        self.assertIsNone(client.completed)
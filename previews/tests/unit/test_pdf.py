@@ -0,0 +1,84 @@
+import re
+import unittest
+
+from pdf import first_page_document, page_size, parse_linearization, probe, render_dpi
+
+def build_linearized(page_box=b"/MediaBox [0 0 595 842]", xref_stream=False):
+    # Linearization dictionary, first page cross-reference section, first page, then the rest of the file
+    header = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+    linearization = b"10 0 obj\n<< /Linearized 1 /L {length:010} /H [ 900 120 ] /O 12 /E {end:010} /N 3 /T 5000 >>\nendobj\n"
+    if xref_stream:
+        xref = b"13 0 obj\n<< /Type /XRef /Size 20 /W [1 2 1] /Index [10 4] /Prev 4900 /Length 16 >>\nstream\n" + b"\x00" * 16 + b"\nendstream\nendobj\n"
+    else:
+        xref = b"xref\n10 3\n0000000000 00000 n \n0000000000 00000 n \n0000000000 00000 n \ntrailer\n<< /Size 20 /Root 11 0 R /Prev 4900 >>\nstartxref\n0\n%%EOF\n"
+    first_page = b"12 0 obj\n<< /Type /Page /Parent 2 0 R " + page_box + b" /Contents 14 0 R >>\nendobj\n"
+    rest = b"2 0 obj\n<< /Type /Pages /Kids [12 0 R 3 0 R 4 0 R] /Count 3 >>\nendobj\n" + b"\x00" * 4000
+    prefix_length = len(header) + len(linearization.replace(b"{length:010}", b"0" * 10).replace(b"{end:010}", b"0" * 10))
+    end = prefix_length + len(xref) + len(first_page)
+    length = end + len(rest)
+    linearization = linearization.replace(b"{length:010}", b"%010d" % length).replace(b"{end:010}", b"%010d" % end)
+    return header + linearization + xref + first_page + rest, end
+
+def reader(data):
+    reads = []
+    def read_range(start, end):
+        reads.append((start, end))
+        return data[start:end + 1]
+    return read_range, reads
+
+
+class PdfProbeTest(unittest.TestCase):
+
+    def test_linearized(self):
+        data, end = build_linearized()
+        read_range, reads = reader(data)
+        linearization = probe(read_range, len(data))
+        self.assertEqual(linearization["first_page_object"], 12)
+        self.assertEqual(linearization["first_page_end"], end)
+        self.assertEqual(linearization["size"], 20)
+        self.assertTrue(data.startswith(b"xref", linearization["xref_offset"]))
+        self.assertEqual(len(reads), 1)
+
+    def test_xref_stream(self):
+        data, _ = build_linearized(xref_stream=True)
+        linearization = parse_linearization(data, len(data))
+        self.assertTrue(data.startswith(b"13 0 obj", linearization["xref_offset"]))
+
+    # An incremental update after linearization leaves a stale /L and a first page section that can't be trusted
+    def test_updated_after_linearization(self):
+        data, _ = build_linearized()
+        data += b"\n% appended update"
+        self.assertIsNone(parse_linearization(data, len(data)))
+
+    def test_not_linearized(self):
+        data = b"%PDF-1.4\n1 0 obj\n<< /Type /Catalog >>\nendobj\n" + b"\x00" * 100
+        read_range, _ = reader(data)
+        self.assertIsNone(probe(read_range, len(data)))
+        read_range, _ = reader(b"\x89PNG\r\n\x1a\n")
+        self.assertIsNone(probe(read_range, 8))
+
+    def test_page_size(self):
+        data, _ = build_linearized()
+        self.assertEqual(page_size(data, 12), (595, 842, False))
+        data, _ = build_linearized(b"/MediaBox [0 0 595 842] /CropBox [10 10 410 310] /Rotate 90")
+        self.assertEqual(page_size(data, 12), (300, 400, True))
+        self.assertEqual(page_size(b"%PDF-1.7\n", 12), (612, 792, False))
+
+    def test_render_dpi(self):
+        self.assertEqual(render_dpi(842, 800), 68.41)
+        self.assertEqual(render_dpi(792, 96), 8.73)
+
+    def test_first_page_document(self):
+        data, end = build_linearized()
+        linearization = parse_linearization(data, len(data))
+        document = first_page_document(data[:end], linearization)
+        # The original offsets are kept and the main cross-reference section isn't referenced anymore
+        self.assertEqual(document[:linearization["xref_offset"]], data[:linearization["xref_offset"]])
+        self.assertNotIn(b"/Prev 4900", document)
+        startxref = int(re.findall(rb"startxref\n(\d+)", document)[-1])
+        self.assertTrue(document.startswith(b"xref", startxref))
+        entries = re.findall(rb"(\d{10}) 00000 n", document[startxref:])
+        self.assertTrue(document.startswith(b"20 0 obj", int(entries[0])))
+        self.assertTrue(document.startswith(b"21 0 obj", int(entries[1])))
+        self.assertIn(b"/Kids [12 0 R]", document)
+        self.assertIn(b"/Root 21 0 R /Prev %d" % linearization["xref_offset"], document)
@@ -0,0 +1,76 @@
+import json
+import unittest
+
+from profiles import container_source, filter_args, parse_probe, parse_rate, rate_args, select_profile
+
+def probe_output(width, height, rate="30000/1001", duration="12.5", rotation=None):
+    stream = {"width": width, "height": height, "codec_name": "h264", "avg_frame_rate": rate, "r_frame_rate": rate}
+    if rotation is not None:
+        stream["side_data_list"] = [{"rotation": rotation}]
+    return json.dumps({"streams": [stream], "format": {"duration": duration}})
+
+
+class ProfilesTest(unittest.TestCase):
+
+    def test_parse_probe(self):
+        source = parse_probe(probe_output(1920, 1080))
+        self.assertEqual((source["width"], source["height"], source["codec"], source["duration"]), (1920, 1080, "h264", 12.5))
+        self.assertAlmostEqual(source["fps"], 29.97, places=2)
+
+    def test_parse_probe_rotated(self):
+        source = parse_probe(probe_output(1920, 1080, rotation=-90))
+        self.assertEqual((source["width"], source["height"]), (1080, 1920))
+
+    def test_parse_probe_empty(self):
+        source = parse_probe("")
+        self.assertEqual((source["width"], source["fps"], source["duration"]), (None, None, None))
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate("15/1"), 15)
+        self.assertIsNone(parse_rate("0/0"))
+        self.assertIsNone(parse_rate(None))
+
+    def test_downscales_large_sources(self):
+        profile = select_profile({"width": 3840, "height": 2160, "fps": 60})
+        self.assertEqual(profile, {"width": 1280, "height": 720, "fps": 24, "bitrate": 1400})
+
+    def test_never_upscales(self):
+        profile = select_profile({"width": 854, "height": 480, "fps": 30})
+        self.assertEqual((profile["width"], profile["height"]), (854, 480))
+        self.assertLess(profile["bitrate"], 1400)
+
+    def test_keeps_portrait_orientation(self):
+        profile = select_profile({"width": 1080, "height": 1920, "fps": 30})
+        self.assertEqual((profile["width"], profile["height"]), (720, 1280))
+
+    def test_keeps_aspect_ratio_with_even_sizes(self):
+        profile = select_profile({"width": 1440, "height": 1080, "fps": 25})
+        self.assertEqual((profile["width"], profile["height"]), (960, 720))
+        profile = select_profile({"width": 2560, "height": 1097, "fps": 25})
+        self.assertEqual((profile["width"] % 2, profile["height"] % 2), (0, 0))
+
+    def test_keeps_lower_frame_rates(self):
+        profile = select_profile({"width": 1280, "height": 720, "fps": 15})
+        self.assertEqual(profile["fps"], 15)
+        self.assertEqual(profile["bitrate"], 875)
+
+    def test_tight_budget(self):
+        profile = select_profile({"width": 1920, "height": 1080, "fps": 30}, tight=True)
+        self.assertEqual((profile["width"], profile["height"]), (854, 480))
+
+    def test_unknown_source(self):
+        self.assertEqual(select_profile({}), {"width": 1280, "height": 720, "fps": 24, "bitrate": 1400})
+
+    def test_container_source(self):
+        info = {"duration": 10.0, "tracks": [{"handler": "soun", "codec": "mp4a", "width": 0, "height": 0, "duration": 10.0},
+            {"handler": "vide", "codec": "avc1", "width": 640, "height": 360, "duration": 10.0}]}
+        self.assertEqual(container_source(info)["width"], 640)
+        self.assertEqual(container_source(None), {})
+
+    def test_args(self):
+        profile = {"width": 960, "height": 720, "fps": 24, "bitrate": 1050}
+        self.assertEqual(filter_args(profile), "fps=24,scale=960:720")
+        self.assertEqual(rate_args(profile), "-b:v 1050k -maxrate 1575k -bufsize 2100k")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import importlib.util
+import os
+import unittest
+from unittest.mock import patch
+
+import renderers
+from renderers import Renderer
+
+def job(extension=".png", category="image", content_length=100):
+    return {"category": category, "extension": extension, "content_length": content_length,
+        "output": "/tmp/thumbnail.png", "sizes": [800, 320]}
+
+
+class RendererDispatchTest(unittest.TestCase):
+
+    def test_cheapest_capable(self):
+        calls = []
+        registry = [
+            Renderer("cli", ["image", "pdf"], 10, lambda job: calls.append("cli") or job["sizes"]),
+            Renderer("fast", ["image"], 1, lambda job: calls.append("fast") or job["sizes"], extensions=(".png",))
+        ]
+        with patch.object(renderers, "registry", registry):
+            self.assertEqual(renderers.render(job()), ("fast", [800, 320]))
+            self.assertEqual(renderers.render(job(".pdf", "pdf")), ("cli", [800, 320]))
+        self.assertEqual(calls, ["fast", "cli"])
+
+    # A renderer that can't handle the file hands it over to the next cheapest one
+    def test_falls_back(self):
+        registry = [
+            Renderer("cli", ["image"], 10, lambda job: [800]),
+            Renderer("fast", ["image"], 1, lambda job: [])
+        ]
+        with patch.object(renderers, "registry", registry):
+            self.assertEqual(renderers.render(job()), ("cli", [800]))
+
+    def test_unavailable(self):
+        checks = []
+        registry = [Renderer("missing", ["image"], 1, lambda job: [800], available=lambda: checks.append(1))]
+        with patch.object(renderers, "registry", registry):
+            self.assertIsNone(renderers.render(job()))
+            self.assertIsNone(renderers.render(job()))
+        self.assertEqual(len(checks), 1)
+
+    def test_no_renderer(self):
+        with patch.object(renderers, "registry", []):
+            self.assertIsNone(renderers.render(job()))
+
+
+@unittest.skipUnless(importlib.util.find_spec("PIL"), "Pillow isn't installed")
+class PillowRendererTest(unittest.TestCase):
+
+    def test_ladder(self):
+        import io
+        from PIL import Image
+        data = io.BytesIO()
+        Image.new("RGB", (1600, 900), "red").save(data, "JPEG")
+        outputs = ["/tmp/pillow-800.png", "/tmp/pillow-320.png"]
+        thumb_job = dict(job(".jpg", content_length=len(data.getvalue())), outputs=outputs,
+            read=data.getvalue, max_in_process_size=1 << 20)
+        self.assertEqual(renderers.pillow_thumb(thumb_job), [800, 320])
+        self.assertEqual(Image.open(outputs[0]).size, (800, 450))
+        self.assertEqual(Image.open(outputs[1]).size, (320, 180))
+        for output in outputs:
+            os.remove(output)
+
+    def test_too_large(self):
+        thumb_job = dict(job(".jpg", content_length=2 << 20), max_in_process_size=1 << 20)
+        self.assertEqual(renderers.pillow_thumb(thumb_job), [])
+
+    def test_unreadable(self):
+        thumb_job = dict(job(".png"), outputs=["/tmp/pillow.png"], read=lambda: b"not an image", max_in_process_size=1 << 20)
+        self.assertEqual(renderers.pillow_thumb(thumb_job), [])
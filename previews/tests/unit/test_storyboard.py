@@ -0,0 +1,24 @@
+import unittest
+
+from storyboard import frame_times, sprite_command, webvtt
+
+
+class StoryboardTest(unittest.TestCase):
+
+    def test_frame_times(self):
+        self.assertEqual(frame_times(40, 4), [5, 15, 25, 35])
+
+    # Every frame is a keyframe-only decode after an input-side seek
+    def test_sprite_command(self):
+        command = sprite_command("https://url", frame_times(40, 4), 2, 160, "/tmp/storyboard.jpg")
+        self.assertEqual(command.count("https://url"), 4)
+        self.assertEqual(command.count("nokey"), 4)
+        self.assertLess(command.index("-ss"), command.index("-i"))
+        self.assertIn("tile=2x2", command[command.index("-filter_complex") + 1])
+
+    def test_webvtt(self):
+        vtt = webvtt(40, 4, 2, 160, "storyboard.jpg").splitlines()
+        self.assertEqual(vtt[0], "WEBVTT")
+        self.assertEqual(vtt[2], "00:00:00.000 --> 00:00:10.000")
+        self.assertEqual(vtt[3], "storyboard.jpg#xywh=0,0,160,90")
+        self.assertEqual(vtt[-1], "storyboard.jpg#xywh=160,90,160,90")
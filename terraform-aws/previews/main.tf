@@ -15,6 +15,9 @@ locals {
   s3_arn       = [for name in var.bucket_names : "arn:aws:s3:::${name}"]
   s3_policies  = [for name in var.bucket_names : "arn:aws:s3:::${name}/*"]
   s3_resources = concat(local.s3_policies, local.s3_arn)
+  # One notification rule per supported extension, S3 suffix filters are case sensitive so both cases are listed
+  file_formats       = yamldecode(file("${path.module}/../../previews-filter/file_formats.yml"))
+  preview_extensions = distinct(flatten([for extension in concat(local.file_formats.video, local.file_formats.pdf, local.file_formats.image) : [lower(extension), upper(extension)]]))
 }
 
 resource "aws_iam_role" "lambda_role" {
@@ -56,6 +59,7 @@ resource "aws_lambda_function" "terraform_lambda_video" {
     variables = {
       preview_duration = var.preview_duration
       preview_audio    = var.preview_audio
+      preview_offset   = var.preview_offset
     }
   }
 }
@@ -76,6 +80,8 @@ resource "aws_lambda_function" "terraform_lambda_image" {
   environment {
     variables = {
       preview_duration = var.preview_duration
+      preview_audio    = var.preview_audio
+      preview_offset   = var.preview_offset
     }
   }
 }
@@ -102,6 +108,8 @@ resource "aws_iam_policy" "iam_policy_for_lambda" {
     "Action": [
        "s3:GetObject",
        "s3:PutObject",
+       "s3:AbortMultipartUpload",
+       "s3:DeleteObject",
        "s3:ListBucket",
        "s3:GetObjectTagging",
        "s3:PutObjectTagging"
@@ -113,9 +121,17 @@ resource "aws_iam_policy" "iam_policy_for_lambda" {
     "Action": [
         "lambda:InvokeAsync",
         "lambda:InvokeFunction",
-        "lambda:GetFunctionConfiguration"
+        "lambda:GetFunctionConfiguration",
+        "lambda:GetFunctionConcurrency"
      ],
-     "Resource": ["${aws_lambda_function.terraform_lambda_video.arn}", "${aws_lambda_function.terraform_lambda_image.arn}"],
+     "Resource": ["${aws_lambda_function.terraform_lambda_video.arn}", "${aws_lambda_function.terraform_lambda_image.arn}", "${aws_lambda_function.terraform_lambda_checker.arn}"],
+     "Effect": "Allow"
+   },
+   {
+    "Action": [
+        "lambda:GetAccountSettings"
+     ],
+     "Resource": "*",
      "Effect": "Allow"
    }
  ]
@@ -147,6 +163,11 @@ resource "aws_lambda_function" "terraform_lambda_filter" {
     variables = {
       high_resource_lambda_name = aws_lambda_function.terraform_lambda_video.function_name
       low_resource_lambda_name  = aws_lambda_function.terraform_lambda_image.function_name
+      routing_config_ttl        = var.routing_config_ttl
+      routing_small_video_mb    = var.routing_small_video_mb
+      routing_large_image_mb    = var.routing_large_image_mb
+      routing_large_pdf_mb      = var.routing_large_pdf_mb
+      routing_batch_size        = var.routing_batch_size
     }
   }
 }
@@ -163,12 +184,16 @@ resource "aws_lambda_permission" "allow_bucket_filter" {
 resource "aws_s3_bucket_notification" "preview-trigger" {
   count = (length(var.bucket_names))
   bucket = var.bucket_names[count.index]
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.terraform_lambda_filter.arn
-    id = "${var.bucket_names[count.index]}-create-trigger"
-    events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = ""
-    filter_suffix       = ""
+  # Only supported extensions invoke the filter, the leases and cache index the previews write under previews/ are .json
+  dynamic "lambda_function" {
+    for_each = local.preview_extensions
+    content {
+      lambda_function_arn = aws_lambda_function.terraform_lambda_filter.arn
+      id = "${var.bucket_names[count.index]}-create-trigger${lambda_function.value}"
+      events              = ["s3:ObjectCreated:*"]
+      filter_prefix       = ""
+      filter_suffix       = lambda_function.value
+    }
   }
   lambda_function {
     lambda_function_arn = aws_lambda_function.terraform_lambda_filter.arn
@@ -197,6 +222,18 @@ resource "aws_lambda_function" "terraform_lambda_checker" {
     variables = {
       high_resource_lambda_name = aws_lambda_function.terraform_lambda_video.function_name
       low_resource_lambda_name  = aws_lambda_function.terraform_lambda_image.function_name
+      routing_config_ttl        = var.routing_config_ttl
+      routing_small_video_mb    = var.routing_small_video_mb
+      routing_large_image_mb    = var.routing_large_image_mb
+      routing_large_pdf_mb      = var.routing_large_pdf_mb
+      routing_batch_size        = var.routing_batch_size
+      checker_tag_workers       = var.checker_tag_workers
+      checker_max_shards        = var.checker_max_shards
+      checker_inventory_manifest = var.checker_inventory_manifest
+      dispatch_target_concurrency = var.dispatch_target_concurrency
+      dispatch_live_share        = var.dispatch_live_share
+      dispatch_high_seconds      = var.dispatch_high_seconds
+      dispatch_low_seconds       = var.dispatch_low_seconds
     }
   }
 }
@@ -26,10 +26,62 @@ variable "preview_audio" {
   default = false
 }
 
+variable "preview_offset" {
+  default = "start"
+}
+
+variable "routing_config_ttl" {
+  default = 300
+}
+
+variable "routing_small_video_mb" {
+  default = 20
+}
+
+variable "routing_large_image_mb" {
+  default = 100
+}
+
+variable "routing_large_pdf_mb" {
+  default = 50
+}
+
+variable "routing_batch_size" {
+  default = 10
+}
+
 variable "timeout_checker" {
   default = 600
 }
 
+variable "checker_tag_workers" {
+  default = 16
+}
+
+variable "checker_max_shards" {
+  default = 64
+}
+
+variable "checker_inventory_manifest" {
+  default = ""
+}
+
+variable "dispatch_target_concurrency" {
+  default = 100
+}
+
+variable "dispatch_live_share" {
+  default = 0.3
+}
+
+variable "dispatch_high_seconds" {
+  default = 60
+}
+
+variable "dispatch_low_seconds" {
+  default = 10
+}
+
 variable "memory_size_previews_video" {
   default = 7169
 }